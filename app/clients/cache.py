@@ -0,0 +1,42 @@
+import threading
+import time
+import typing
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class TTLCache(typing.Generic[K, V]):
+    """
+    Small bounded cache, entries expire after ``ttl`` seconds and the least
+    recently stored entries are evicted once ``max_size`` is reached. Safe to
+    use from the worker threads
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: dict[K, tuple[float, V]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> V | None:
+        if (item := self._data.get(key)) is None:
+            return None
+
+        stored_at, value = item
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            with self._lock:
+                self._data.pop(key, None)
+            return None
+
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic(), value)
+            while len(self._data) > self.max_size:
+                del self._data[next(iter(self._data))]
+
+    def __len__(self) -> int:
+        return len(self._data)
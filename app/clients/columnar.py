@@ -0,0 +1,205 @@
+"""
+Parquet files of the simulation output for the local analysis, readable by
+pandas, DuckDB, Spark and the other Parquet readers.
+
+Every written batch of rows is one row group of the file. Parquet keeps the
+min/max statistics of the columns of every row group in the footer, they are
+used to skip the row groups by the filters.
+
+pyarrow is imported on the first use, so the servers start without loading it
+when the sink is disabled.
+"""
+from __future__ import annotations
+
+import glob
+import os
+import typing
+
+if typing.TYPE_CHECKING:
+    import pyarrow
+    import pyarrow.parquet
+
+INT64 = "int64"
+FLOAT64 = "float64"
+STRING = "string"
+
+FILE_EXTENSION = ".parquet"
+
+COMPRESSION = "zstd"
+
+Schema = list[tuple[str, str]]
+Column = list[typing.Any]
+
+
+class ColumnarFileError(Exception):
+    pass
+
+
+def _get_arrow_types() -> dict[str, pyarrow.DataType]:
+    import pyarrow
+
+    return {
+        INT64: pyarrow.int64(),
+        FLOAT64: pyarrow.float64(),
+        STRING: pyarrow.string(),
+    }
+
+
+def _get_arrow_schema(schema: Schema) -> pyarrow.Schema:
+    import pyarrow
+
+    types = _get_arrow_types()
+    return pyarrow.schema([(name, types[type_]) for name, type_ in schema])
+
+
+class ColumnarWriter:
+    """
+    Writes the row groups to the Parquet file, the file is readable only after
+    close, when the footer is written
+    """
+
+    def __init__(self, path: str, schema: Schema):
+        import pyarrow.parquet
+
+        self.path = path
+        self.schema = schema
+        self.rows_number = 0
+        self._arrow_schema = _get_arrow_schema(schema)
+        self._file = open(path, "wb")
+        self._writer = pyarrow.parquet.ParquetWriter(
+            self._file, self._arrow_schema, compression=COMPRESSION
+        )
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+    def write_row_group(self, columns: dict[str, list[typing.Any]]) -> None:
+        import pyarrow
+
+        rows_number = len(columns[self.schema[0][0]])
+        if not rows_number:
+            return
+
+        for name, _ in self.schema:
+            if len(columns[name]) != rows_number:
+                raise ColumnarFileError(f"Column {name} has {len(columns[name])} rows")
+
+        table = pyarrow.Table.from_pydict(
+            {name: columns[name] for name, _ in self.schema}, schema=self._arrow_schema
+        )
+        self._writer.write_table(table, row_group_size=rows_number)
+        self.rows_number += rows_number
+
+    def close(self) -> None:
+        self._writer.close()
+        self._file.close()
+
+
+class ColumnarFile:
+    """
+    Parquet file read by the row groups
+    """
+
+    def __init__(self, path: str):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.path = path
+        try:
+            self._file = pyarrow.parquet.ParquetFile(path)
+        except pyarrow.ArrowInvalid as e:
+            raise ColumnarFileError(f"{path} is not a complete Parquet file") from e
+
+        type_names = {type_: name for name, type_ in _get_arrow_types().items()}
+        self.schema: Schema = [
+            (field.name, type_names.get(field.type, str(field.type)))
+            for field in self._file.schema_arrow
+        ]
+
+    def __enter__(self) -> ColumnarFile:
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+    @property
+    def row_groups_number(self) -> int:
+        return self._file.metadata.num_row_groups
+
+    @property
+    def rows_number(self) -> int:
+        return self._file.metadata.num_rows
+
+    def read_column(self, row_group_index: int, name: str) -> Column:
+        return self._file.read_row_group(row_group_index, columns=[name])[
+            name
+        ].to_pylist()
+
+    def matches(
+        self, row_group_index: int, filters: dict[str, tuple[float, float]]
+    ) -> bool:
+        """
+        Checks by the statistics if the row group may have the rows with
+        the values of the columns in the [min, max] ranges
+        """
+        row_group = self._file.metadata.row_group(row_group_index)
+        columns = {
+            row_group.column(i).path_in_schema: row_group.column(i)
+            for i in range(row_group.num_columns)
+        }
+        for name, (min_value, max_value) in filters.items():
+            statistics = columns[name].statistics
+            if statistics is None or not statistics.has_min_max:
+                continue
+            if statistics.max < min_value or statistics.min > max_value:
+                return False
+        return True
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def find_files(directory: str, table: str) -> list[str]:
+    return sorted(
+        glob.glob(
+            os.path.join(directory, table, "**", f"*{FILE_EXTENSION}"), recursive=True
+        )
+    )
+
+
+def load_table(
+    directory: str,
+    table: str,
+    columns: list[str] | None = None,
+    filters: dict[str, tuple[float, float]] | None = None,
+) -> pyarrow.Table | None:
+    """
+    Loads the columns of the table from all its partitions in the directory,
+    None if the table has no files. Row groups are pruned by the statistics of
+    the filtered columns, then the rows outside the [min, max] ranges are
+    filtered out. The files are memory-mapped, the columns stay in the Arrow
+    buffers for the pyarrow.compute functions
+    """
+    import pyarrow.compute
+    import pyarrow.parquet
+
+    paths = find_files(directory, table)
+    if not paths:
+        return None
+
+    expression = None
+    for name, (min_value, max_value) in (filters or {}).items():
+        field = pyarrow.compute.field(name)
+        condition = (field >= min_value) & (field <= max_value)
+        expression = condition if expression is None else expression & condition
+
+    # the partitions are in the paths already, e.g. date=YYYY-MM-DD, so the
+    # files are read as they are
+    return pyarrow.parquet.read_table(
+        paths,
+        columns=columns,
+        filters=expression,
+        partitioning=None,
+        memory_map=True,
+    )
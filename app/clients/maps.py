@@ -1,19 +1,77 @@
 from __future__ import annotations
 
+import codecs
+import dataclasses
+import json
+import logging
+import math
 import typing
 
-import polyline  # type: ignore[import-untyped]
-import requests  # type: ignore[import-untyped]
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from app.config import MAPS_API_TOKEN
+from app.clients.cache import TTLCache
+from app.clients.resilience import (
+    CircuitOpenError,
+    DeadlineExceededError,
+    ResilientCaller,
+    RetryableError,
+)
+from app.config import get_maps_api_token
+from app.diagnostics.tracing import traced
 
+if typing.TYPE_CHECKING:
+    import requests  # type: ignore[import-untyped]
 
-class LocationPoint(BaseModel):
+logger = logging.getLogger(__name__)
+
+ROUTES_FIELD_MASK = (
+    "routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline"
+)
+ROUTE_MATRIX_FIELD_MASK = (
+    "originIndex,destinationIndex,duration,distanceMeters,status,condition"
+)
+
+# Limits of computeRouteMatrix for the TRAFFIC_AWARE routing preference
+# https://developers.google.com/maps/documentation/routes/choose_endpoint
+MAX_ROUTE_MATRIX_ELEMENTS = 100
+MAX_ROUTE_MATRIX_WAYPOINTS = 50
+
+ROUTE_MATRIX_CACHE_TTL_IN_SECONDS = 10 * 60
+ROUTES_CACHE_TTL_IN_SECONDS = 60 * 60
+
+MAPS_REQUEST_DEADLINE_IN_SECONDS = 10
+MAPS_REQUEST_ATTEMPT_TIMEOUT_IN_SECONDS = 4
+MAPS_REQUEST_MAX_ATTEMPTS = 3
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# used to estimate the routes when Maps API is unavailable
+STRAIGHT_LINE_ROAD_FACTOR = 1.3
+STRAIGHT_LINE_SPEED_IN_METERS_PER_SECOND = 60 / 3.6
+STRAIGHT_LINE_POINTS_STEP_IN_METERS = 500
+
+EARTH_RADIUS_IN_METERS = 6_371_000
+
+
+class MapsClientError(Exception):
+    pass
+
+
+class MapsUnavailableError(MapsClientError):
+    """
+    Maps API can't be reached: the request timed out, failed after the retries
+    or the circuit breaker is open
+    """
+
+
+@dataclasses.dataclass(slots=True)
+class LocationPoint:
     lat: float
     lon: float
 
 
+Waypoint = str | LocationPoint
+
+
 class RouteResponse(BaseModel):
     origin_address: str | None = None
     origin_location: LocationPoint | None = None
@@ -23,9 +81,85 @@ class RouteResponse(BaseModel):
     expected_duration_in_seconds: int
 
 
+class RouteMatrixElement(BaseModel):
+    origin_index: int
+    destination_index: int
+    duration_in_seconds: int | None = None
+    distance_meters: int | None = None
+
+
+def get_distance_in_meters(p1: LocationPoint, p2: LocationPoint) -> float:
+    """
+    Returns the great-circle (haversine) distance between two points
+    """
+    lat1, lat2 = math.radians(p1.lat), math.radians(p2.lat)
+    d_lat = lat2 - lat1
+    d_lon = math.radians(p2.lon - p1.lon)
+    a = (
+        math.sin(d_lat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(d_lon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_IN_METERS * math.asin(math.sqrt(a))
+
+
+def _iter_json_array(chunks: typing.Iterable[bytes]) -> typing.Iterator[typing.Any]:
+    """
+    Incrementally decodes the items of a JSON array that arrives in chunks,
+    so the items can be consumed before the whole response is downloaded
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                position += 1
+            if position >= len(buffer):
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield item
+        buffer = buffer[position:]
+
+
 # Polyline decoder
 # https://developers.google.com/maps/documentation/utilities/polylineutility
 class MapsClient(BaseModel):
+    hedge_requests: bool = False
+
+    _resilient_caller: ResilientCaller = PrivateAttr()
+    _routes_cache: TTLCache[tuple, RouteResponse] = PrivateAttr(
+        default_factory=lambda: TTLCache(ttl=ROUTES_CACHE_TTL_IN_SECONDS)
+    )
+    _route_matrix_cache: TTLCache[tuple, RouteMatrixElement] = PrivateAttr(
+        default_factory=lambda: TTLCache(ttl=ROUTE_MATRIX_CACHE_TTL_IN_SECONDS)
+    )
+    _locations_cache: TTLCache[str, LocationPoint] = PrivateAttr(
+        default_factory=TTLCache
+    )
+
+    def model_post_init(self, __context: typing.Any) -> None:
+        # requests is imported with the first client, not with the module
+        import requests
+
+        self._resilient_caller = ResilientCaller(
+            deadline=MAPS_REQUEST_DEADLINE_IN_SECONDS,
+            attempt_timeout=MAPS_REQUEST_ATTEMPT_TIMEOUT_IN_SECONDS,
+            max_attempts=MAPS_REQUEST_MAX_ATTEMPTS,
+            retryable_exceptions=(
+                RetryableError,
+                TimeoutError,
+                requests.ConnectionError,
+                requests.Timeout,
+            ),
+            hedge=self.hedge_requests,
+        )
+
+    @traced("maps.get_route")
     def get_route(
         self,
         *,
@@ -42,39 +176,15 @@ class MapsClient(BaseModel):
                 "Destination address or destination location must be specified!"
             )
 
-        origin: dict[str, typing.Any] = {}
-        if origin_address:
-            origin.update({"address": origin_address})
-        elif origin_location:
-            origin.update(
-                {
-                    "location": {
-                        "latLng": {
-                            "latitude": origin_location.lat,
-                            "longitude": origin_location.lon,
-                        }
-                    }
-                }
-            )
-
-        destination: dict[str, typing.Any] = {}
-        if destination_address:
-            destination.update({"address": destination_address})
-        elif destination_location:
-            destination.update(
-                {
-                    "location": {
-                        "latLng": {
-                            "latitude": destination_location.lat,
-                            "longitude": destination_location.lon,
-                        }
-                    }
-                }
-            )
+        origin = typing.cast(Waypoint, origin_address or origin_location)
+        destination = typing.cast(Waypoint, destination_address or destination_location)
+        cache_key = (self._get_cache_key(origin), self._get_cache_key(destination))
+        if cached := self._routes_cache.get(cache_key):
+            return cached
 
         data = {
-            "origin": origin,
-            "destination": destination,
+            "origin": self._get_waypoint(origin),
+            "destination": self._get_waypoint(destination),
             "travelMode": "DRIVE",
             "routingPreference": "TRAFFIC_AWARE",
             "departureTime": "2023-11-15T15:01:23.045123456Z",
@@ -88,16 +198,43 @@ class MapsClient(BaseModel):
             "units": "METRIC",
         }
 
-        response = requests.post(
-            "https://routes.googleapis.com/directions/v2:computeRoutes",
-            json=data,
-            headers=self._get_default_headers(),
-        )
+        try:
+            response = self._post(
+                "https://routes.googleapis.com/directions/v2:computeRoutes",
+                json=data,
+                headers=self._get_default_headers(),
+            )
+        except MapsUnavailableError as e:
+            if not (
+                (origin_point := self._get_known_location(origin))
+                and (destination_point := self._get_known_location(destination))
+            ):
+                raise
+
+            logger.warning(f"Using straight-line route estimate, because of: {e}")
+            return RouteResponse(
+                origin_address=origin_address,
+                origin_location=origin_location,
+                destination_address=destination_address,
+                destination_location=destination_location,
+                location_points=self._get_straight_line_points(
+                    origin_point, destination_point
+                ),
+                expected_duration_in_seconds=self._get_straight_line_duration(
+                    origin_point, destination_point
+                ),
+            )
+
         data = response.json()
+        if not data.get("routes"):
+            raise MapsClientError(f"Route from {origin} to {destination} not found")
+
+        import polyline  # type: ignore[import-untyped]
+
         encoded_polyline = data["routes"][0]["polyline"]["encodedPolyline"]  # type: ignore[index]
         data_points = polyline.decode(encoded_polyline)
         expected_duration_in_seconds = int(data["routes"][0]["duration"][:-1])  # type: ignore[index]
-        return RouteResponse(
+        route_response = RouteResponse(
             origin_address=origin_address,
             origin_location=origin_location,
             destination_address=destination_address,
@@ -105,31 +242,257 @@ class MapsClient(BaseModel):
             location_points=[LocationPoint(lat=dp[0], lon=dp[1]) for dp in data_points],
             expected_duration_in_seconds=expected_duration_in_seconds,
         )
+        self._routes_cache.set(cache_key, route_response)
+        return route_response
+
+    @traced("maps.get_route_matrix")
+    def get_route_matrix(
+        self,
+        *,
+        origins: list[Waypoint],
+        destinations: list[Waypoint],
+    ) -> list[RouteMatrixElement]:
+        """
+        Returns the route durations and distances for every origin/destination
+        pair. Pairs that are already cached are not requested again, the rest
+        are requested in chunks that fit the element limits of the endpoint.
+        Indexes of returned elements refer to the passed origins and destinations
+        """
+        elements: list[RouteMatrixElement] = []
+        missing_origins: set[int] = set()
+        missing_destinations: set[int] = set()
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                key = (self._get_cache_key(origin), self._get_cache_key(destination))
+                if cached := self._route_matrix_cache.get(key):
+                    elements.append(
+                        cached.model_copy(
+                            update={"origin_index": i, "destination_index": j}
+                        )
+                    )
+                else:
+                    missing_origins.add(i)
+                    missing_destinations.add(j)
+
+        if not missing_origins:
+            return elements
+
+        origin_indexes = sorted(missing_origins)
+        destination_indexes = sorted(missing_destinations)
+        destinations_chunk_size = min(
+            len(destination_indexes),
+            MAX_ROUTE_MATRIX_ELEMENTS,
+            MAX_ROUTE_MATRIX_WAYPOINTS - 1,
+        )
+        origins_chunk_size = min(
+            MAX_ROUTE_MATRIX_ELEMENTS // destinations_chunk_size,
+            MAX_ROUTE_MATRIX_WAYPOINTS - destinations_chunk_size,
+        )
+        cached_pairs = {(e.origin_index, e.destination_index) for e in elements}
+
+        for i in range(0, len(origin_indexes), origins_chunk_size):
+            chunk_origins = origin_indexes[i : i + origins_chunk_size]
+            for j in range(0, len(destination_indexes), destinations_chunk_size):
+                chunk_destinations = destination_indexes[
+                    j : j + destinations_chunk_size
+                ]
+                chunk = (
+                    [origins[k] for k in chunk_origins],
+                    [destinations[k] for k in chunk_destinations],
+                )
+                is_estimate = False
+                try:
+                    chunk_elements = list(self._compute_route_matrix(*chunk))
+                except MapsUnavailableError as e:
+                    logger.warning(
+                        f"Using straight-line route matrix estimate, because of: {e}"
+                    )
+                    chunk_elements = self._estimate_route_matrix(*chunk)
+                    is_estimate = True
+
+                for element in chunk_elements:
+                    origin_index = chunk_origins[element.origin_index]
+                    destination_index = chunk_destinations[element.destination_index]
+                    if (origin_index, destination_index) in cached_pairs:
+                        continue
 
+                    element.origin_index = origin_index
+                    element.destination_index = destination_index
+                    elements.append(element)
+                    if not is_estimate and element.duration_in_seconds is not None:
+                        self._route_matrix_cache.set(
+                            (
+                                self._get_cache_key(origins[origin_index]),
+                                self._get_cache_key(destinations[destination_index]),
+                            ),
+                            element,
+                        )
+
+        return elements
+
+    @traced("maps.get_location")
     def get_location(self, address) -> LocationPoint:
+        if cached := self._locations_cache.get(address):
+            return cached
+
         params = self._get_default_params()
         params.update({"address": address})
 
-        response = requests.post(
+        response = self._post(
             "https://maps.googleapis.com/maps/api/geocode/json",
             params=params,
             headers=self._get_default_headers(),
         )
         data = response.json()
+        if not data.get("results"):
+            raise MapsClientError(f"Unable to get location of {address}")
+
         location = data["results"][0]["geometry"]["location"]
 
-        return LocationPoint(lat=location["lat"], lon=location["lng"])
+        location_point = LocationPoint(lat=location["lat"], lon=location["lng"])
+        self._locations_cache.set(address, location_point)
+        return location_point
+
+    def _compute_route_matrix(
+        self, origins: list[Waypoint], destinations: list[Waypoint]
+    ) -> typing.Iterator[RouteMatrixElement]:
+        data: dict[str, typing.Any] = {
+            "origins": [{"waypoint": self._get_waypoint(o)} for o in origins],
+            "destinations": [{"waypoint": self._get_waypoint(d)} for d in destinations],
+            "travelMode": "DRIVE",
+            "routingPreference": "TRAFFIC_AWARE",
+        }
+
+        with self._post(
+            "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix",
+            json=data,
+            headers=self._get_default_headers(field_mask=ROUTE_MATRIX_FIELD_MASK),
+            stream=True,
+        ) as response:
+            for item in _iter_json_array(response.iter_content(chunk_size=4096)):
+                route_exists = item.get("condition") == "ROUTE_EXISTS"
+                yield RouteMatrixElement(
+                    origin_index=item.get("originIndex", 0),
+                    destination_index=item.get("destinationIndex", 0),
+                    duration_in_seconds=int(item["duration"][:-1])
+                    if route_exists and "duration" in item
+                    else None,
+                    distance_meters=item.get("distanceMeters")
+                    if route_exists
+                    else None,
+                )
+
+    def _estimate_route_matrix(
+        self, origins: list[Waypoint], destinations: list[Waypoint]
+    ) -> list[RouteMatrixElement]:
+        elements = []
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                element = RouteMatrixElement(origin_index=i, destination_index=j)
+                if (origin_point := self._get_known_location(origin)) and (
+                    destination_point := self._get_known_location(destination)
+                ):
+                    element.duration_in_seconds = self._get_straight_line_duration(
+                        origin_point, destination_point
+                    )
+                elements.append(element)
+        return elements
+
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        import requests
+
+        def attempt(timeout: float) -> requests.Response:
+            response = requests.post(url, timeout=timeout, **kwargs)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                response.close()
+                raise RetryableError(
+                    f"Maps API responded with status {response.status_code}"
+                )
+            response.raise_for_status()
+            return response
+
+        try:
+            return self._resilient_caller.call(attempt)
+        except (
+            CircuitOpenError,
+            DeadlineExceededError,
+            RetryableError,
+            TimeoutError,
+            requests.ConnectionError,
+            requests.Timeout,
+        ) as e:
+            raise MapsUnavailableError(str(e)) from e
+        except requests.HTTPError as e:
+            # the server errors mean the outage, the client errors are raised,
+            # so they are not hidden by the straight line estimates
+            if e.response is not None and e.response.status_code >= 500:
+                raise MapsUnavailableError(str(e)) from e
+            raise MapsClientError(str(e)) from e
+        except requests.RequestException as e:
+            raise MapsClientError(str(e)) from e
+
+    def _get_known_location(self, waypoint: Waypoint) -> LocationPoint | None:
+        if isinstance(waypoint, LocationPoint):
+            return waypoint
+
+        return self._locations_cache.get(waypoint)
+
+    @staticmethod
+    def _get_straight_line_duration(p1: LocationPoint, p2: LocationPoint) -> int:
+        return int(
+            get_distance_in_meters(p1, p2)
+            * STRAIGHT_LINE_ROAD_FACTOR
+            / STRAIGHT_LINE_SPEED_IN_METERS_PER_SECOND
+        )
+
+    @staticmethod
+    def _get_straight_line_points(
+        p1: LocationPoint, p2: LocationPoint
+    ) -> list[LocationPoint]:
+        steps = max(
+            int(get_distance_in_meters(p1, p2) / STRAIGHT_LINE_POINTS_STEP_IN_METERS), 1
+        )
+        return [
+            LocationPoint(
+                lat=p1.lat + (p2.lat - p1.lat) * i / steps,
+                lon=p1.lon + (p2.lon - p1.lon) * i / steps,
+            )
+            for i in range(steps + 1)
+        ]
+
+    @staticmethod
+    def _get_waypoint(waypoint: Waypoint) -> dict[str, typing.Any]:
+        if isinstance(waypoint, str):
+            return {"address": waypoint}
+
+        return {
+            "location": {
+                "latLng": {
+                    "latitude": waypoint.lat,
+                    "longitude": waypoint.lon,
+                }
+            }
+        }
+
+    @staticmethod
+    def _get_cache_key(waypoint: Waypoint) -> str | tuple[float, float]:
+        if isinstance(waypoint, str):
+            return waypoint
+
+        return round(waypoint.lat, 5), round(waypoint.lon, 5)
 
-    def _get_default_headers(self) -> dict[str, str]:
+    def _get_default_headers(
+        self, field_mask: str = ROUTES_FIELD_MASK
+    ) -> dict[str, str]:
         return {
             "Content-Type": "application/json",
-            "X-Goog-Api-Key": MAPS_API_TOKEN,
-            "X-Goog-FieldMask": "routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline",
+            "X-Goog-Api-Key": get_maps_api_token(),
+            "X-Goog-FieldMask": field_mask,
         }
 
     def _get_default_params(self) -> dict[str, str]:
         return {
-            "key": MAPS_API_TOKEN,
+            "key": get_maps_api_token(),
         }
 
 
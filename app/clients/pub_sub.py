@@ -1,10 +1,22 @@
+from __future__ import annotations
+
 import asyncio
-import json
+import dataclasses
+import logging
+import typing
+
+from app.clients.maps import LocationPoint
+from app.clients.sink import ColumnarSink
+from app.clients.telemetry import ENCODING_NAME, TelemetryEncoder
+from app.diagnostics.tracing import TRACEPARENT_ATTRIBUTE, inject, traced
+from app.serialization import dumps
+from app.simulation.log import Log
+from app.simulation.utils import get_timestamp
 
-from gcloud.aio.pubsub import PublisherClient, PubsubMessage
-from pydantic import BaseModel
+if typing.TYPE_CHECKING:
+    from gcloud.aio.pubsub import PublisherClient, PubsubMessage
 
-from app.simulation.log import Log
+logger = logging.getLogger(__name__)
 
 PROJECT_ID = "cloud-computing-project-403820"
 SERVICE_ACCOUNT_FILENAME = "simulation-sa.json"
@@ -18,8 +30,14 @@ FULL_DOMAIN_LOGS_TOPIC_NAME = f"projects/{PROJECT_ID}/topics/{DOMAIN_LOGS_TOPIC_
 JOURNEYS_TOPIC_NAME = "journeys"
 FULL_JOURNEYS_TOPIC_NAME = f"projects/{PROJECT_ID}/topics/{JOURNEYS_TOPIC_NAME}"
 
+COMPACT_IOT_EVENTS_TOPIC_NAME = "iot-events-compact"
+FULL_COMPACT_IOT_EVENTS_TOPIC_NAME = (
+    f"projects/{PROJECT_ID}/topics/{COMPACT_IOT_EVENTS_TOPIC_NAME}"
+)
 
-class JourneyTrackEvent(BaseModel):
+
+@dataclasses.dataclass(slots=True)
+class JourneyTrackEvent:
     truck_id: int
     lat: float
     lon: float
@@ -27,52 +45,103 @@ class JourneyTrackEvent(BaseModel):
     color: str
 
 
+def _create_message(data: str | bytes, **attributes: str) -> PubsubMessage:
+    # gcloud.aio is imported with the first published message, not with the
+    # module, it takes a large share of the server cold start
+    from gcloud.aio.pubsub import PubsubMessage
+
+    return PubsubMessage(data, **attributes)
+
+
 class PubSubClient:
-    def __init__(self, publisher_client: PublisherClient):
-        self.publisher_client = publisher_client
+    def __init__(
+        self,
+        publisher_client: PublisherClient | None = None,
+        sink: ColumnarSink | None = None,
+        service_file: str | None = None,
+    ):
+        # created on the first publish, when it's not given
+        self._publisher_client = publisher_client
+        self.service_file = service_file
+        # local copy of everything that is published, for the offline analysis
+        self.sink = sink
         self._domain_logs_queue: asyncio.Queue[Log] = asyncio.Queue()
+        self.telemetry_encoder = TelemetryEncoder()
 
     @classmethod
-    def create(cls, service_file: str | None = f"../var/{SERVICE_ACCOUNT_FILENAME}"):
-        if service_file:
-            publisher_client = PublisherClient(service_file=service_file)
-        else:
-            publisher_client = PublisherClient()
-        return cls(publisher_client=publisher_client)
+    def create(
+        cls,
+        service_file: str | None = f"../var/{SERVICE_ACCOUNT_FILENAME}",
+        sink: ColumnarSink | None = None,
+    ):
+        return cls(sink=sink, service_file=service_file)
+
+    @property
+    def publisher_client(self) -> PublisherClient:
+        if self._publisher_client is None:
+            from gcloud.aio.pubsub import PublisherClient
+
+            if self.service_file:
+                self._publisher_client = PublisherClient(service_file=self.service_file)
+            else:
+                self._publisher_client = PublisherClient()
+        return self._publisher_client
 
     async def publish_events(self, events: list[JourneyTrackEvent]):
-        messages = [PubsubMessage(json.dumps(e.model_dump())) for e in events]
+        messages = [_create_message(dumps(e)) for e in events]
         await self.publisher_client.publish(FULL_IOT_EVENTS_TOPIC_NAME, messages)
 
+    async def publish_compact_events(self, batches: list[tuple[int, bytes]]):
+        messages = [
+            _create_message(data, truck_id=str(truck_id), encoding=ENCODING_NAME)
+            for truck_id, data in batches
+        ]
+        await self.publisher_client.publish(
+            FULL_COMPACT_IOT_EVENTS_TOPIC_NAME, messages
+        )
+
+    @traced("pub_sub.publish_domain_logs")
     async def publish_domain_logs(self, logs: list[Log]):
         messages = []
         for log in logs:
-            log_data = log.model_dump()
-            log_data["data"] = json.dumps(log_data["data"])
-            messages.append(PubsubMessage(json.dumps(log_data), type=log_data["type"]))
+            attributes = {"type": log.type.value}
+            if log.traceparent:
+                attributes[TRACEPARENT_ATTRIBUTE] = log.traceparent
+            messages.append(_create_message(log.to_json(), **attributes))
 
         await self.publisher_client.publish(FULL_DOMAIN_LOGS_TOPIC_NAME, messages)
 
+    @traced("pub_sub.publish_journey")
     async def publish_journey(
         self, journey_id: int, truck_id: int, route_geography: str
     ) -> None:
+        if self.sink:
+            self.sink.add_journey(
+                journey_id, truck_id, get_timestamp(), route_geography
+            )
         await self.publisher_client.publish(
             FULL_JOURNEYS_TOPIC_NAME,
             [
-                PubsubMessage(
-                    json.dumps(
+                _create_message(
+                    dumps(
                         {
                             "journey_id": journey_id,
                             "truck_id": truck_id,
                             "route_geography": route_geography,
                         }
-                    )
+                    ),
+                    **inject({}),
                 )
             ],
         )
 
     async def add_domain_log(self, log: Log):
-        await self._domain_logs_queue.put(log)
+        self.add_domain_log_nowait(log)
+
+    def add_domain_log_nowait(self, log: Log):
+        if self.sink:
+            self.sink.add_domain_log(log)
+        self._domain_logs_queue.put_nowait(log)
 
     async def flush_domain_logs(self):
         while True:
@@ -80,13 +149,46 @@ class PubSubClient:
             while not self._domain_logs_queue.empty():
                 logs.append(await self._domain_logs_queue.get())
 
+            # the logs of the failed publish are dropped, the loop keeps
+            # running, so the other tasks of the TTS are not cancelled
             if logs:
-                await self.publish_domain_logs(logs)
+                try:
+                    await self.publish_domain_logs(logs)
+                except Exception:
+                    logger.exception(f"Failed to publish {len(logs)} domain logs")
 
             await asyncio.sleep(3)
 
+    def start_track(self, truck_id: int, route_points: list[LocationPoint]) -> None:
+        self.telemetry_encoder.start_track(truck_id, route_points)
+
+    def add_track_point(
+        self, truck_id: int, route_index: int, location: LocationPoint, timestamp: int
+    ) -> None:
+        self.telemetry_encoder.add_point(truck_id, route_index, location, timestamp)
+        if self.sink:
+            self.sink.add_track_point(
+                truck_id, route_index, location.lat, location.lon, timestamp
+            )
+
+    def stop_track(self, truck_id: int) -> None:
+        self.telemetry_encoder.stop_track(truck_id)
+
+    async def flush_telemetry(self):
+        while True:
+            if batches := self.telemetry_encoder.drain():
+                try:
+                    await self.publish_compact_events(batches)
+                except Exception:
+                    logger.exception(f"Failed to publish {len(batches)} track batches")
+
+            await asyncio.sleep(1)
+
     async def close(self):
-        await self.publisher_client.close()
+        if self.sink:
+            await self.sink.close()
+        if self._publisher_client is not None:
+            await self._publisher_client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+import collections
+import logging
+import random
+import threading
+import time
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+T = typing.TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    """
+    Raised by the wrapped call when the attempt failed, but can be repeated
+    """
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops the calls to the upstream after ``failure_threshold`` consecutive
+    failures, after ``recovery_timeout`` seconds lets a single trial call through
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                return False
+
+            if self._trial_in_progress:
+                return False
+
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def release_trial(self) -> None:
+        """
+        Ends the trial call without the result, so the next call after
+        the recovery timeout can be a trial
+        """
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Circuit breaker opened")
+                self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the recent calls to estimate the percentiles
+    """
+
+    def __init__(self, window_size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._latencies: collections.deque[float] = collections.deque(
+            maxlen=window_size
+        )
+
+    def record(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def percentile(self, p: float) -> float | None:
+        if len(self._latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+        return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+
+class ResilientCaller:
+    """
+    Calls the function with deadline-bounded timeouts, jittered exponential
+    retries of retryable errors and a circuit breaker. When hedging is enabled
+    and the attempt takes longer than the p95 latency, a duplicate attempt is
+    started and the first successful result is used.
+
+    The called function receives the timeout in seconds for the attempt.
+    """
+
+    def __init__(
+        self,
+        *,
+        deadline: float = 10,
+        attempt_timeout: float = 4,
+        max_attempts: int = 3,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2,
+        retryable_exceptions: tuple[type[Exception], ...] = (RetryableError,),
+        circuit_breaker: CircuitBreaker | None = None,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+    ):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retryable_exceptions = retryable_exceptions
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.latency_tracker = LatencyTracker()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def call(self, fn: typing.Callable[[float], T]) -> T:
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError("Circuit breaker is open")
+
+        try:
+            return self._call(fn)
+        except BaseException:
+            # the trial ends on every exit path, otherwise the circuit never
+            # closes again, it's a no-op when the result was recorded
+            self.circuit_breaker.release_trial()
+            raise
+
+    def _call(self, fn: typing.Callable[[float], T]) -> T:
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self.circuit_breaker.record_failure()
+                raise DeadlineExceededError(
+                    f"Deadline of {self.deadline}s exceeded after {attempt} attempts"
+                )
+
+            try:
+                result = self._attempt(fn, min(self.attempt_timeout, remaining))
+            except self.retryable_exceptions as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self.circuit_breaker.record_failure()
+                    raise
+
+                backoff = random.uniform(
+                    0, min(self.backoff_max, self.backoff_base * 2**attempt)
+                )
+                logger.warning(f"Retrying call in {backoff:.2f}s after error: {e}")
+                time.sleep(min(backoff, max(deadline_at - time.monotonic(), 0)))
+                continue
+            except Exception:
+                # the upstream is reachable, the error is not a sign of an
+                # outage, e.g. a client error or a bug in the function
+                self.circuit_breaker.record_success()
+                raise
+
+            self.circuit_breaker.record_success()
+            return result
+
+    def _attempt(self, fn: typing.Callable[[float], T], timeout: float) -> T:
+        hedge_after = self.latency_tracker.percentile(self.hedge_percentile)
+        if not self.hedge or hedge_after is None or hedge_after >= timeout:
+            started_at = time.monotonic()
+            result = fn(timeout)
+            self.latency_tracker.record(time.monotonic() - started_at)
+            return result
+
+        return self._hedged_attempt(fn, timeout, hedge_after)
+
+    def _hedged_attempt(
+        self, fn: typing.Callable[[float], T], timeout: float, hedge_after: float
+    ) -> T:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(thread_name_prefix="hedged-call")
+
+        started_at = time.monotonic()
+        futures = [self._executor.submit(fn, timeout)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            logger.info(f"Hedging the call after {hedge_after:.2f}s")
+            futures.append(self._executor.submit(fn, timeout - hedge_after))
+
+        pending: set[Future[T]] = set(futures)
+        error: BaseException | None = None
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(timeout - (time.monotonic() - started_at), 0),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                break
+
+            for future in done:
+                if (error := future.exception()) is None:
+                    self.latency_tracker.record(time.monotonic() - started_at)
+                    for other in pending:
+                        other.add_done_callback(_close_result)
+                    return future.result()
+
+        if error is not None:
+            raise error
+
+        raise TimeoutError(f"Hedged call timed out after {timeout:.2f}s")
+
+
+def _close_result(future: Future) -> None:
+    """
+    Releases the resources of the result of the hedged call that lost the race
+    """
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
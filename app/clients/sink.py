@@ -0,0 +1,234 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+import typing
+
+from app.clients.columnar import (
+    FILE_EXTENSION,
+    FLOAT64,
+    INT64,
+    STRING,
+    ColumnarWriter,
+    Schema,
+)
+from app.serialization import dumps
+from app.simulation.log import Log
+
+logger = logging.getLogger(__name__)
+
+TRACK_EVENTS_TABLE = "track_events"
+DOMAIN_LOGS_TABLE = "domain_logs"
+JOURNEYS_TABLE = "journeys"
+
+SCHEMAS: dict[str, Schema] = {
+    TRACK_EVENTS_TABLE: [
+        ("truck_id", INT64),
+        ("route_index", INT64),
+        ("lat", FLOAT64),
+        ("lon", FLOAT64),
+        ("timestamp", INT64),
+    ],
+    DOMAIN_LOGS_TABLE: [
+        ("type", STRING),
+        ("timestamp", INT64),
+        ("traceparent", STRING),
+        ("data", STRING),
+    ],
+    JOURNEYS_TABLE: [
+        ("journey_id", INT64),
+        ("truck_id", INT64),
+        ("timestamp", INT64),
+        ("route_geography", STRING),
+    ],
+}
+
+ROW_GROUP_SIZE = 50_000
+# rows over the limit are dropped while the writes are failing
+MAX_BUFFERED_ROWS = 10 * ROW_GROUP_SIZE
+MAX_FILE_SIZE_IN_BYTES = 64 * 1024 * 1024
+MAX_FILE_AGE_IN_SECONDS = 300
+FLUSH_INTERVAL_IN_SECONDS = 5
+
+
+class _Table:
+    def __init__(self, name: str, schema: Schema):
+        self.name = name
+        self.schema = schema
+        self.columns: dict[str, list[typing.Any]] = {name: [] for name, _ in schema}
+        self.rows_number = 0
+        self.dropped_rows_number = 0
+        self.writer: ColumnarWriter | None = None
+        self.writer_opened_at = 0.0
+        self.writer_date: datetime.date | None = None
+
+    def append(self, row: tuple[typing.Any, ...]) -> None:
+        for values, value in zip(self.columns.values(), row):
+            values.append(value)
+        self.rows_number += 1
+
+    def take_row_group(self) -> dict[str, list[typing.Any]]:
+        columns = self.columns
+        self.columns = {name: [] for name, _ in self.schema}
+        self.rows_number = 0
+        return columns
+
+
+class ColumnarSink:
+    """
+    Writes the track events, domain logs and journeys into the Parquet files
+    partitioned by the table and the date:
+
+        {directory}/{table}/date=YYYY-MM-DD/part-{timestamp}-{sequence}.parquet
+
+    Rows are buffered in memory column by column and written as a row group
+    when the buffer is full or on the flush interval. Encoding and writing
+    happen in the worker thread, one row group at a time. Files are rolled by
+    the size, the age and the date, an open file has the ".tmp" suffix until
+    its footer is written.
+
+    A failed write drops its row group and the open file, the next row group
+    is written to a new file. Every table buffers at most max_buffered_rows
+    rows, the newer rows are dropped until the buffer is written
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        row_group_size: int = ROW_GROUP_SIZE,
+        max_file_size: int = MAX_FILE_SIZE_IN_BYTES,
+        max_file_age: float = MAX_FILE_AGE_IN_SECONDS,
+        flush_interval: float = FLUSH_INTERVAL_IN_SECONDS,
+        max_buffered_rows: int = MAX_BUFFERED_ROWS,
+    ):
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.max_file_size = max_file_size
+        self.max_file_age = max_file_age
+        self.flush_interval = flush_interval
+        self.max_buffered_rows = max_buffered_rows
+        self._tables = {name: _Table(name, schema) for name, schema in SCHEMAS.items()}
+        self._is_full = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._files_number = 0
+
+    def add_track_point(
+        self, truck_id: int, route_index: int, lat: float, lon: float, timestamp: int
+    ) -> None:
+        self._append(TRACK_EVENTS_TABLE, (truck_id, route_index, lat, lon, timestamp))
+
+    def add_domain_log(self, log: Log) -> None:
+        self._append(
+            DOMAIN_LOGS_TABLE,
+            (log.type.value, log.timestamp, log.traceparent, dumps(log.data)),
+        )
+
+    def add_journey(
+        self, journey_id: int, truck_id: int, timestamp: int, route_geography: str
+    ) -> None:
+        self._append(JOURNEYS_TABLE, (journey_id, truck_id, timestamp, route_geography))
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._is_full.wait(), timeout=self.flush_interval
+                )
+                self._is_full.clear()
+                only_full = True
+            except asyncio.TimeoutError:
+                only_full = False
+
+            try:
+                await self.flush(only_full=only_full)
+            except Exception:
+                logger.exception("Failed to flush the columnar sink")
+
+    async def flush(self, only_full: bool = False) -> None:
+        async with self._write_lock:
+            for table in self._tables.values():
+                if table.dropped_rows_number:
+                    logger.warning(
+                        f"Dropped {table.dropped_rows_number} rows of {table.name}, "
+                        f"the buffer is full"
+                    )
+                    table.dropped_rows_number = 0
+
+                try:
+                    if table.rows_number and (
+                        not only_full or table.rows_number >= self.row_group_size
+                    ):
+                        row_group = table.take_row_group()
+                        await asyncio.to_thread(self._write_row_group, table, row_group)
+                    elif not only_full and table.writer:
+                        await asyncio.to_thread(self._roll_if_needed, table)
+                except Exception:
+                    logger.exception(f"Failed to write {table.name}")
+                    await asyncio.to_thread(self._discard_writer, table)
+
+    async def close(self) -> None:
+        await self.flush()
+        async with self._write_lock:
+            for table in self._tables.values():
+                if table.writer:
+                    await asyncio.to_thread(self._close_writer, table)
+
+    def _append(self, name: str, row: tuple[typing.Any, ...]) -> None:
+        table = self._tables[name]
+        if table.rows_number >= self.max_buffered_rows:
+            table.dropped_rows_number += 1
+            return
+        table.append(row)
+        if table.rows_number >= self.row_group_size:
+            self._is_full.set()
+
+    def _write_row_group(
+        self, table: _Table, row_group: dict[str, list[typing.Any]]
+    ) -> None:
+        self._roll_if_needed(table)
+        if not table.writer:
+            self._open_writer(table)
+        typing.cast(ColumnarWriter, table.writer).write_row_group(row_group)
+        self._roll_if_needed(table)
+
+    def _roll_if_needed(self, table: _Table) -> None:
+        if table.writer and (
+            table.writer.size >= self.max_file_size
+            or time.monotonic() - table.writer_opened_at >= self.max_file_age
+            or table.writer_date != datetime.date.today()
+        ):
+            self._close_writer(table)
+
+    def _open_writer(self, table: _Table) -> None:
+        today = datetime.date.today()
+        partition = os.path.join(self.directory, table.name, f"date={today}")
+        os.makedirs(partition, exist_ok=True)
+        self._files_number += 1
+        path = os.path.join(
+            partition,
+            f"part-{time.time_ns()}-{self._files_number:05d}{FILE_EXTENSION}.tmp",
+        )
+        table.writer = ColumnarWriter(path, table.schema)
+        table.writer_opened_at = time.monotonic()
+        table.writer_date = today
+
+    def _close_writer(self, table: _Table) -> None:
+        writer = typing.cast(ColumnarWriter, table.writer)
+        writer.close()
+        os.rename(writer.path, writer.path.removesuffix(".tmp"))
+        table.writer = None
+        logger.info(f"Wrote {writer.rows_number} rows of {table.name}")
+
+    def _discard_writer(self, table: _Table) -> None:
+        """
+        Leaves the file with the failed write with the ".tmp" suffix, the file
+        is not read by the report
+        """
+        if not table.writer:
+            return
+        try:
+            table.writer.close()
+        except Exception:
+            logger.exception(f"Failed to close {table.writer.path}")
+        table.writer = None
@@ -0,0 +1,231 @@
+"""
+Compact encoding of the trucks telemetry.
+
+Points of a truck are batched and encoded as varints: the first point of the
+batch is absolute, the rest are zigzag deltas from the previous point.
+Coordinates are stored as integers with 1e-5 degree precision (~1 m).
+
+A point is emitted only when the truck deviates from the position predicted
+by dead reckoning along the route by more than the threshold, or when the
+heartbeat is due. The prediction needs only the route and the emitted points,
+so the consumers can reconstruct the positions between the emitted points
+with ``predict_location``.
+"""
+import dataclasses
+import math
+
+from app.clients.maps import LocationPoint, get_distance_in_meters
+
+ENCODING_NAME = "delta-varint-v1"
+
+COORDINATE_SCALE = 100_000
+
+DEVIATION_THRESHOLD_IN_METERS = 50
+HEARTBEAT_INTERVAL_IN_MS = 30_000
+
+
+@dataclasses.dataclass(slots=True)
+class TrackPoint:
+    route_index: int
+    lat: float
+    lon: float
+    timestamp: int
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _zigzag_encode(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _zigzag_decode(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def encode_track_batch(truck_id: int, points: list[TrackPoint]) -> bytes:
+    buffer = bytearray()
+    _write_varint(buffer, truck_id)
+    _write_varint(buffer, len(points))
+
+    previous = (0, 0, 0, 0)
+    for point in points:
+        current = (
+            point.route_index,
+            round(point.lat * COORDINATE_SCALE),
+            round(point.lon * COORDINATE_SCALE),
+            point.timestamp,
+        )
+        for value, previous_value in zip(current, previous):
+            _write_varint(buffer, _zigzag_encode(value - previous_value))
+        previous = current
+
+    return bytes(buffer)
+
+
+def decode_track_batch(data: bytes) -> tuple[int, list[TrackPoint]]:
+    truck_id, position = _read_varint(data, 0)
+    points_number, position = _read_varint(data, position)
+
+    points = []
+    route_index = lat = lon = timestamp = 0
+    for _ in range(points_number):
+        deltas = []
+        for _ in range(4):
+            value, position = _read_varint(data, position)
+            deltas.append(_zigzag_decode(value))
+        route_index += deltas[0]
+        lat += deltas[1]
+        lon += deltas[2]
+        timestamp += deltas[3]
+        points.append(
+            TrackPoint(
+                route_index=route_index,
+                lat=lat / COORDINATE_SCALE,
+                lon=lon / COORDINATE_SCALE,
+                timestamp=timestamp,
+            )
+        )
+
+    return truck_id, points
+
+
+def predict_location(
+    route_points: list[LocationPoint],
+    previous: TrackPoint | None,
+    last: TrackPoint,
+    timestamp: int,
+) -> LocationPoint:
+    """
+    Predicts the location on the route at ``timestamp``, assuming that the
+    truck moves along the route with the speed between the last two points
+    """
+    if previous is None or last.timestamp <= previous.timestamp:
+        route_index = float(last.route_index)
+    else:
+        speed = (last.route_index - previous.route_index) / (
+            last.timestamp - previous.timestamp
+        )
+        route_index = last.route_index + speed * (timestamp - last.timestamp)
+
+    route_index = min(max(route_index, 0), len(route_points) - 1)
+    i = math.floor(route_index)
+    if i == len(route_points) - 1:
+        return route_points[i]
+
+    fraction = route_index - i
+    p1, p2 = route_points[i], route_points[i + 1]
+    return LocationPoint(
+        lat=p1.lat + (p2.lat - p1.lat) * fraction,
+        lon=p1.lon + (p2.lon - p1.lon) * fraction,
+    )
+
+
+@dataclasses.dataclass(slots=True)
+class _Track:
+    route_points: list[LocationPoint]
+    previous: TrackPoint | None = None
+    last: TrackPoint | None = None
+    last_observed: TrackPoint | None = None
+    pending: list[TrackPoint] = dataclasses.field(default_factory=list)
+    is_stopped: bool = False
+
+
+class TelemetryEncoder:
+    def __init__(
+        self,
+        deviation_threshold_in_meters: float = DEVIATION_THRESHOLD_IN_METERS,
+        heartbeat_interval_in_ms: int = HEARTBEAT_INTERVAL_IN_MS,
+    ):
+        self.deviation_threshold_in_meters = deviation_threshold_in_meters
+        self.heartbeat_interval_in_ms = heartbeat_interval_in_ms
+        self.observed_points_number = 0
+        self.emitted_points_number = 0
+        self._tracks: dict[int, _Track] = {}
+
+    def start_track(self, truck_id: int, route_points: list[LocationPoint]) -> None:
+        pending = track.pending if (track := self._tracks.get(truck_id)) else []
+        self._tracks[truck_id] = _Track(route_points=route_points, pending=pending)
+
+    def stop_track(self, truck_id: int) -> None:
+        """
+        Emits the last observed point, so the consumers know where the track ended
+        """
+        if not (track := self._tracks.get(truck_id)):
+            return
+
+        if track.last_observed and track.last_observed is not track.last:
+            self._emit(track, track.last_observed)
+        track.is_stopped = True
+
+    def add_point(
+        self, truck_id: int, route_index: int, location: LocationPoint, timestamp: int
+    ) -> bool:
+        """
+        Returns whether the point was emitted
+        """
+        if not (track := self._tracks.get(truck_id)) or track.is_stopped:
+            return False
+
+        point = TrackPoint(
+            route_index=route_index,
+            lat=location.lat,
+            lon=location.lon,
+            timestamp=timestamp,
+        )
+        track.last_observed = point
+        self.observed_points_number += 1
+
+        if track.last is None or self._should_emit(track, track.last, point):
+            self._emit(track, point)
+            return True
+
+        return False
+
+    def drain(self) -> list[tuple[int, bytes]]:
+        """
+        Returns the encoded batches of the emitted points per truck
+        """
+        batches = []
+        for truck_id, track in list(self._tracks.items()):
+            if track.pending:
+                batches.append((truck_id, encode_track_batch(truck_id, track.pending)))
+                track.pending = []
+            if track.is_stopped:
+                del self._tracks[truck_id]
+        return batches
+
+    def _should_emit(self, track: _Track, last: TrackPoint, point: TrackPoint) -> bool:
+        if point.timestamp - last.timestamp >= self.heartbeat_interval_in_ms:
+            return True
+
+        predicted = predict_location(
+            track.route_points, track.previous, last, point.timestamp
+        )
+        return (
+            get_distance_in_meters(
+                predicted, LocationPoint(lat=point.lat, lon=point.lon)
+            )
+            > self.deviation_threshold_in_meters
+        )
+
+    def _emit(self, track: _Track, point: TrackPoint) -> None:
+        track.previous, track.last = track.last, point
+        track.pending.append(point)
+        self.emitted_points_number += 1
@@ -1,3 +1,4 @@
+import functools
 import os
 import typing
 
@@ -13,5 +14,42 @@ def get_or_raise_exception(name: str) -> str:
         raise Exception(f"Unable to get env var {name}")
 
 
-MAPS_API_TOKEN: typing.Final[str] = get_or_raise_exception("MAPS_API_TOKEN")
-TELEGRAM_API_TOKEN: typing.Final[str] = get_or_raise_exception("TELEGRAM_API_TOKEN")
+# required settings are read on the first use, so a service doesn't fail at
+# import for the settings of the other service
+@functools.cache
+def get_maps_api_token() -> str:
+    return get_or_raise_exception("MAPS_API_TOKEN")
+
+
+@functools.cache
+def get_telegram_api_token() -> str:
+    return get_or_raise_exception("TELEGRAM_API_TOKEN")
+
+
+ADMIN_API_TOKEN: typing.Final[str | None] = os.getenv("ADMIN_API_TOKEN")
+TELEGRAM_WEBHOOK_URL: typing.Final[str | None] = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET: typing.Final[str | None] = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+# "sqlite" keeps the subscriptions in SUBSCRIPTIONS_DB_FILE for the local runs,
+# "datastore" in Firestore in Datastore mode, the local file system of the
+# Cloud Run instance is lost on the cold start
+SUBSCRIPTIONS_STORAGE: typing.Final[str] = os.getenv("SUBSCRIPTIONS_STORAGE", "sqlite")
+SUBSCRIPTIONS_DB_FILE: typing.Final[str] = os.getenv(
+    "SUBSCRIPTIONS_DB_FILE", "subscriptions.sqlite3"
+)
+TTS_WORKERS_NUMBER: typing.Final[int] = int(os.getenv("TTS_WORKERS_NUMBER", "4"))
+EVENTS_QUEUE_MAX_SIZE: typing.Final[int] = int(
+    os.getenv("EVENTS_QUEUE_MAX_SIZE", "1000")
+)
+DELIVERY_REQUEST_DEADLINE_IN_SECONDS: typing.Final[float] = float(
+    os.getenv("DELIVERY_REQUEST_DEADLINE_IN_SECONDS", "60")
+)
+BACKLOG_TTL_IN_SECONDS: typing.Final[float] = float(
+    os.getenv("BACKLOG_TTL_IN_SECONDS", "60")
+)
+JOURNEY_MAX_DELIVERIES: typing.Final[int] = int(
+    os.getenv("JOURNEY_MAX_DELIVERIES", "4")
+)
+FLEET_MANIFEST_PATH: typing.Final[str | None] = os.getenv("FLEET_MANIFEST_PATH")
+TRACES_FILE: typing.Final[str | None] = os.getenv("TRACES_FILE")
+GEOFENCES_FILE: typing.Final[str | None] = os.getenv("GEOFENCES_FILE")
+LOCAL_SINK_DIR: typing.Final[str | None] = os.getenv("LOCAL_SINK_DIR")
@@ -0,0 +1,73 @@
+import asyncio
+import collections
+import logging
+import typing
+
+from app.simulation.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopMonitor:
+    """
+    Continuously measures the lag of the event loop by the drift of the
+    sentinel callback scheduled with call_later: a callback that blocks the
+    loop delays the sentinel by the time it runs. The lags longer than
+    ``stall_duration`` seconds are reported as the stalls of the loop
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.25,
+        stall_duration: float = 0.1,
+        history_size: int = 1000,
+    ):
+        self.interval = interval
+        self.stall_duration = stall_duration
+        self._lags: collections.deque[float] = collections.deque(maxlen=history_size)
+        self._max_lag = 0.0
+        self._stalls: collections.deque[dict[str, typing.Any]] = collections.deque(
+            maxlen=100
+        )
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._handle: asyncio.TimerHandle | None = None
+        self._expected_at = 0.0
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._schedule_sentinel()
+
+    def stop(self) -> None:
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def get_info(self) -> dict[str, typing.Any]:
+        lags = sorted(self._lags)
+
+        def percentile(p: float) -> float | None:
+            if not lags:
+                return None
+            return round(lags[min(int(p * len(lags)), len(lags) - 1)], 4)
+
+        return {
+            "lag_p50": percentile(0.5),
+            "lag_p99": percentile(0.99),
+            "lag_max": round(self._max_lag, 4),
+            "stalls": list(self._stalls),
+        }
+
+    def _schedule_sentinel(self) -> None:
+        loop = typing.cast(asyncio.AbstractEventLoop, self._loop)
+        self._expected_at = loop.time() + self.interval
+        self._handle = loop.call_at(self._expected_at, self._on_sentinel)
+
+    def _on_sentinel(self) -> None:
+        loop = typing.cast(asyncio.AbstractEventLoop, self._loop)
+        lag = max(loop.time() - self._expected_at, 0)
+        self._lags.append(lag)
+        self._max_lag = max(self._max_lag, lag)
+        if lag >= self.stall_duration:
+            logger.warning(f"Event loop lag is {lag:.3f}s")
+            self._stalls.append({"lag": round(lag, 4), "timestamp": get_timestamp()})
+        self._schedule_sentinel()
@@ -0,0 +1,63 @@
+import asyncio
+import collections
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+
+
+async def run_cprofile(
+    duration: float, sort_by: str = "cumulative", limit: int = 50
+) -> str:
+    """
+    Profiles everything that is executed by the event loop during ``duration``
+    seconds, returns the pstats report
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        profiler.disable()
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(sort_by).print_stats(limit)
+    return output.getvalue()
+
+
+async def run_sampling_profile(
+    duration: float, interval: float = 0.005, limit: int = 50
+) -> str:
+    """
+    Samples the stack of the event loop thread from a separate thread every
+    ``interval`` seconds, returns the most frequent stacks in collapsed format
+    (compatible with flamegraph tools)
+    """
+    loop_thread_id = threading.get_ident()
+
+    def sample() -> collections.Counter[str]:
+        stacks: collections.Counter[str] = collections.Counter()
+        finish_at = time.monotonic() + duration
+        while time.monotonic() < finish_at:
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return stacks
+
+    stacks = await asyncio.to_thread(sample)
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common(limit))
+
+
+def dump_tasks_stacks() -> str:
+    output = io.StringIO()
+    for task in asyncio.all_tasks():
+        task.print_stack(file=output)
+        output.write("\n")
+    return output.getvalue()
@@ -0,0 +1,67 @@
+import asyncio
+import enum
+import hmac
+import typing
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+
+from app.config import ADMIN_API_TOKEN
+from app.diagnostics.loop_monitor import EventLoopMonitor
+from app.diagnostics.profiling import (
+    dump_tasks_stacks,
+    run_cprofile,
+    run_sampling_profile,
+)
+
+_profiling_lock = asyncio.Lock()
+
+
+class ProfileMode(enum.StrEnum):
+    CPROFILE = enum.auto()
+    SAMPLING = enum.auto()
+
+
+def verify_admin_token(x_admin_token: str | None = Header(default=None)) -> None:
+    """
+    The endpoints are closed when the admin token is not configured
+    """
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(
+    prefix="/admin", tags=["admin"], dependencies=[Depends(verify_admin_token)]
+)
+
+
+def get_event_loop_monitor(request: Request) -> EventLoopMonitor:
+    return request.app.state.event_loop_monitor
+
+
+@router.get("/event-loop")
+async def event_loop_info(
+    monitor: EventLoopMonitor = Depends(get_event_loop_monitor),
+) -> dict[str, typing.Any]:
+    return monitor.get_info()
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile(
+    duration: float = Query(default=5, gt=0, le=60),
+    mode: ProfileMode = ProfileMode.CPROFILE,
+) -> str:
+    if _profiling_lock.locked():
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+
+    async with _profiling_lock:
+        if mode == ProfileMode.SAMPLING:
+            return await run_sampling_profile(duration)
+        return await run_cprofile(duration)
+
+
+@router.get("/tasks", response_class=PlainTextResponse)
+async def tasks() -> str:
+    return dump_tasks_stacks()
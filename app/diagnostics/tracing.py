@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import inspect
+import json
+import secrets
+import threading
+import time
+import typing
+
+# W3C trace context header, also used as the Pub/Sub message attribute
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_ATTRIBUTE = "traceparent"
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SpanContext:
+    trace_id: str
+    span_id: str
+
+    def to_traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def from_traceparent(cls, traceparent: str | None) -> SpanContext | None:
+        if not traceparent:
+            return None
+
+        parts = traceparent.split("-")
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+
+        return cls(trace_id=parts[1], span_id=parts[2])
+
+
+@dataclasses.dataclass(slots=True)
+class Span:
+    name: str
+    context: SpanContext
+    parent_span_id: str | None
+    start_time_ns: int
+    end_time_ns: int | None = None
+    attributes: dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float | None:
+        if self.end_time_ns is None:
+            return None
+        return (self.end_time_ns - self.start_time_ns) / 1_000_000
+
+    def set_attribute(self, key: str, value: typing.Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_ns": self.start_time_ns,
+            "end_time_ns": self.end_time_ns,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter(typing.Protocol):
+    def export(self, span: Span) -> None:
+        ...
+
+
+class InMemorySpanExporter:
+    """
+    Keeps the finished spans in memory, used to collect the stage latencies
+    in tests and benchmarks
+    """
+
+    def __init__(self, max_spans: int = 100_000):
+        self.spans: collections.deque[Span] = collections.deque(maxlen=max_spans)
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def get_spans(self, trace_id: str | None = None) -> list[Span]:
+        return [s for s in self.spans if not trace_id or s.context.trace_id == trace_id]
+
+    def get_latencies_by_stage(self) -> dict[str, list[float]]:
+        latencies: dict[str, list[float]] = collections.defaultdict(list)
+        for span in self.spans:
+            if span.duration_ms is not None:
+                latencies[span.name].append(span.duration_ms)
+        return dict(latencies)
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+
+class FileSpanExporter:
+    """
+    Appends the finished spans to the file as JSON lines
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Tracer:
+    def __init__(self, exporters: list[SpanExporter] | None = None):
+        self.exporters: list[SpanExporter] = exporters or []
+
+    def add_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters.append(exporter)
+
+    @contextlib.contextmanager
+    def start_span(
+        self,
+        name: str,
+        *,
+        parent: SpanContext | None = None,
+        attributes: dict[str, typing.Any] | None = None,
+    ) -> typing.Iterator[Span]:
+        """
+        Starts the span as a child of ``parent`` or of the current span,
+        the span becomes the current one until the block is exited
+        """
+        span = self._create_span(name, parent, time.time_ns(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_attribute("error", repr(e))
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish_span(span, time.time_ns())
+
+    def record_span(
+        self,
+        name: str,
+        *,
+        start_time_ns: int,
+        end_time_ns: int,
+        parent: SpanContext | None = None,
+        attributes: dict[str, typing.Any] | None = None,
+    ) -> Span:
+        """
+        Records the span for the stage that was already finished,
+        e.g. the time that the event spent in a queue
+        """
+        span = self._create_span(name, parent, start_time_ns, attributes)
+        self._finish_span(span, end_time_ns)
+        return span
+
+    def _create_span(
+        self,
+        name: str,
+        parent: SpanContext | None,
+        start_time_ns: int,
+        attributes: dict[str, typing.Any] | None,
+    ) -> Span:
+        if parent is None and (current_span := _current_span.get()):
+            parent = current_span.context
+
+        return Span(
+            name=name,
+            context=SpanContext(
+                trace_id=parent.trace_id if parent else secrets.token_hex(16),
+                span_id=secrets.token_hex(8),
+            ),
+            parent_span_id=parent.span_id if parent else None,
+            start_time_ns=start_time_ns,
+            attributes=attributes or {},
+        )
+
+    def _finish_span(self, span: Span, end_time_ns: int) -> None:
+        span.end_time_ns = end_time_ns
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+tracer = Tracer()
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+def traced(name: str) -> typing.Callable[[F], F]:
+    """
+    Wraps every call of the function (or coroutine function) into the span
+    """
+
+    def decorator(fn: F) -> F:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.start_span(name):
+                    return await fn(*args, **kwargs)
+
+            return typing.cast(F, async_wrapper)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.start_span(name):
+                return fn(*args, **kwargs)
+
+        return typing.cast(F, wrapper)
+
+    return decorator
+
+
+def get_current_span() -> Span | None:
+    return _current_span.get()
+
+
+def get_current_traceparent() -> str | None:
+    if span := _current_span.get():
+        return span.context.to_traceparent()
+    return None
+
+
+def inject(attributes: dict[str, str]) -> dict[str, str]:
+    """
+    Adds the context of the current span to the message attributes
+    """
+    if traceparent := get_current_traceparent():
+        attributes[TRACEPARENT_ATTRIBUTE] = traceparent
+    return attributes
+
+
+def extract(attributes: typing.Mapping[str, typing.Any]) -> SpanContext | None:
+    return SpanContext.from_traceparent(attributes.get(TRACEPARENT_ATTRIBUTE))
@@ -0,0 +1,85 @@
+"""
+Checks the import time of the server entry points by ``python -X importtime``.
+Fails when the cumulative import time of an entry point is over the budget or
+when it imports at the module level the packages that are imported on the
+first use. The entry points are imported without the API tokens, so importing
+them must not require the settings
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# packages that must not be imported with the entry point
+LAZY_PACKAGES = ["telebot", "gcloud", "aiohttp", "polyline", "requests", "pyarrow"]
+
+ENTRY_POINTS = ["app.run_tts_server", "app.run_notifications_server"]
+
+# just above the measured ~750 ms, the import before the lazy imports took
+# ~1.4 s, so the regressions fail the check
+IMPORT_TIME_BUDGET_IN_MS = 1000
+
+# the best of the runs is compared, so the first run warms up the bytecode
+# cache and the noise of the machine doesn't fail the check
+RUNS_NUMBER = 5
+
+
+def measure_import(module: str) -> tuple[float, set[str]]:
+    """
+    Returns the cumulative import time of the module in ms and the top level
+    packages it imports
+    """
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("MAPS_API_TOKEN", "TELEGRAM_API_TOKEN")
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise Exception(f"Unable to import {module}:\n{result.stderr}")
+
+    import_time = None
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("| imported package"):
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        packages.add(name.strip().split(".")[0])
+        if name.strip() == module:
+            import_time = int(cumulative) / 1000
+
+    if import_time is None:
+        raise Exception(f"Import time of {module} is not found")
+    return import_time, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget-ms", type=float, default=IMPORT_TIME_BUDGET_IN_MS, help="Budget"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for module in ENTRY_POINTS:
+        measurements = [measure_import(module) for _ in range(RUNS_NUMBER)]
+        import_time = min(t for t, _ in measurements)
+        lazy_packages = sorted(set(LAZY_PACKAGES) & measurements[0][1])
+        print(f"{module}: {import_time:.0f} ms (budget {args.budget_ms:.0f} ms)")
+        if import_time > args.budget_ms:
+            print(f"  over the budget by {import_time - args.budget_ms:.0f} ms")
+            failed = True
+        if lazy_packages:
+            print(f"  imports the lazy packages: {', '.join(lazy_packages)}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,32 @@
 import asyncio
 import base64
-import json
+import binascii
+import hmac
 import logging
 from functools import partial
-from threading import Thread
 
 import uvicorn
-from fastapi import Depends, FastAPI, Request
+from fastapi import FastAPI, Header, HTTPException, Request
+from pydantic import ValidationError
 
-from app.telegram_bot_server.schemas import Notification
-from app.telegram_bot_server.server import send_telegram_messages, serve_telegram_bot
+from app.config import TELEGRAM_WEBHOOK_URL, TRACES_FILE
+from app.diagnostics.loop_monitor import EventLoopMonitor
+from app.diagnostics.router import router as diagnostics_router
+from app.diagnostics.tracing import FileSpanExporter, extract, tracer
+from app.serialization import loads
+from app.telegram_bot_server.schemas import Notification, PushRequest
+from app.telegram_bot_server.server import (
+    SECRET_TOKEN_HEADER,
+    WEBHOOK_PATH,
+    NotificationNotSentError,
+    close_telegram_bot,
+    get_subscription_store,
+    get_webhook_secret,
+    process_telegram_update,
+    send_telegram_messages,
+    serve_telegram_bot,
+    set_telegram_webhook,
+)
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(message)s",
@@ -19,40 +36,79 @@ logging.basicConfig(
 
 
 app = FastAPI()
+app.include_router(diagnostics_router)
 
 
 async def application_setup_signal(app_instance: FastAPI):
-    events_queue: asyncio.Queue[Notification] = asyncio.Queue()
-    app_instance.state.events_queue = events_queue
-    asyncio.create_task(send_telegram_messages(events_queue))
-    telegram_bot_thread = Thread(target=serve_telegram_bot)
-    telegram_bot_thread.start()
+    if TRACES_FILE:
+        tracer.add_exporter(FileSpanExporter(TRACES_FILE))
+    event_loop_monitor = EventLoopMonitor()
+    event_loop_monitor.start()
+    app_instance.state.event_loop_monitor = event_loop_monitor
+    await get_subscription_store().load()
+    # updates are pushed by Telegram to the webhook, polling is the fallback
+    # when the server is not reachable from outside
+    if TELEGRAM_WEBHOOK_URL:
+        await set_telegram_webhook(TELEGRAM_WEBHOOK_URL)
+    else:
+        asyncio.create_task(serve_telegram_bot())
+
+
+async def application_shutdown_signal(app_instance: FastAPI):
+    app_instance.state.event_loop_monitor.stop()
+    await close_telegram_bot()
 
 
 app.add_event_handler(
     "startup",
     partial(application_setup_signal, app_instance=app),
 )
+app.add_event_handler(
+    "shutdown",
+    partial(application_shutdown_signal, app_instance=app),
+)
+
 
+@app.post("/notifications")
+async def notifications(request: Request) -> str:
+    # the request comes from outside, so it is validated before it becomes
+    # the internal notification
+    try:
+        message = PushRequest.model_validate_json(await request.body()).message
+        event_type = message.attributes["type"]
+        additional_data = loads(base64.b64decode(message.data))
+    except (ValidationError, KeyError, binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid push request: {e}")
 
-def get_events_queue(request: Request) -> asyncio.Queue[Notification]:
-    return request.app.state.events_queue
+    with tracer.start_span(
+        "notifications_server.notifications", parent=extract(message.attributes)
+    ) as span:
+        notification = Notification(
+            event_type=event_type,
+            additional_data=additional_data,
+            traceparent=span.context.to_traceparent(),
+        )
+        # the push is acked by the response, so the messages are sent before
+        # it, while the instance has the CPU, and the error response makes
+        # Pub/Sub redeliver the notification
+        try:
+            await send_telegram_messages(notification)
+        except NotificationNotSentError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    return "Success"
 
 
-@app.post("/notifications")
-async def notifications(
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(
     request: Request,
-    events_queue: asyncio.Queue[Notification] = Depends(get_events_queue),
+    secret_token: str = Header(default="", alias=SECRET_TOKEN_HEADER),
 ) -> str:
-    data = json.loads(await request.body())
-    await events_queue.put(
-        Notification(
-            event_type=data["message"]["attributes"]["type"],
-            additional_data=json.loads(
-                base64.b64decode(data["message"]["data"]).decode("utf-8")
-            ),
-        )
-    )
+    if not hmac.compare_digest(secret_token, get_webhook_secret()):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    # the update is handled before the response, so the instance keeps the
+    # CPU while the handlers run
+    await process_telegram_update(await request.json())
     return "Success"
 
 
@@ -0,0 +1,136 @@
+"""
+Compares the per-message CPU time and allocations of the pydantic based
+serialization with the fast path used by PubSubClient and /notifications
+"""
+import base64
+import json
+import timeit
+import tracemalloc
+import typing
+
+from pydantic import BaseModel
+
+from app.clients.maps import LocationPoint
+from app.clients.pub_sub import JourneyTrackEvent
+from app.serialization import dumps, loads
+from app.simulation.log import Log, LogType
+from app.telegram_bot_server.schemas import Notification
+
+MESSAGES_NUMBER = 10_000
+
+
+class PydanticLocationPoint(BaseModel):
+    lat: float
+    lon: float
+
+
+class PydanticLog(BaseModel):
+    type: LogType
+    data: dict[str, typing.Any]
+    timestamp: int
+
+
+class PydanticJourneyTrackEvent(BaseModel):
+    truck_id: int
+    lat: float
+    lon: float
+    timestamp: int
+    color: str
+
+
+class PydanticNotification(BaseModel):
+    event_type: str
+    additional_data: dict[str, typing.Any]
+
+
+LOG_DATA = {
+    "journey_id": 1,
+    "truck_id": 2,
+    "origin_address": "Vilnius, Lithuania",
+    "destination_address": "Klaipeda, Lithuania",
+    "expected_duration_in_seconds": 11_000,
+}
+
+PUSH_DATA = base64.b64encode(json.dumps(LOG_DATA).encode()).decode()
+
+
+def pydantic_domain_log() -> str:
+    log_data = PydanticLog(
+        type=LogType.JOURNEY_DISPATCHED, data=LOG_DATA, timestamp=1
+    ).model_dump()
+    log_data["data"] = json.dumps(log_data["data"])
+    return json.dumps(log_data)
+
+
+def fast_domain_log() -> str:
+    return Log(type=LogType.JOURNEY_DISPATCHED, data=LOG_DATA, timestamp=1).to_json()
+
+
+def pydantic_track_event() -> str:
+    location = PydanticLocationPoint(lat=54.6872, lon=25.2797)
+    event = PydanticJourneyTrackEvent(
+        truck_id=1, lat=location.lat, lon=location.lon, timestamp=1, color="#FF0000"
+    )
+    return json.dumps(event.model_dump())
+
+
+def fast_track_event() -> str:
+    location = LocationPoint(lat=54.6872, lon=25.2797)
+    event = JourneyTrackEvent(
+        truck_id=1, lat=location.lat, lon=location.lon, timestamp=1, color="#FF0000"
+    )
+    return dumps(event)
+
+
+def pydantic_notification() -> PydanticNotification:
+    return PydanticNotification(
+        event_type="truck_not_found",
+        additional_data=json.loads(base64.b64decode(PUSH_DATA).decode("utf-8")),
+    )
+
+
+def fast_notification() -> Notification:
+    return Notification(
+        event_type="truck_not_found",
+        additional_data=loads(base64.b64decode(PUSH_DATA)),
+    )
+
+
+def measure(fn: typing.Callable[[], typing.Any]) -> tuple[float, float]:
+    """
+    Returns the time in microseconds and the retained allocated bytes per message
+    """
+    seconds = min(timeit.repeat(fn, number=MESSAGES_NUMBER, repeat=5))
+
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    results = [fn() for _ in range(MESSAGES_NUMBER)]
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(
+        stat.size_diff
+        for stat in snapshot_after.compare_to(snapshot_before, "filename")
+        if stat.size_diff > 0
+    )
+    del results
+
+    return seconds / MESSAGES_NUMBER * 1_000_000, retained / MESSAGES_NUMBER
+
+
+def main():
+    for name, slow, fast in [
+        ("domain log", pydantic_domain_log, fast_domain_log),
+        ("track event", pydantic_track_event, fast_track_event),
+        ("notification", pydantic_notification, fast_notification),
+    ]:
+        slow_time, slow_allocated = measure(slow)
+        fast_time, fast_allocated = measure(fast)
+        print(
+            f"{name}: pydantic {slow_time:.2f}us {slow_allocated:.0f}B, "
+            f"fast path {fast_time:.2f}us {fast_allocated:.0f}B, "
+            f"{slow_time / fast_time:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
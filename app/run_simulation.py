@@ -2,7 +2,8 @@ import asyncio
 
 from app.clients.maps import LocationPoint, MapsClient
 from app.clients.pub_sub import PubSubClient
-from app.simulation.event import DeliveryRequestEvent, Event
+from app.simulation.event import DeliveryRequestEvent
+from app.simulation.events_queue import EventsQueue
 from app.simulation.journey import Journey
 from app.simulation.route import Route
 from app.simulation.server import serve_tts
@@ -77,7 +78,7 @@ async def simulation():
     await pub_sub_client.close()
 
 
-async def populate_events(events_queue: asyncio.Queue[Event]):
+async def populate_events(events_queue: EventsQueue):
     events = [
         (
             DeliveryRequestEvent.create(
@@ -107,7 +108,7 @@ async def populate_events(events_queue: asyncio.Queue[Event]):
         await asyncio.sleep(delay)
 
 
-async def tts_simulation(events_queue: asyncio.Queue[Event]):
+async def tts_simulation(events_queue: EventsQueue):
     await asyncio.gather(
         serve_tts(events_queue),
         populate_events(events_queue),
@@ -116,5 +117,5 @@ async def tts_simulation(events_queue: asyncio.Queue[Event]):
 
 if __name__ == "__main__":
     loop = asyncio.new_event_loop()
-    queue: asyncio.Queue[Event] = asyncio.Queue()
+    queue = EventsQueue()
     loop.run_until_complete(tts_simulation(queue))
@@ -0,0 +1,132 @@
+"""
+Prints the dispatch and trip metrics of a simulation run from the files
+written by the columnar sink (LOCAL_SINK_DIR)
+"""
+import argparse
+
+import pyarrow
+import pyarrow.compute
+
+from app.clients.columnar import load_table
+from app.clients.sink import DOMAIN_LOGS_TABLE, JOURNEYS_TABLE, TRACK_EVENTS_TABLE
+from app.serialization import loads
+from app.simulation.log import LogType
+
+
+def filter_logs(logs: pyarrow.Table, log_type: LogType) -> pyarrow.Table:
+    return logs.filter(pyarrow.compute.equal(logs["type"], log_type.value))
+
+
+def load_data(logs: pyarrow.Table) -> list[dict]:
+    return [loads(data) for data in logs["data"].to_pylist()]
+
+
+def print_dispatch_metrics(directory: str) -> None:
+    logs = load_table(
+        directory, DOMAIN_LOGS_TABLE, columns=["type", "timestamp", "data"]
+    )
+    if logs is None or not logs.num_rows:
+        print("No domain logs")
+        return
+
+    counts = {
+        row["values"]: row["counts"]
+        for row in pyarrow.compute.value_counts(logs["type"]).to_pylist()
+    }
+    dispatched = counts.get(LogType.JOURNEY_DISPATCHED.value, 0)
+    not_found = counts.get(LogType.TRUCK_NOT_FOUND.value, 0)
+    print("Domain logs:")
+    for log_type, count in sorted(counts.items(), key=lambda item: -item[1]):
+        print(f"  {log_type}: {count}")
+    if dispatched + not_found:
+        print(f"Dispatch rate: {dispatched / (dispatched + not_found):.1%}")
+
+    # only the data of the journey logs is parsed, the rest stays in the Arrow
+    # columns
+    dispatched_logs = filter_logs(logs, LogType.JOURNEY_DISPATCHED)
+    dispatched_data = load_data(dispatched_logs)
+    dispatched_journeys = pyarrow.table(
+        {
+            "journey_id": pyarrow.array(
+                [data["journey_id"] for data in dispatched_data], pyarrow.int64()
+            ),
+            "dispatched_at": dispatched_logs["timestamp"],
+            "expected_duration": pyarrow.array(
+                [data["expected_duration_in_seconds"] for data in dispatched_data],
+                pyarrow.float64(),
+            ),
+        }
+    )
+    finished_logs = filter_logs(logs, LogType.JOURNEY_FINISHED)
+    finished_journeys = pyarrow.table(
+        {
+            "journey_id": pyarrow.array(
+                [data["journey_id"] for data in load_data(finished_logs)],
+                pyarrow.int64(),
+            ),
+            "finished_at": finished_logs["timestamp"],
+        }
+    )
+    trips = finished_journeys.join(dispatched_journeys, "journey_id")
+    if trips.num_rows:
+        durations = pyarrow.compute.divide(
+            pyarrow.compute.subtract(trips["finished_at"], trips["dispatched_at"]),
+            1000.0,
+        )
+        delays = pyarrow.compute.subtract(durations, trips["expected_duration"])
+        print(
+            f"Trips: {trips.num_rows}, "
+            f"mean duration {pyarrow.compute.mean(durations).as_py():.1f}s, "
+            f"max duration {pyarrow.compute.max(durations).as_py():.1f}s, "
+            f"mean delay vs expected {pyarrow.compute.mean(delays).as_py():.1f}s"
+        )
+
+    dropped_off_logs = filter_logs(logs, LogType.DELIVERY_DROPPED_OFF)
+    if dropped_off := dropped_off_logs.num_rows:
+        delivered_load_weight = sum(
+            data["load_weight"] for data in load_data(dropped_off_logs)
+        )
+        print(
+            f"Deliveries: {dropped_off}, {delivered_load_weight} kg, "
+            f"{dropped_off / max(dispatched, 1):.2f} deliveries and "
+            f"{delivered_load_weight / max(dispatched, 1):.0f} kg per journey"
+        )
+
+
+def print_trip_metrics(directory: str) -> None:
+    journeys = load_table(directory, JOURNEYS_TABLE, columns=["journey_id"])
+    print(f"Published journeys: {journeys.num_rows if journeys else 0}")
+
+    track = load_table(directory, TRACK_EVENTS_TABLE, columns=["truck_id", "timestamp"])
+    if track is None or not track.num_rows:
+        return
+
+    points_by_truck = (
+        track.group_by("truck_id")
+        .aggregate([("timestamp", "count")])
+        .sort_by("truck_id")
+    )
+    timestamps = pyarrow.compute.min_max(track["timestamp"]).as_py()
+    duration = (timestamps["max"] - timestamps["min"]) / 1000
+    print(
+        f"Track points: {track.num_rows} of {points_by_truck.num_rows} trucks "
+        f"over {duration:.1f}s"
+    )
+    for truck_id, count in zip(
+        points_by_truck["truck_id"].to_pylist(),
+        points_by_truck["timestamp_count"].to_pylist(),
+    ):
+        print(f"  truck {truck_id}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="Directory of the columnar sink")
+    args = parser.parse_args()
+
+    print_dispatch_metrics(args.directory)
+    print_trip_metrics(args.directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,22 @@ import logging
 from functools import partial
 
 import uvicorn
-from fastapi import Depends, FastAPI, Request
-from pydantic import BaseModel, ConfigDict
+from fastapi import Depends, FastAPI, HTTPException, Request
+from pydantic import BaseModel, ConfigDict, Field
 from pydantic.alias_generators import to_camel
 
-from app.simulation.event import DeliveryRequestEvent, Event
-from app.simulation.server import serve_tts
+from app.config import (
+    DELIVERY_REQUEST_DEADLINE_IN_SECONDS,
+    EVENTS_QUEUE_MAX_SIZE,
+    TRACES_FILE,
+)
+from app.diagnostics.loop_monitor import EventLoopMonitor
+from app.diagnostics.router import router as diagnostics_router
+from app.diagnostics.tracing import FileSpanExporter, tracer
+from app.simulation.api import router as queries_router
+from app.simulation.event import DeliveryRequestEvent, Priority
+from app.simulation.events_queue import EventsQueue, EventsQueueFullError
+from app.simulation.server import create_tts
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(message)s",
@@ -23,6 +33,12 @@ class PostTriggerEventDeliveryRequest(BaseModel):
     load_weight: int
     origin_address: str
     destination_address: str
+    priority: Priority = Priority.NORMAL
+    deadline_in_seconds: float = Field(
+        default=DELIVERY_REQUEST_DEADLINE_IN_SECONDS,
+        gt=0,
+        description="The request is dropped when it is not handled in time",
+    )
 
     model_config = ConfigDict(
         from_attributes=True,
@@ -34,6 +50,8 @@ class PostTriggerEventDeliveryRequest(BaseModel):
                     "loadWeight": 1000,
                     "originAddress": "Vilnius, Lithuania",
                     "destinationAddress": "Siauliai, Lithuania",
+                    "priority": "normal",
+                    "deadlineInSeconds": 60,
                 }
             ]
         },
@@ -41,17 +59,28 @@ class PostTriggerEventDeliveryRequest(BaseModel):
 
 
 async def application_setup_signal(app_instance: FastAPI):
-    events_queue: asyncio.Queue[Event] = asyncio.Queue()
+    events_queue = EventsQueue(max_size=EVENTS_QUEUE_MAX_SIZE)
     app_instance.state.events_queue = events_queue
-    asyncio.create_task(serve_tts(events_queue))
+    if TRACES_FILE:
+        tracer.add_exporter(FileSpanExporter(TRACES_FILE))
+    event_loop_monitor = EventLoopMonitor()
+    event_loop_monitor.start()
+    app_instance.state.event_loop_monitor = event_loop_monitor
+    tts = create_tts(events_queue)
+    app_instance.state.tts = tts
+    asyncio.create_task(tts.run())
     logger.info("Application was set up!")
 
 
 async def application_shutdown_signal(app_instance: FastAPI):
-    pass
+    app_instance.state.event_loop_monitor.stop()
+    if sink := app_instance.state.tts.pub_sub_client.sink:
+        await sink.close()
 
 
 app = FastAPI()
+app.include_router(diagnostics_router)
+app.include_router(queries_router)
 
 
 app.add_event_handler(
@@ -64,18 +93,26 @@ app.add_event_handler(
 )
 
 
-def get_events_queue(request: Request) -> asyncio.Queue[Event]:
+def get_events_queue(request: Request) -> EventsQueue:
     return request.app.state.events_queue
 
 
 @app.post("/trigger-event/delivery-request")
 async def delivery_request(
     payload: PostTriggerEventDeliveryRequest,
-    events_queue: asyncio.Queue[Event] = Depends(get_events_queue),
+    events_queue: EventsQueue = Depends(get_events_queue),
 ) -> str:
-    await events_queue.put(
-        DeliveryRequestEvent.create(**payload.model_dump(by_alias=False))
-    )
+    with tracer.start_span("tts_server.delivery_request"):
+        try:
+            events_queue.put_nowait(
+                DeliveryRequestEvent.create(**payload.model_dump(by_alias=False))
+            )
+        except EventsQueueFullError as e:
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(events_queue.get_retry_after())},
+            )
     return "Success"
 
 
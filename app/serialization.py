@@ -0,0 +1,36 @@
+import dataclasses
+import json
+import typing
+
+from pydantic import BaseModel
+
+_dataclass_fields: dict[type, tuple[str, ...]] = {}
+
+
+def _default(obj: typing.Any) -> typing.Any:
+    cls = type(obj)
+    if (names := _dataclass_fields.get(cls)) is None:
+        if dataclasses.is_dataclass(obj):
+            names = tuple(f.name for f in dataclasses.fields(obj))
+            _dataclass_fields[cls] = names
+        elif isinstance(obj, BaseModel):
+            return obj.model_dump()
+        else:
+            raise TypeError(f"Object of type {cls.__name__} is not JSON serializable")
+
+    return {name: getattr(obj, name) for name in names}
+
+
+_encoder = json.JSONEncoder(
+    separators=(",", ":"), check_circular=False, default=_default
+)
+
+# internal messages are trusted, so they are encoded without the validation
+# and the intermediate dicts, dataclasses are converted to objects on the fly
+dumps: typing.Callable[[typing.Any], str] = _encoder.encode
+
+loads: typing.Callable[[str | bytes], typing.Any] = json.loads
+
+# encodes the string as a JSON string literal, used to embed already encoded
+# JSON documents into the other documents without decoding them
+encode_string: typing.Callable[[str], str] = json.encoder.encode_basestring_ascii  # type: ignore[attr-defined]
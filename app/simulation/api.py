@@ -0,0 +1,187 @@
+import typing
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from app.clients.maps import LocationPoint
+from app.simulation.eta import EtaService
+from app.simulation.registry import JourneyRegistry
+from app.simulation.streaming import (
+    PositionStreamHub,
+    TooManySubscribersError,
+    Viewport,
+    stream_frames,
+)
+
+router = APIRouter(tags=["queries"])
+
+MAX_PAGE_SIZE = 1000
+
+
+def get_registry(request: Request) -> JourneyRegistry:
+    return request.app.state.tts.journeys
+
+
+def get_eta_service(request: Request) -> EtaService:
+    return request.app.state.tts.eta_service
+
+
+def get_position_stream(request: Request) -> PositionStreamHub:
+    return request.app.state.tts.position_stream
+
+
+def paginate(
+    items: list[typing.Any],
+    offset: int,
+    limit: int,
+    serialize: typing.Callable[[typing.Any], dict[str, typing.Any]],
+) -> dict[str, typing.Any]:
+    return {
+        "total": len(items),
+        "offset": offset,
+        "limit": limit,
+        "items": [serialize(item) for item in items[offset : offset + limit]],
+    }
+
+
+@router.get("/events-queue")
+async def get_events_queue_info(request: Request) -> dict[str, typing.Any]:
+    return request.app.state.tts.events_queue.get_info()
+
+
+@router.get("/journeys")
+async def list_journeys(
+    origin: str | None = None,
+    destination: str | None = None,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+    registry: JourneyRegistry = Depends(get_registry),
+) -> dict[str, typing.Any]:
+    journeys = registry.find_journeys(origin=origin, destination=destination)
+    return paginate(journeys, offset, limit, lambda j: j.get_state())
+
+
+@router.get("/journeys/eta")
+async def list_journey_etas(
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+    eta_service: EtaService = Depends(get_eta_service),
+) -> dict[str, typing.Any]:
+    """
+    Returns the ETAs of the active journeys computed by the last refresh
+    """
+    # only the requested page of the ETAs is built
+    return {
+        "refreshed_at": eta_service.refreshed_at,
+        "total": len(eta_service),
+        "offset": offset,
+        "limit": limit,
+        "items": [eta._asdict() for eta in eta_service.get_etas(offset, limit)],
+    }
+
+
+@router.get("/journeys/{journey_id}")
+async def get_journey(
+    journey_id: int, registry: JourneyRegistry = Depends(get_registry)
+) -> dict[str, typing.Any]:
+    if not (journey := registry.get_journey(journey_id)):
+        raise HTTPException(status_code=404, detail="Journey not found")
+    return journey.get_state()
+
+
+@router.get("/journeys/{journey_id}/eta")
+async def get_journey_eta(
+    journey_id: int, eta_service: EtaService = Depends(get_eta_service)
+) -> dict[str, typing.Any]:
+    if not (eta := eta_service.get_eta(journey_id)):
+        raise HTTPException(status_code=404, detail="ETA not found")
+    return {"refreshed_at": eta_service.refreshed_at, **eta._asdict()}
+
+
+@router.get("/trucks")
+async def list_trucks(
+    min_lat: float | None = None,
+    min_lon: float | None = None,
+    max_lat: float | None = None,
+    max_lon: float | None = None,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+    registry: JourneyRegistry = Depends(get_registry),
+) -> dict[str, typing.Any]:
+    bbox = (min_lat, min_lon, max_lat, max_lon)
+    if all(v is None for v in bbox):
+        trucks = registry.get_trucks()
+    elif any(v is None for v in bbox):
+        raise HTTPException(
+            status_code=422,
+            detail="min_lat, min_lon, max_lat and max_lon must be specified together",
+        )
+    else:
+        trucks = registry.find_trucks_in_bbox(*bbox)  # type: ignore[arg-type]
+    return paginate(trucks, offset, limit, lambda tr: tr.get_info())
+
+
+@router.get("/trucks/nearby")
+async def list_nearby_trucks(
+    lat: float,
+    lon: float,
+    radius: float = Query(gt=0, description="Radius in meters"),
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, gt=0, le=MAX_PAGE_SIZE),
+    registry: JourneyRegistry = Depends(get_registry),
+) -> dict[str, typing.Any]:
+    trucks = registry.find_trucks_in_radius(LocationPoint(lat=lat, lon=lon), radius)
+    return paginate(trucks, offset, limit, lambda tr: tr.get_info())
+
+
+@router.get("/trucks/{truck_id}")
+async def get_truck(
+    truck_id: int, registry: JourneyRegistry = Depends(get_registry)
+) -> dict[str, typing.Any]:
+    if not (truck := registry.get_truck(truck_id)):
+        raise HTTPException(status_code=404, detail="Truck not found")
+
+    journey = registry.get_journey_by_truck(truck_id)
+    return {**truck.get_info(), "journey_id": journey.id if journey else None}
+
+
+@router.get("/positions/stream")
+async def stream_positions(
+    min_lat: float = Query(ge=-90, le=90),
+    min_lon: float = Query(ge=-180, le=180),
+    max_lat: float = Query(ge=-90, le=90),
+    max_lon: float = Query(ge=-180, le=180),
+    min_interval: float = Query(
+        default=0.5, ge=0.1, le=60, description="Min interval between frames"
+    ),
+    registry: JourneyRegistry = Depends(get_registry),
+    position_stream: PositionStreamHub = Depends(get_position_stream),
+) -> StreamingResponse:
+    """
+    Streams the positions of the trucks inside the viewport as server-sent
+    events, the first frame is a snapshot of the viewport
+    """
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=422, detail="Invalid viewport")
+
+    try:
+        subscription = position_stream.subscribe(
+            Viewport(min_lat, min_lon, max_lat, max_lon),
+            trucks=registry.find_trucks_in_bbox(min_lat, min_lon, max_lat, max_lon),
+            min_frame_interval=min_interval,
+        )
+    except TooManySubscribersError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    async def frames() -> typing.AsyncIterator[str]:
+        try:
+            async for frame in stream_frames(subscription):
+                yield frame
+        finally:
+            position_stream.unsubscribe(subscription)
+
+    return StreamingResponse(
+        frames(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,197 @@
+import bisect
+import collections
+import dataclasses
+import heapq
+import math
+import typing
+
+from app.clients.maps import LocationPoint
+from app.simulation.event import DeliveryRequestEvent
+from app.simulation.truck import Truck
+from app.simulation.utils import get_timestamp
+
+# ~55 km along the meridian
+REGION_SIZE_IN_DEGREES = 0.5
+
+# rings of the regions around the region of the truck that are searched for
+# the requests, the farther requests are found among the non-empty regions
+MAX_REGION_DISTANCE = 2
+
+BACKLOG_MAX_SIZE = 1000
+
+Region = tuple[int, int]
+
+
+@dataclasses.dataclass(slots=True)
+class PendingRequest:
+    event: DeliveryRequestEvent
+    origin_location: LocationPoint
+    destination_location: LocationPoint
+    region: Region
+    key: tuple[int, int]
+    expires_at: int
+
+
+class PendingRequestsBacklog:
+    """
+    Delivery requests waiting for a free truck, indexed by the region of the
+    origin and sorted by the load weight inside the region. A released truck
+    takes the heaviest request it can carry from the nearest region, found
+    by the binary search in each of the nearby regions and then in the
+    farther non-empty ones, so no request starves far from the free trucks
+    """
+
+    def __init__(
+        self,
+        ttl_in_seconds: float,
+        max_size: int = BACKLOG_MAX_SIZE,
+        region_size: float = REGION_SIZE_IN_DEGREES,
+        max_region_distance: int = MAX_REGION_DISTANCE,
+    ):
+        self.ttl_in_seconds = ttl_in_seconds
+        self.max_size = max_size
+        self.region_size = region_size
+        self.max_region_distance = max_region_distance
+        self._requests: dict[int, PendingRequest] = {}
+        # sorted (load weight, event id) of the requests of the region
+        self._regions: dict[Region, list[tuple[int, int]]] = collections.defaultdict(
+            list
+        )
+        self._expirations: list[tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+    def add(
+        self,
+        event: DeliveryRequestEvent,
+        origin_location: LocationPoint,
+        destination_location: LocationPoint,
+    ) -> bool:
+        """
+        Returns False when the backlog is full. The request expires at its
+        deadline or after the TTL, if it has no deadline
+        """
+        if len(self._requests) >= self.max_size:
+            return False
+
+        expires_at = (
+            event.deadline
+            if event.deadline is not None
+            else get_timestamp() + int(self.ttl_in_seconds * 1000)
+        )
+        request = PendingRequest(
+            event=event,
+            origin_location=origin_location,
+            destination_location=destination_location,
+            region=self._get_region(origin_location),
+            key=(event.load_weight, event.id),
+            expires_at=expires_at,
+        )
+        self._requests[event.id] = request
+        bisect.insort(self._regions[request.region], request.key)
+        heapq.heappush(self._expirations, (expires_at, event.id))
+        return True
+
+    def pop_for_truck(self, truck: Truck) -> DeliveryRequestEvent | None:
+        """
+        Removes and returns the best request for the truck: from the nearest
+        region and the heaviest of the ones the truck can carry
+        """
+        for ring in self._iter_rings(*self._get_region(truck.location)):
+            best: tuple[int, int] | None = None
+            for region in ring:
+                if not (keys := self._regions.get(region)):
+                    continue
+                # the truck carries the loads lighter than its max load weight
+                i = bisect.bisect_left(keys, (truck.max_load_weight,))
+                if i and (best is None or keys[i - 1] > best):
+                    best = keys[i - 1]
+
+            if best is not None:
+                return self._remove(best[1]).event
+
+        return None
+
+    def find_candidates(
+        self, location: LocationPoint, max_load_weight: int, limit: int
+    ) -> list[PendingRequest]:
+        """
+        Returns up to the limit of the requests lighter than the max load
+        weight with the origin near the location, the nearest regions and
+        the heaviest loads first. Only the nearby regions are searched, the
+        farther requests don't fit the detour of the journey. The requests
+        stay in the backlog
+        """
+        x, y = self._get_region(location)
+        candidates: list[PendingRequest] = []
+        for distance in range(self.max_region_distance + 1):
+            ring: list[tuple[int, int]] = []
+            for region in self._get_ring(x, y, distance):
+                if keys := self._regions.get(region):
+                    ring.extend(keys[: bisect.bisect_left(keys, (max_load_weight,))])
+            ring.sort(reverse=True)
+            candidates.extend(self._requests[event_id] for _, event_id in ring)
+            if len(candidates) >= limit:
+                return candidates[:limit]
+
+        return candidates
+
+    def remove(self, event_id: int) -> PendingRequest | None:
+        """
+        Returns None if the request is not in the backlog anymore
+        """
+        if event_id not in self._requests:
+            return None
+        return self._remove(event_id)
+
+    def pop_expired(self) -> list[DeliveryRequestEvent]:
+        now = get_timestamp()
+        expired = []
+        while self._expirations and self._expirations[0][0] <= now:
+            _, event_id = heapq.heappop(self._expirations)
+            # the request may have been already dispatched
+            if event_id in self._requests:
+                expired.append(self._remove(event_id).event)
+        return expired
+
+    def _remove(self, event_id: int) -> PendingRequest:
+        request = self._requests.pop(event_id)
+        keys = self._regions[request.region]
+        del keys[bisect.bisect_left(keys, request.key)]
+        if not keys:
+            del self._regions[request.region]
+        return request
+
+    def _iter_rings(self, x: int, y: int) -> typing.Iterator[list[Region]]:
+        """
+        Yields the regions by the distance from the region: the nearby rings
+        and then the farther non-empty regions, so all the requests are
+        reachable while the search doesn't visit the empty regions far away
+        """
+        for distance in range(self.max_region_distance + 1):
+            yield self._get_ring(x, y, distance)
+
+        far_regions: dict[int, list[Region]] = collections.defaultdict(list)
+        for region in self._regions:
+            distance = max(abs(region[0] - x), abs(region[1] - y))
+            if distance > self.max_region_distance:
+                far_regions[distance].append(region)
+        for distance in sorted(far_regions):
+            yield far_regions[distance]
+
+    def _get_ring(self, x: int, y: int, distance: int) -> list[Region]:
+        if distance == 0:
+            return [(x, y)]
+        return [
+            (x + dx, y + dy)
+            for dx in range(-distance, distance + 1)
+            for dy in range(-distance, distance + 1)
+            if max(abs(dx), abs(dy)) == distance
+        ]
+
+    def _get_region(self, location: LocationPoint) -> Region:
+        return (
+            math.floor(location.lat / self.region_size),
+            math.floor(location.lon / self.region_size),
+        )
@@ -0,0 +1,178 @@
+import dataclasses
+import itertools
+import math
+
+from app.clients.maps import LocationPoint, get_distance_in_meters
+from app.simulation.event import DeliveryRequestEvent
+from app.simulation.route import RouteStop, StopType
+
+MAX_DELIVERIES_PER_JOURNEY = 4
+
+# pending requests near the origin that are tried to be inserted into the journey
+CANDIDATES_NUMBER = 10
+
+# a delivery may be completed this share later than by a dedicated truck
+MAX_DETOUR_RATIO = 0.5
+
+# the detour allowed to every delivery, so the short ones within a city
+# can be consolidated too
+MIN_DETOUR_IN_METERS = 20_000
+
+
+@dataclasses.dataclass(slots=True)
+class Delivery:
+    event: DeliveryRequestEvent
+    origin_location: LocationPoint
+    destination_location: LocationPoint
+
+
+def get_direct_stops(event: DeliveryRequestEvent) -> list[RouteStop]:
+    return [
+        RouteStop(
+            type=StopType.PICKUP,
+            event_id=event.id,
+            address=event.origin_address,
+            load_weight=event.load_weight,
+        ),
+        RouteStop(
+            type=StopType.DROPOFF,
+            event_id=event.id,
+            address=event.destination_address,
+            load_weight=event.load_weight,
+        ),
+    ]
+
+
+class ConsolidationPlanner:
+    """
+    Packs several deliveries into one journey of the truck. Candidates are
+    taken the heaviest first (first fit decreasing) and each one is inserted
+    with the cheapest insertion: its pickup and drop-off are put at the
+    positions of the stops that make the route the shortest, provided that
+    the load on board stays below the max load weight and every delivery of
+    the journey is completed within the detour limit of its dedicated trip.
+    Distances are estimated by the straight lines, so planning doesn't call
+    the Maps API, only the legs of the resulting route are requested
+    """
+
+    def __init__(
+        self,
+        max_deliveries: int = MAX_DELIVERIES_PER_JOURNEY,
+        candidates_number: int = CANDIDATES_NUMBER,
+        max_detour_ratio: float = MAX_DETOUR_RATIO,
+        min_detour_in_meters: float = MIN_DETOUR_IN_METERS,
+    ):
+        self.max_deliveries = max_deliveries
+        self.candidates_number = candidates_number
+        self.max_detour_ratio = max_detour_ratio
+        self.min_detour_in_meters = min_detour_in_meters
+
+    def plan(
+        self,
+        start_location: LocationPoint,
+        max_load_weight: int,
+        delivery: Delivery,
+        candidates: list[Delivery],
+    ) -> list[RouteStop]:
+        """
+        Returns the stops of the journey that starts with the delivery,
+        the candidates that didn't fit are not in the stops
+        """
+        deliveries = [delivery, *candidates]
+        # the start is the point 0, the pickup and the drop-off of the
+        # delivery i are the points 2i + 1 and 2i + 2
+        locations = [start_location]
+        addresses: list[str | None] = [None]
+        for d in deliveries:
+            locations += [d.origin_location, d.destination_location]
+            addresses += [d.event.origin_address, d.event.destination_address]
+        # the stops at the same address are one stop of the route
+        distances = [
+            [
+                0.0 if a1 is not None and a1 == a2 else get_distance_in_meters(p1, p2)
+                for p2, a2 in zip(locations, addresses)
+            ]
+            for p1, a1 in zip(locations, addresses)
+        ]
+        max_completion_distances = [
+            (distances[0][2 * i + 1] + distances[2 * i + 1][2 * i + 2])
+            * (1 + self.max_detour_ratio)
+            + self.min_detour_in_meters
+            for i in range(len(deliveries))
+        ]
+
+        def get_length(stops: list[int]) -> float:
+            return sum(distances[p1][p2] for p1, p2 in zip([0, *stops], stops))
+
+        def order_at_same_address(stops: list[int]) -> list[int]:
+            """
+            At the same address the loads picked up at the previous stops are
+            dropped off before the pickups, the length of the route is the same
+            """
+            result: list[int] = []
+            for _, group in itertools.groupby(stops, key=lambda p: addresses[p]):
+                picked_up = set(result)
+                result += sorted(
+                    group, key=lambda p: not (p % 2 == 0 and p - 1 in picked_up)
+                )
+            return result
+
+        def is_feasible(stops: list[int]) -> bool:
+            load_weight = 0
+            length = 0.0
+            previous = 0
+            for point in stops:
+                length += distances[previous][point]
+                previous = point
+                i, is_dropoff = divmod(point - 1, 2)
+                if is_dropoff:
+                    load_weight -= deliveries[i].event.load_weight
+                    if length > max_completion_distances[i]:
+                        return False
+                else:
+                    load_weight += deliveries[i].event.load_weight
+                    if load_weight >= max_load_weight:
+                        return False
+            return True
+
+        stops = [1, 2]
+        order = sorted(
+            range(1, len(deliveries)),
+            key=lambda i: deliveries[i].event.load_weight,
+            reverse=True,
+        )
+        for i in order:
+            if len(stops) >= 2 * self.max_deliveries:
+                break
+
+            pickup, dropoff = 2 * i + 1, 2 * i + 2
+            best: list[int] | None = None
+            best_length = math.inf
+            for j in range(len(stops) + 1):
+                for k in range(j, len(stops) + 1):
+                    option = order_at_same_address(
+                        [*stops[:j], pickup, *stops[j:k], dropoff, *stops[k:]]
+                    )
+                    length = get_length(option)
+                    if length < best_length and is_feasible(option):
+                        best, best_length = option, length
+            if best is not None:
+                stops = best
+
+        result: list[RouteStop] = []
+        for point in stops:
+            i, is_dropoff = divmod(point - 1, 2)
+            event = deliveries[i].event
+            result.append(
+                RouteStop(
+                    type=StopType.DROPOFF if is_dropoff else StopType.PICKUP,
+                    event_id=event.id,
+                    address=event.destination_address
+                    if is_dropoff
+                    else event.origin_address,
+                    load_weight=event.load_weight,
+                )
+            )
+
+        # at the same address the loads are dropped off before the pickups
+        return result
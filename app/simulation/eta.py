@@ -0,0 +1,324 @@
+import asyncio
+import dataclasses
+import heapq
+import math
+import time
+import typing
+from array import array
+
+from app.clients.maps import LocationPoint, get_distance_in_meters
+from app.simulation.journey import Journey
+from app.simulation.utils import get_timestamp
+
+ETA_REFRESH_INTERVAL_IN_SECONDS = 1
+
+# ~11 km along the meridian
+SPEED_CELL_SIZE_IN_DEGREES = 0.1
+
+# weight of the previous observations of the cell at every new one
+SPEED_DECAY = 0.95
+
+# the speed of the cell is used once the trucks spent this time in it
+MIN_OBSERVED_SECONDS = 1.0
+
+# journeys behind the prediction the most that are listed in the summary
+SUMMARY_LATE_JOURNEYS_NUMBER = 5
+
+Cell = tuple[int, int]
+
+
+class SpeedProfile:
+    """
+    Speeds of the trucks in the grid cells learned from the driven segments
+    of the journeys, the older observations of the cell decay, so the profile
+    follows the changes of the traffic
+    """
+
+    def __init__(
+        self,
+        cell_size: float = SPEED_CELL_SIZE_IN_DEGREES,
+        decay: float = SPEED_DECAY,
+        min_observed_seconds: float = MIN_OBSERVED_SECONDS,
+    ):
+        self.cell_size = cell_size
+        self.decay = decay
+        self.min_observed_seconds = min_observed_seconds
+        # decayed sums of the distance in meters and of the time in seconds
+        self._cells: dict[Cell, list[float]] = {}
+        self._total = [0.0, 0.0]
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    def observe(self, location: LocationPoint, distance: float, duration: float):
+        if duration <= 0:
+            return
+
+        cell = self._get_cell(location)
+        if (sums := self._cells.get(cell)) is None:
+            sums = self._cells[cell] = [0.0, 0.0]
+        for s in (sums, self._total):
+            s[0] = s[0] * self.decay + distance
+            s[1] = s[1] * self.decay + duration
+
+    def get_speed(self, location: LocationPoint) -> float | None:
+        """
+        Returns the speed in meters per second in the cell of the location
+        """
+        sums = self._cells.get(self._get_cell(location))
+        if sums is None or sums[1] < self.min_observed_seconds:
+            return None
+        return sums[0] / sums[1]
+
+    def get_average_speed(self) -> float | None:
+        if self._total[1] < self.min_observed_seconds:
+            return None
+        return self._total[0] / self._total[1]
+
+    def _get_cell(self, location: LocationPoint) -> Cell:
+        return (
+            math.floor(location.lat / self.cell_size),
+            math.floor(location.lon / self.cell_size),
+        )
+
+
+class Eta(typing.NamedTuple):
+    journey_id: int
+    truck_id: int
+    remaining_in_seconds: float
+    # timestamps in ms
+    eta: int
+    next_stop_eta: int | None
+
+
+@dataclasses.dataclass(slots=True)
+class _Track:
+    journey: Journey
+    # cumulative distance in meters and the predicted cumulative time in
+    # seconds to every point of the route
+    distances: array
+    times: array
+    started_at: float
+    # the last route index seen by the refresh and when it was seen
+    sampled_index: int
+    sampled_at: float
+
+
+@dataclasses.dataclass(slots=True)
+class _EtaTable:
+    """
+    Result of the refresh stored by columns, the rows of the ETAs are built
+    only for the requested journeys
+    """
+
+    tracks: list[_Track]
+    rows: dict[int, int]
+    route_indexes: array
+    paces: array
+    remaining_times: array
+    # seconds the journey is behind the predicted time left
+    delays: array
+    refreshed_at: int
+
+
+class EtaService:
+    """
+    Predicts the arrival times of all active journeys. When the journey is
+    added, the time to every point of its route is predicted once by the
+    learned speed profile, falling back to the average speed and then to
+    the expected duration of the route. The refresh computes the remaining
+    time of every journey from these tables in constant time: the predicted
+    time left from the current point scaled by the pace of the journey so
+    far. The driven segments are fed back to the speed profile
+    """
+
+    def __init__(
+        self,
+        speed_profile: SpeedProfile | None = None,
+        refresh_interval: float = ETA_REFRESH_INTERVAL_IN_SECONDS,
+    ):
+        self.speed_profile = speed_profile or SpeedProfile()
+        self.refresh_interval = refresh_interval
+        self._tracks: dict[int, _Track] = {}
+        self._table = _EtaTable(
+            tracks=[],
+            rows={},
+            route_indexes=array("q"),
+            paces=array("d"),
+            remaining_times=array("d"),
+            delays=array("d"),
+            refreshed_at=get_timestamp(),
+        )
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    @property
+    def refreshed_at(self) -> int:
+        return self._table.refreshed_at
+
+    def add_journey(self, journey: Journey) -> None:
+        points = journey.route.location_points
+        if not points:
+            return
+
+        distances = array("d", [0.0])
+        for p1, p2 in zip(points, points[1:]):
+            distances.append(distances[-1] + get_distance_in_meters(p1, p2))
+
+        now = time.monotonic()
+        self._tracks[journey.id] = _Track(
+            journey=journey,
+            distances=distances,
+            times=self._predict_times(journey, distances),
+            started_at=now,
+            sampled_index=0,
+            sampled_at=now,
+        )
+
+    def remove_journey(self, journey: Journey) -> None:
+        self._tracks.pop(journey.id, None)
+
+    def get_eta(self, journey_id: int) -> Eta | None:
+        """
+        Returns the ETA of the journey computed by the last refresh
+        """
+        table = self._table
+        if (row := table.rows.get(journey_id)) is None:
+            return None
+        return self._get_eta(table, row)
+
+    def get_etas(self, offset: int = 0, limit: int | None = None) -> list[Eta]:
+        table = self._table
+        end = len(table.tracks) if limit is None else offset + limit
+        return [
+            eta
+            for row in range(offset, min(end, len(table.tracks)))
+            if (eta := self._get_eta(table, row))
+        ]
+
+    def get_summary(
+        self, late_journeys_number: int = SUMMARY_LATE_JOURNEYS_NUMBER
+    ) -> dict[str, typing.Any]:
+        """
+        Returns the bounded summary of the last refresh for the state logs,
+        the ETAs of all journeys are served by the API
+        """
+        table = self._table
+        remaining_times = sorted(table.remaining_times)
+
+        def percentile(p: float) -> float | None:
+            if not remaining_times:
+                return None
+            i = min(int(p * len(remaining_times)), len(remaining_times) - 1)
+            return round(remaining_times[i], 3)
+
+        late_rows = heapq.nlargest(
+            late_journeys_number,
+            (row for row in range(len(table.tracks)) if table.delays[row] > 0),
+            key=table.delays.__getitem__,
+        )
+        return {
+            "refreshed_at": table.refreshed_at,
+            "journeys": len(table.tracks),
+            "p50_remaining_in_seconds": percentile(0.5),
+            "p95_remaining_in_seconds": percentile(0.95),
+            "max_remaining_in_seconds": percentile(1),
+            "most_late": [
+                {**eta._asdict(), "delay_in_seconds": round(table.delays[row], 3)}
+                for row in late_rows
+                if (eta := self._get_eta(table, row))
+            ],
+        }
+
+    def refresh(self) -> None:
+        self._table = self._compute_table(list(self._tracks.values()))
+
+    async def run(self):
+        while True:
+            # the tracks are taken on the event loop and the table is computed
+            # in a thread, so a large number of journeys doesn't block the loop
+            tracks = list(self._tracks.values())
+            self._table = await asyncio.to_thread(self._compute_table, tracks)
+            await asyncio.sleep(self.refresh_interval)
+
+    def _compute_table(self, tracks: list[_Track]) -> _EtaTable:
+        now = time.monotonic()
+        route_indexes = array("q")
+        paces = array("d")
+        remaining_times = array("d")
+        delays = array("d")
+        observe = self.speed_profile.observe
+        for track in tracks:
+            i = track.journey.route_index
+            times = track.times
+            elapsed_time = times[i]
+            # the pace of the journey corrects the prediction, e.g. when
+            # the truck is stuck in the traffic
+            pace = (
+                (now - track.started_at) / elapsed_time
+                if i and elapsed_time > 0
+                else 1.0
+            )
+            route_indexes.append(i)
+            paces.append(pace)
+            remaining_times.append((times[-1] - elapsed_time) * pace)
+            delays.append((times[-1] - elapsed_time) * (pace - 1))
+
+            if i > track.sampled_index:
+                observe(
+                    track.journey.route.location_points[track.sampled_index],
+                    track.distances[i] - track.distances[track.sampled_index],
+                    now - track.sampled_at,
+                )
+                track.sampled_index = i
+                track.sampled_at = now
+
+        return _EtaTable(
+            tracks=tracks,
+            rows={track.journey.id: row for row, track in enumerate(tracks)},
+            route_indexes=route_indexes,
+            paces=paces,
+            remaining_times=remaining_times,
+            delays=delays,
+            refreshed_at=get_timestamp(),
+        )
+
+    def _get_eta(self, table: _EtaTable, row: int) -> Eta | None:
+        track = table.tracks[row]
+        journey = track.journey
+        # the journey has finished since the refresh
+        if journey.id not in self._tracks:
+            return None
+
+        remaining_time = table.remaining_times[row]
+        next_stop_eta = None
+        if (next_stop := journey.next_stop) and next_stop.location_index < len(
+            track.times
+        ):
+            next_stop_time = (
+                track.times[next_stop.location_index]
+                - track.times[table.route_indexes[row]]
+            ) * table.paces[row]
+            next_stop_eta = table.refreshed_at + int(max(next_stop_time, 0) * 1000)
+
+        return Eta(
+            journey_id=journey.id,
+            truck_id=journey.truck.id,
+            remaining_in_seconds=round(remaining_time, 3),
+            eta=table.refreshed_at + int(remaining_time * 1000),
+            next_stop_eta=next_stop_eta,
+        )
+
+    def _predict_times(self, journey: Journey, distances: array) -> array:
+        points = journey.route.location_points
+        default_speed = self.speed_profile.get_average_speed()
+        if default_speed is None and journey.route.expected_duration_in_seconds > 0:
+            default_speed = distances[-1] / journey.route.expected_duration_in_seconds
+
+        times = array("d", [0.0])
+        for j in range(1, len(points)):
+            speed = self.speed_profile.get_speed(points[j - 1]) or default_speed
+            length = distances[j] - distances[j - 1]
+            times.append(times[-1] + (length / speed if speed else 0))
+        return times
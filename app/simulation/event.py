@@ -1,10 +1,26 @@
-from pydantic import BaseModel
+import enum
+
+from pydantic import BaseModel, Field
+
+from app.diagnostics.tracing import get_current_traceparent
+from app.simulation.utils import get_timestamp
 
 EVENT_ID = 0
 
 
+class Priority(enum.StrEnum):
+    HIGH = enum.auto()
+    NORMAL = enum.auto()
+    LOW = enum.auto()
+
+
 class Event(BaseModel):
     id: int
+    created_at: int = Field(default_factory=get_timestamp)
+    traceparent: str | None = None
+    priority: Priority = Priority.NORMAL
+    # timestamp in ms after which the event is not handled anymore
+    deadline: int | None = None
 
 
 class DeliveryRequestEvent(Event):
@@ -14,14 +30,27 @@ class DeliveryRequestEvent(Event):
 
     @classmethod
     def create(
-        cls, *, origin_address: str, destination_address: str, load_weight: int = 0
+        cls,
+        *,
+        origin_address: str,
+        destination_address: str,
+        load_weight: int = 0,
+        priority: Priority = Priority.NORMAL,
+        deadline_in_seconds: float | None = None,
     ):
         global EVENT_ID
         id_ = EVENT_ID
         EVENT_ID += 1
+        created_at = get_timestamp()
         return cls(
             id=id_,
+            created_at=created_at,
+            priority=priority,
+            deadline=created_at + int(deadline_in_seconds * 1000)
+            if deadline_in_seconds is not None
+            else None,
             load_weight=load_weight,
             origin_address=origin_address,
             destination_address=destination_address,
+            traceparent=get_current_traceparent(),
         )
@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import math
+import time
+import typing
+
+from app.clients.resilience import LatencyTracker
+from app.simulation.event import Event, Priority
+from app.simulation.utils import get_timestamp
+
+EVENTS_QUEUE_MAX_SIZE = 1000
+
+PRIORITY_RANKS = {Priority.HIGH: 0, Priority.NORMAL: 1, Priority.LOW: 2}
+
+MAX_RETRY_AFTER_IN_SECONDS = 60
+
+# rank, deadline, sequence number, enqueue time, event
+_Item = tuple[int, float, int, float, Event]
+
+
+class EventsQueueFullError(Exception):
+    pass
+
+
+class EventsQueue:
+    """
+    Bounded queue of the events ordered by the priority and then by the
+    deadline (earliest first). Events whose deadline has passed are shed
+    instead of being handled, when the queue is full the incoming event
+    evicts the queued event with the lowest priority, if its own priority
+    is higher, otherwise it is rejected
+    """
+
+    def __init__(
+        self,
+        max_size: int = EVENTS_QUEUE_MAX_SIZE,
+        on_shed: typing.Callable[[Event, str], None] | None = None,
+    ):
+        self.max_size = max_size
+        self.on_shed = on_shed
+        self._heap: list[_Item] = []
+        self._counter = itertools.count()
+        self._not_empty = asyncio.Event()
+        self._queue_times = LatencyTracker(window_size=1000, min_samples=1)
+        self._dequeue_times: collections.deque[float] = collections.deque(maxlen=100)
+        self._counts: collections.Counter[str] = collections.Counter()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def empty(self) -> bool:
+        return not self._heap
+
+    def put_nowait(self, event: Event) -> None:
+        """
+        Raises EventsQueueFullError when the event is not admitted
+        """
+        item: _Item = (
+            PRIORITY_RANKS[event.priority],
+            event.deadline if event.deadline is not None else math.inf,
+            next(self._counter),
+            time.monotonic(),
+            event,
+        )
+        if len(self._heap) >= self.max_size:
+            self._shed_expired()
+        if len(self._heap) >= self.max_size:
+            worst = max(self._heap)
+            if worst[0] <= item[0]:
+                self._counts["rejected"] += 1
+                raise EventsQueueFullError(
+                    f"Events queue is full ({self.max_size} events)"
+                )
+            self._heap.remove(worst)
+            heapq.heapify(self._heap)
+            self._shed(worst, "evicted")
+
+        heapq.heappush(self._heap, item)
+        self._counts["admitted"] += 1
+        self._not_empty.set()
+
+    async def put(self, event: Event) -> None:
+        self.put_nowait(event)
+
+    async def get(self) -> Event:
+        """
+        Returns the most urgent event, the expired events are shed
+        """
+        while True:
+            while not self._heap:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+
+            item = heapq.heappop(self._heap)
+            if self._is_expired(item):
+                self._shed(item, "expired")
+                continue
+
+            now = time.monotonic()
+            self._queue_times.record(now - item[3])
+            self._dequeue_times.append(now)
+            self._counts["dequeued"] += 1
+            return item[4]
+
+    def get_retry_after(self) -> int:
+        """
+        Estimates in how many seconds the queue will have the free space by
+        the recent dequeue rate
+        """
+        if len(self._dequeue_times) < 2:
+            return 1
+
+        elapsed = self._dequeue_times[-1] - self._dequeue_times[0]
+        rate = (len(self._dequeue_times) - 1) / max(elapsed, 1e-3)
+        return min(
+            max(math.ceil((len(self._heap) - self.max_size + 1) / rate), 1),
+            MAX_RETRY_AFTER_IN_SECONDS,
+        )
+
+    def get_info(self) -> dict[str, typing.Any]:
+        queue_times = {
+            f"p{int(p * 100)}_queue_time_in_ms": round(value * 1000, 2)
+            if (value := self._queue_times.percentile(p)) is not None
+            else None
+            for p in [0.5, 0.95, 0.99]
+        }
+        return {
+            "size": len(self._heap),
+            "max_size": self.max_size,
+            **{
+                name: self._counts[name]
+                for name in ["admitted", "rejected", "dequeued", "expired", "evicted"]
+            },
+            **queue_times,
+        }
+
+    def _shed_expired(self) -> None:
+        now = get_timestamp()
+        expired = [item for item in self._heap if item[1] < now]
+        if not expired:
+            return
+
+        self._heap = [item for item in self._heap if item[1] >= now]
+        heapq.heapify(self._heap)
+        for item in expired:
+            self._shed(item, "expired")
+
+    def _shed(self, item: _Item, reason: str) -> None:
+        self._counts[reason] += 1
+        if self.on_shed:
+            self.on_shed(item[4], reason)
+
+    @staticmethod
+    def _is_expired(item: _Item) -> bool:
+        return item[1] < get_timestamp()
@@ -1,30 +1,252 @@
+import asyncio
+import collections
+import heapq
+import math
 import typing
 
+from app.clients.maps import LocationPoint, MapsClient, get_distance_in_meters
+from app.diagnostics.tracing import traced
 from app.simulation.event import DeliveryRequestEvent
 from app.simulation.log import Log, LogType
 from app.simulation.truck import Truck
 
+# number of the nearest (by the straight line) free trucks that are compared
+# by the actual drive time to the pickup location
+CANDIDATE_TRUCKS_NUMBER = 5
+
+# number of the selections when the ranked trucks were reserved by the
+# concurrent requests while their drive times were requested
+SELECTION_ATTEMPTS_NUMBER = 3
+
+# ~5.5 km along the meridian
+FREE_TRUCKS_CELL_SIZE_IN_DEGREES = 0.05
+
+Cell = tuple[int, int]
+
 
 class Fleet:
-    def __init__(self, trucks: list[Truck]):
+    """
+    Trucks of the fleet, the free ones are indexed by the grid cell of their
+    location, which doesn't change until the truck starts a journey, so the
+    truck for the delivery is searched among the free trucks near the pickup
+    """
+
+    def __init__(
+        self,
+        trucks: list[Truck],
+        maps_client: MapsClient | None = None,
+        candidate_trucks_number: int = CANDIDATE_TRUCKS_NUMBER,
+        cell_size: float = FREE_TRUCKS_CELL_SIZE_IN_DEGREES,
+    ):
         self.trucks = trucks
+        self.maps_client = maps_client
+        self.candidate_trucks_number = candidate_trucks_number
+        self.cell_size = cell_size
+        self._reserved_truck_ids: set[int] = set()
+        self._max_load_weight = max((tr.max_load_weight for tr in trucks), default=0)
+        self._free_cells: dict[Cell, dict[int, Truck]] = collections.defaultdict(dict)
+        self._free_truck_cells: dict[int, Cell] = {}
+
+        for truck in trucks:
+            if not truck.in_journey:
+                self._add_free_truck(truck)
 
+    @traced("fleet.select_truck_for_delivery")
     async def select_truck_for_delivery(
         self, event: DeliveryRequestEvent
     ) -> Truck | None:
-        def filter_truck(tr: Truck) -> bool:
-            return not tr.in_journey and event.load_weight < tr.max_load_weight
+        """
+        Selects the truck for the delivery and reserves it, so it can't be
+        selected for the concurrent requests. The reservation is kept until
+        ``release_truck`` is called
+        """
+        for _ in range(SELECTION_ATTEMPTS_NUMBER):
+            if not self._free_truck_cells:
+                return None
+
+            if self.maps_client is None:
+                trucks = self._find_free_trucks(event, None, 1)
+            else:
+                origin_location = await asyncio.to_thread(
+                    self.maps_client.get_location, event.origin_address
+                )
+                trucks = self._find_free_trucks(
+                    event, origin_location, self.candidate_trucks_number
+                )
+            if not trucks:
+                return None
+
+            if self.maps_client is None or len(trucks) == 1:
+                ranked_trucks = trucks
+            else:
+                ranked_trucks = await asyncio.to_thread(
+                    self._rank_trucks_by_drive_time, event, trucks
+                )
+
+            # there is no await between the check and the reservation, so
+            # the same truck is never reserved twice
+            for truck in ranked_trucks:
+                if self._is_available(truck, event):
+                    self.reserve_truck(truck)
+                    return truck
+
+        return None
+
+    def can_carry(self, event: DeliveryRequestEvent) -> bool:
+        """
+        Checks if any truck of the fleet can carry the load, when it is free
+        """
+        return event.load_weight < self._max_load_weight
+
+    def reserve_truck(self, truck: Truck) -> bool:
+        """
+        Returns False if the truck is busy or already reserved
+        """
+        if truck.in_journey or truck.id in self._reserved_truck_ids:
+            return False
+        self._reserved_truck_ids.add(truck.id)
+        return True
+
+    def release_truck(self, truck: Truck) -> None:
+        self._reserved_truck_ids.discard(truck.id)
+
+    def start_journey(self, truck: Truck) -> None:
+        """
+        Marks the reserved truck busy and releases the reservation
+        """
+        truck.in_journey = True
+        self.release_truck(truck)
+        if (cell := self._free_truck_cells.pop(truck.id, None)) is not None:
+            del self._free_cells[cell][truck.id]
+            if not self._free_cells[cell]:
+                del self._free_cells[cell]
+
+    def finish_journey(self, truck: Truck) -> None:
+        """
+        Marks the truck free at its current location
+        """
+        truck.in_journey = False
+        self._add_free_truck(truck)
 
-        if truck := next(filter(lambda tr: filter_truck(tr), self.trucks), None):
-            return truck
-        else:
-            return None
+    def _is_available(self, truck: Truck, event: DeliveryRequestEvent) -> bool:
+        return (
+            not truck.in_journey
+            and truck.id not in self._reserved_truck_ids
+            and event.load_weight < truck.max_load_weight
+        )
+
+    def _find_free_trucks(
+        self, event: DeliveryRequestEvent, location: LocationPoint | None, number: int
+    ) -> list[Truck]:
+        """
+        Returns up to the number of the available trucks for the delivery,
+        the nearest to the location by the straight line. The cells are
+        visited by the distance from the cell of the location until the ring
+        after the one where enough trucks were found, since its trucks can be
+        nearer than the ones of the previous ring
+        """
+        if location is None:
+            return [
+                truck
+                for trucks in self._free_cells.values()
+                for truck in trucks.values()
+                if self._is_available(truck, event)
+            ][:number]
+
+        origin_location = location
+        candidates: list[Truck] = []
+        max_distance: int | None = None
+        for distance, cell in self._iter_free_cells(self._get_cell(origin_location)):
+            if max_distance is not None and distance > max_distance:
+                break
+
+            candidates.extend(
+                truck
+                for truck in self._free_cells[cell].values()
+                if self._is_available(truck, event)
+            )
+            if max_distance is None and len(candidates) >= number:
+                max_distance = distance + 1
+
+        return heapq.nsmallest(
+            number,
+            candidates,
+            key=lambda tr: get_distance_in_meters(tr.location, origin_location),
+        )
+
+    def _iter_free_cells(self, origin: Cell) -> typing.Iterator[tuple[int, Cell]]:
+        """
+        Yields the cells with the free trucks and their distances from the
+        origin cell, the nearest first. The rings around the origin are
+        visited while they are smaller than the number of the cells with the
+        free trucks, then the rest of the cells are sorted by the distance
+        """
+        x, y = origin
+        distance = 0
+        while 8 * distance <= len(self._free_cells):
+            for dx in range(-distance, distance + 1):
+                # the inner cells of the columns belong to the previous rings
+                step = 1 if abs(dx) == distance else 2 * distance
+                for dy in range(-distance, distance + 1, max(step, 1)):
+                    if (cell := (x + dx, y + dy)) in self._free_cells:
+                        yield distance, cell
+            distance += 1
+
+        yield from sorted(
+            (cell_distance, cell)
+            for cell in self._free_cells
+            if (cell_distance := max(abs(cell[0] - x), abs(cell[1] - y))) >= distance
+        )
+
+    def _add_free_truck(self, truck: Truck) -> None:
+        cell = self._get_cell(truck.location)
+        if (previous_cell := self._free_truck_cells.get(truck.id)) is not None:
+            del self._free_cells[previous_cell][truck.id]
+            if not self._free_cells[previous_cell]:
+                del self._free_cells[previous_cell]
+        self._free_cells[cell][truck.id] = truck
+        self._free_truck_cells[truck.id] = cell
+
+    def _get_cell(self, location: LocationPoint) -> Cell:
+        return (
+            math.floor(location.lat / self.cell_size),
+            math.floor(location.lon / self.cell_size),
+        )
+
+    def _rank_trucks_by_drive_time(
+        self, event: DeliveryRequestEvent, candidates: list[Truck]
+    ) -> list[Truck]:
+        """
+        Ranks the nearest free trucks by the actual drive time to the pickup
+        location using a single route matrix request, blocks on the Maps API
+        """
+        assert self.maps_client is not None
+        elements = self.maps_client.get_route_matrix(
+            origins=[tr.location for tr in candidates],
+            destinations=[event.origin_address],
+        )
+        durations = {
+            e.origin_index: e.duration_in_seconds
+            for e in elements
+            if e.duration_in_seconds is not None
+        }
+        return [
+            candidates[i]
+            for i in sorted(
+                range(len(candidates)),
+                key=lambda i: (durations.get(i) is None, durations.get(i, 0)),
+            )
+        ]
 
     def get_info(self) -> dict[str, typing.Any]:
+        """
+        Returns the aggregates only, the trucks are served by the API
+        """
+        free_trucks_number = len(self._free_truck_cells)
         return {
-            "free_trucks": len([tr for tr in self.trucks if not tr.in_journey]),
-            "busy_trucks": len([tr for tr in self.trucks if tr.in_journey]),
-            "trucks": [tr.get_info() for tr in self.trucks],
+            "free_trucks": free_trucks_number,
+            "busy_trucks": len(self.trucks) - free_trucks_number,
+            "reserved_trucks": len(self._reserved_truck_ids),
         }
 
     def get_truck_not_found_domain_log(self, event: DeliveryRequestEvent) -> Log:
@@ -0,0 +1,353 @@
+import collections
+import dataclasses
+import json
+import math
+import typing
+from array import array
+
+from app.simulation.log import Log, LogType
+from app.simulation.truck import Truck
+
+# ~2 km along the meridian, the smaller cells have fewer fence edges
+GRID_CELL_SIZE_IN_DEGREES = 0.02
+
+_NOT_INSIDE: frozenset[int] = frozenset()
+
+# ring is a list of (lon, lat) coordinates as in GeoJSON
+Ring = list[tuple[float, float]]
+
+
+@dataclasses.dataclass(slots=True)
+class Geofence:
+    id: str
+    name: str
+    kind: str
+    # rings of all polygons of the fence, holes included, the point is inside
+    # when it is inside an odd number of rings
+    rings: list[Ring]
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    @classmethod
+    def create(cls, id: str, name: str, kind: str, rings: list[Ring]) -> "Geofence":
+        lons = [lon for ring in rings for lon, _ in ring]
+        lats = [lat for ring in rings for _, lat in ring]
+        return cls(
+            id=id,
+            name=name,
+            kind=kind,
+            rings=rings,
+            min_lat=min(lats),
+            min_lon=min(lons),
+            max_lat=max(lats),
+            max_lon=max(lons),
+        )
+
+    def contains(self, lats: array, lons: array) -> bytearray:
+        """
+        Tests all points at once with the even-odd rule, iterating over the
+        edges in the outer loop, so each edge is prepared once per batch
+        """
+        inside = bytearray(len(lats))
+        points = range(len(lats))
+        for ring in self.rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if y1 == y2:
+                    continue
+                slope = (x2 - x1) / (y2 - y1)
+                low, high = (y1, y2) if y1 < y2 else (y2, y1)
+                for i in points:
+                    y = lats[i]
+                    if low <= y < high and lons[i] < x1 + (y - y1) * slope:
+                        inside[i] ^= 1
+        return inside
+
+
+def load_geofences(path: str) -> list[Geofence]:
+    """
+    Loads the geofences from the GeoJSON feature collection with Polygon and
+    MultiPolygon features, properties "id", "name" and "kind" are optional
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    geofences = []
+    for i, feature in enumerate(data["features"]):
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            raise Exception(f"Unsupported geofence geometry {geometry['type']}")
+
+        properties = feature.get("properties") or {}
+        geofences.append(
+            Geofence.create(
+                id=str(properties.get("id", feature.get("id", i))),
+                name=properties.get("name", ""),
+                kind=properties.get("kind", "zone"),
+                rings=[
+                    [(lon, lat) for lon, lat, *_ in ring]
+                    for polygon in polygons
+                    for ring in polygon
+                ],
+            )
+        )
+    return geofences
+
+
+Cell = tuple[int, int]
+
+Edge = tuple[float, float, float, float]
+
+# the edges are added to the cells within this distance in degrees too, so
+# the rounding doesn't miss the cells the edges touch
+CELL_MARGIN = 1e-9
+
+# the reference point of the cell is not its center, so it doesn't fall on
+# the fences drawn by the round coordinates
+REFERENCE_POINT_OFFSET = (0.381966, 0.618034)
+
+
+@dataclasses.dataclass(slots=True)
+class _Boundary:
+    fence_index: int
+    # the edges of the fence crossing the cell and whether the reference
+    # point of the cell is inside the fence
+    edges: list[Edge]
+    is_reference_inside: bool
+
+
+@dataclasses.dataclass(slots=True)
+class _GridCell:
+    # fences that contain the whole cell
+    inside: frozenset[int]
+    # fences whose edges cross the cell
+    boundaries: list[_Boundary]
+
+
+class GeofenceEngine:
+    """
+    Tracks which trucks are inside which geofences and creates the domain
+    logs when the trucks enter or exit them. The grid cells are classified
+    once: the cells crossed by the edges of a fence are its boundary, the
+    other cells of the fence bounding box are entirely inside or outside it.
+    Only the trucks that moved since the previous check are tested: a truck
+    in a cell without the boundaries is resolved by the cell and skipped when
+    the cell didn't change. In a boundary cell the point is inside the fence
+    when the segment from the reference point of the cell to the point
+    crosses the edges of the cell an even number of times and the reference
+    point is inside, so a point is tested against a few edges only
+    """
+
+    def __init__(
+        self, geofences: list[Geofence], cell_size: float = GRID_CELL_SIZE_IN_DEGREES
+    ):
+        self.geofences = geofences
+        self.cell_size = cell_size
+        inside: dict[Cell, set[int]] = collections.defaultdict(set)
+        boundaries: dict[Cell, list[_Boundary]] = collections.defaultdict(list)
+        for i, fence in enumerate(geofences):
+            self._classify_cells(i, fence, inside, boundaries)
+        self._cells: dict[Cell, _GridCell] = {
+            cell: _GridCell(
+                inside=frozenset(inside.get(cell, ())),
+                boundaries=boundaries.get(cell, []),
+            )
+            for cell in inside.keys() | boundaries.keys()
+        }
+
+        self._inside: dict[int, frozenset[int]] = {}
+        self._truck_cells: dict[int, Cell] = {}
+        self._moved_trucks: dict[int, Truck] = {}
+
+    def mark_moved(self, truck: Truck) -> None:
+        self._moved_trucks[truck.id] = truck
+
+    def initialize(self, trucks: typing.Iterable[Truck]) -> None:
+        """
+        Sets the initial state of the trucks without creating the logs
+        """
+        for truck in trucks:
+            self.mark_moved(truck)
+        self.check()
+
+    def check(self) -> list[Log]:
+        if not self._moved_trucks:
+            return []
+
+        trucks = list(self._moved_trucks.values())
+        self._moved_trucks.clear()
+
+        logs = []
+        for truck in trucks:
+            lat, lon = truck.location.lat, truck.location.lon
+            cell = self._get_cell(lat, lon)
+            grid_cell = self._cells.get(cell)
+            previous_cell = self._truck_cells.get(truck.id)
+            self._truck_cells[truck.id] = cell
+            if grid_cell is None:
+                current = _NOT_INSIDE
+            elif not grid_cell.boundaries:
+                if previous_cell == cell:
+                    # the fences of the truck are the fences of the cell
+                    continue
+                current = grid_cell.inside
+            else:
+                current = grid_cell.inside | {
+                    boundary.fence_index
+                    for boundary in grid_cell.boundaries
+                    if self._is_inside(cell, boundary, lat, lon)
+                }
+
+            previous = self._inside.get(truck.id)
+            self._inside[truck.id] = current
+            if previous is None or previous == current:
+                continue
+
+            for fence_index in current - previous:
+                logs.append(self._get_log(LogType.GEOFENCE_ENTERED, truck, fence_index))
+            for fence_index in previous - current:
+                logs.append(self._get_log(LogType.GEOFENCE_EXITED, truck, fence_index))
+
+        return logs
+
+    def get_geofences_of_truck(self, truck_id: int) -> list[Geofence]:
+        return [self.geofences[i] for i in self._inside.get(truck_id, ())]
+
+    def _get_log(self, type: LogType, truck: Truck, fence_index: int) -> Log:
+        fence = self.geofences[fence_index]
+        return Log.create(
+            type=type,
+            data={
+                "truck_id": truck.id,
+                "geofence_id": fence.id,
+                "geofence_name": fence.name,
+                "geofence_kind": fence.kind,
+                "lat": truck.location.lat,
+                "lon": truck.location.lon,
+            },
+        )
+
+    def _is_inside(
+        self, cell: Cell, boundary: _Boundary, lat: float, lon: float
+    ) -> bool:
+        """
+        Counts the edges crossed by the segment from the reference point of
+        the cell to the point. The vertices on the segment are on its negative
+        side, so the segment through a vertex crosses exactly one of its edges
+        """
+        ref_lat, ref_lon = self._get_reference_point(cell)
+        inside = boundary.is_reference_inside
+        for x1, y1, x2, y2 in boundary.edges:
+            if not (orientation := _orient(x1, y1, x2, y2, lon, lat)):
+                # the point is on the line of the edge, it's tested by the
+                # whole fence, so the points on the edges are resolved the same
+                fence = self.geofences[boundary.fence_index]
+                return bool(fence.contains(array("d", [lat]), array("d", [lon]))[0])
+            if (_orient(x1, y1, x2, y2, ref_lon, ref_lat) > 0) != (
+                orientation > 0
+            ) and (_orient(ref_lon, ref_lat, lon, lat, x1, y1) > 0) != (
+                _orient(ref_lon, ref_lat, lon, lat, x2, y2) > 0
+            ):
+                inside = not inside
+        return inside
+
+    def _classify_cells(
+        self,
+        fence_index: int,
+        fence: Geofence,
+        inside: dict[Cell, set[int]],
+        boundaries: dict[Cell, list[_Boundary]],
+    ) -> None:
+        """
+        Adds the fence to the cells crossed by its edges and to the cells
+        entirely inside it. In a row of the cells the state changes only at
+        the boundary cells, so one point of every run of the other cells is
+        tested
+        """
+        edges_by_cell: dict[Cell, list[Edge]] = collections.defaultdict(list)
+        for ring in fence.rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                for cell in self._get_edge_cells(x1, y1, x2, y2):
+                    edges_by_cell[cell].append((x1, y1, x2, y2))
+
+        boundary_cells = list(edges_by_cell)
+        points = [self._get_reference_point(cell) for cell in boundary_cells]
+        is_inside = fence.contains(
+            array("d", (lat for lat, _ in points)),
+            array("d", (lon for _, lon in points)),
+        )
+        for i, cell in enumerate(boundary_cells):
+            boundaries[cell].append(
+                _Boundary(
+                    fence_index=fence_index,
+                    edges=edges_by_cell[cell],
+                    is_reference_inside=bool(is_inside[i]),
+                )
+            )
+
+        min_cell = self._get_cell(fence.min_lat, fence.min_lon)
+        max_cell = self._get_cell(fence.max_lat, fence.max_lon)
+        runs: list[tuple[int, int, int]] = []
+        for x in range(min_cell[0], max_cell[0] + 1):
+            start = None
+            for y in range(min_cell[1], max_cell[1] + 2):
+                if y <= max_cell[1] and (x, y) not in edges_by_cell:
+                    start = y if start is None else start
+                elif start is not None:
+                    runs.append((x, start, y))
+                    start = None
+        if not runs:
+            return
+
+        points = [self._get_reference_point((x, start)) for x, start, _ in runs]
+        is_inside = fence.contains(
+            array("d", (lat for lat, _ in points)),
+            array("d", (lon for _, lon in points)),
+        )
+        for (x, start, end), is_run_inside in zip(runs, is_inside):
+            if is_run_inside:
+                for y in range(start, end):
+                    inside[(x, y)].add(fence_index)
+
+    def _get_edge_cells(
+        self, x1: float, y1: float, x2: float, y2: float
+    ) -> typing.Iterator[Cell]:
+        """
+        Yields the cells crossed by the edge, row by row: the part of the
+        edge within the latitudes of the row spans the cells of the row
+        """
+        min_row = math.floor((min(y1, y2) - CELL_MARGIN) / self.cell_size)
+        max_row = math.floor((max(y1, y2) + CELL_MARGIN) / self.cell_size)
+        for row in range(min_row, max_row + 1):
+            if y1 == y2:
+                lon1, lon2 = x1, x2
+            else:
+                low = max(row * self.cell_size, min(y1, y2))
+                high = min((row + 1) * self.cell_size, max(y1, y2))
+                lon1 = x1 + (low - y1) * (x2 - x1) / (y2 - y1)
+                lon2 = x1 + (high - y1) * (x2 - x1) / (y2 - y1)
+            min_column = math.floor((min(lon1, lon2) - CELL_MARGIN) / self.cell_size)
+            max_column = math.floor((max(lon1, lon2) + CELL_MARGIN) / self.cell_size)
+            for column in range(min_column, max_column + 1):
+                yield row, column
+
+    def _get_reference_point(self, cell: Cell) -> tuple[float, float]:
+        return (
+            (cell[0] + REFERENCE_POINT_OFFSET[0]) * self.cell_size,
+            (cell[1] + REFERENCE_POINT_OFFSET[1]) * self.cell_size,
+        )
+
+    def _get_cell(self, lat: float, lon: float) -> Cell:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+
+def _orient(x1: float, y1: float, x2: float, y2: float, x: float, y: float) -> float:
+    """
+    Positive when the point is to the left of the line through the points
+    """
+    return (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1)
@@ -1,13 +1,17 @@
 import asyncio
 import logging
 import random
+import typing
 
 from app.simulation.log import Log, LogType
-from app.simulation.route import Route
+from app.simulation.route import Route, RouteStop, StopType
 from app.simulation.truck import Truck
 
 JOURNEY_ID = 0
 
+# delay between the moves of the truck to the next point of the route
+MOVEMENT_DELAY_IN_SECONDS = 0.05
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,8 +28,12 @@ class Journey:
         self.truck = truck
         self.route = route
         self.starting_delay = starting_delay
+        self.route_index = 0
+        # load on board of the truck
+        self.load_weight = 0
+        self._stop_index = 0
         self._progress_percentage = 0.0
-        self._delay = 0.05
+        self._delay = MOVEMENT_DELAY_IN_SECONDS
 
     @classmethod
     def create(
@@ -40,11 +48,37 @@ class Journey:
             starting_delay=starting_delay,
         )
 
-    async def run(self, journey_finished_events: asyncio.Queue):
+    @property
+    def next_stop(self) -> RouteStop | None:
+        stops = self.route.stops
+        return stops[self._stop_index] if self._stop_index < len(stops) else None
+
+    async def run(
+        self,
+        journey_finished_events: asyncio.Queue,
+        on_move: typing.Callable[["Journey"], None] | None = None,
+        on_stop: typing.Callable[["Journey", RouteStop], None] | None = None,
+    ):
         await asyncio.sleep(self.starting_delay)
+        stops = self.route.stops
         for i, lp in enumerate(self.route.location_points):
             self.truck.location = lp
+            self.route_index = i
             self._progress_percentage = (i + 1) / len(self.route.location_points) * 100
+            if on_move:
+                on_move(self)
+            while (
+                self._stop_index < len(stops)
+                and stops[self._stop_index].location_index == i
+            ):
+                stop = stops[self._stop_index]
+                self._stop_index += 1
+                if stop.type == StopType.PICKUP:
+                    self.load_weight += stop.load_weight
+                else:
+                    self.load_weight -= stop.load_weight
+                if on_stop:
+                    on_stop(self, stop)
             # await self._log_movement()
             await asyncio.sleep(self._delay + self._get_jitter())
 
@@ -56,6 +90,23 @@ class Journey:
             f"from {self.route.origin_address}, to {self.route.destination_address}"
         )
 
+    def get_state(self) -> dict[str, typing.Any]:
+        return {
+            "id": self.id,
+            "truck_id": self.truck.id,
+            "origin_address": self.route.origin_address,
+            "destination_address": self.route.destination_address,
+            "expected_duration_in_seconds": self.route.expected_duration_in_seconds,
+            "progress_percentage": round(self._progress_percentage, 2),
+            "load_weight": self.load_weight,
+            "completed_stops": self._stop_index,
+            "stops_number": len(self.route.stops),
+            "location": {
+                "lat": self.truck.location.lat,
+                "lon": self.truck.location.lon,
+            },
+        }
+
     def get_journey_dispatched_domain_log(self):
         return Log.create(
             type=LogType.JOURNEY_DISPATCHED,
@@ -66,6 +117,7 @@ class Journey:
                 "destination_address": self.route.destination_address,
                 "expected_duration_in_seconds": self.route.expected_duration_in_seconds,
                 "route_lines": self.route.location_points,
+                "event_ids": self.get_event_ids(),
             },
         )
 
@@ -77,9 +129,29 @@ class Journey:
                 "truck_id": self.truck.id,
                 "origin_address": self.route.origin_address,
                 "destination_address": self.route.destination_address,
+                "event_ids": self.get_event_ids(),
+                "truck_location": self.truck.location,
+            },
+        )
+
+    def get_stop_domain_log(self, stop: RouteStop):
+        return Log.create(
+            type=LogType.DELIVERY_PICKED_UP
+            if stop.type == StopType.PICKUP
+            else LogType.DELIVERY_DROPPED_OFF,
+            data={
+                "journey_id": self.id,
+                "truck_id": self.truck.id,
+                "event_id": stop.event_id,
+                "address": stop.address,
+                "load_weight": stop.load_weight,
+                "load_weight_on_board": self.load_weight,
             },
         )
 
+    def get_event_ids(self) -> list[int]:
+        return list(dict.fromkeys(stop.event_id for stop in self.route.stops))
+
     def _get_jitter(self) -> float:
         """
         Returns a random value to normalize the distribution of delay for cars
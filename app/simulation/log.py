@@ -1,8 +1,9 @@
+import dataclasses
 import enum
 import typing
 
-from pydantic import BaseModel
-
+from app.diagnostics.tracing import get_current_traceparent
+from app.serialization import dumps, encode_string
 from app.simulation.utils import get_timestamp
 
 
@@ -11,16 +12,39 @@ class LogType(enum.StrEnum):
     JOURNEY_DISPATCHED = enum.auto()
     JOURNEY_FINISHED = enum.auto()
     TRUCK_NOT_FOUND = enum.auto()
+    GEOFENCE_ENTERED = enum.auto()
+    GEOFENCE_EXITED = enum.auto()
+    DELIVERY_REQUEST_SHED = enum.auto()
+    DELIVERY_PICKED_UP = enum.auto()
+    DELIVERY_DROPPED_OFF = enum.auto()
 
     def __str__(self):
         return str(self.name)
 
 
-class Log(BaseModel):
+@dataclasses.dataclass(slots=True)
+class Log:
     type: LogType
     data: dict[str, typing.Any]
     timestamp: int
+    traceparent: str | None = None
 
     @classmethod
     def create(cls, type: LogType, data: dict[str, typing.Any]):
-        return cls(type=type, data=data, timestamp=get_timestamp())
+        return cls(
+            type=type,
+            data=data,
+            timestamp=get_timestamp(),
+            traceparent=get_current_traceparent(),
+        )
+
+    def to_json(self) -> str:
+        """
+        Encodes the log in the format of domain logs topic, the data is
+        stored as the JSON encoded string
+        """
+        return (
+            f'{{"type":"{self.type.value}",'
+            f'"data":{encode_string(dumps(self.data))},'
+            f'"timestamp":{self.timestamp}}}'
+        )
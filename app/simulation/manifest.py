@@ -0,0 +1,176 @@
+"""
+Loads the fleet from the manifest file, one truck per row. Supported formats
+are CSV with the header, JSON Lines and Parquet, the columns are:
+
+    id        optional, the id of the truck, generated when it's empty
+    depot     address of the depot where the truck starts
+    lat, lon  optional, the coordinates of the truck, take precedence over
+              the depot address, so the depot is not geocoded
+    capacity  optional, max load weight of the truck in kg
+
+The file is streamed into the compact arrays, the unique depot addresses are
+geocoded in bulk, then the trucks and the indexes are built in one pass
+"""
+import concurrent.futures
+import csv
+import os
+import typing
+from array import array
+
+from app.clients.maps import LocationPoint, MapsClient
+from app.serialization import loads
+from app.simulation.fleet import Fleet
+from app.simulation.registry import JourneyRegistry
+from app.simulation.truck import (
+    Truck,
+    get_next_truck_id,
+    get_truck_color,
+    skip_truck_ids,
+)
+
+DEFAULT_CAPACITY = 1000
+
+GEOCODING_WORKERS_NUMBER = 8
+
+# marks the missing values in the arrays
+_MISSING_ID = -1
+_MISSING_DEPOT = -1
+
+
+class FleetManifestError(Exception):
+    pass
+
+
+def iter_manifest_rows(path: str) -> typing.Iterator[dict[str, typing.Any]]:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".parquet":
+        yield from _iter_parquet_rows(path)
+        return
+
+    with open(path, newline="") as f:
+        if extension == ".csv":
+            yield from csv.DictReader(f)
+        elif extension in (".jsonl", ".ndjson"):
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+        else:
+            raise FleetManifestError(f"Unsupported fleet manifest format of {path}")
+
+
+def _iter_parquet_rows(path: str) -> typing.Iterator[dict[str, typing.Any]]:
+    """
+    Streams the rows by the record batches, pyarrow is imported only for the
+    Parquet manifests
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    try:
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    except pyarrow.ArrowException as e:
+        raise FleetManifestError(f"Invalid Parquet fleet manifest {path}: {e}") from e
+
+
+class _Columns:
+    """
+    Rows of the manifest kept as the arrays, so a large manifest takes
+    a few dozen bytes per truck until the trucks are built
+    """
+
+    def __init__(self) -> None:
+        self.ids = array("q")
+        self.depot_indexes = array("q")
+        self.lats = array("d")
+        self.lons = array("d")
+        self.capacities = array("q")
+        self.depots: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, row: dict[str, typing.Any], line: int) -> None:
+        try:
+            id_ = _get_value(row, "id")
+            capacity = _get_value(row, "capacity")
+            lat, lon = _get_value(row, "lat"), _get_value(row, "lon")
+            depot = (row.get("depot") or "").strip()
+
+            if id_ is not None and int(id_) < 0:
+                raise FleetManifestError(f"id {id_} is negative")
+            if lat is not None and lon is not None:
+                if not (-90 <= float(lat) <= 90 and -180 <= float(lon) <= 180):
+                    raise FleetManifestError(f"coordinates {lat}, {lon} are invalid")
+            elif not depot:
+                raise FleetManifestError("depot or lat/lon must be specified")
+
+            capacity = int(capacity) if capacity is not None else DEFAULT_CAPACITY
+            self.ids.append(int(id_) if id_ is not None else _MISSING_ID)
+            self.capacities.append(capacity)
+            if lat is not None and lon is not None:
+                self.lats.append(float(lat))
+                self.lons.append(float(lon))
+                self.depot_indexes.append(_MISSING_DEPOT)
+            else:
+                self.lats.append(0)
+                self.lons.append(0)
+                self.depot_indexes.append(
+                    self.depots.setdefault(depot, len(self.depots))
+                )
+        except (TypeError, ValueError, FleetManifestError) as e:
+            raise FleetManifestError(f"Invalid fleet manifest row {line}: {e}") from e
+
+
+def _get_value(row: dict[str, typing.Any], name: str) -> typing.Any:
+    """
+    Returns None for the missing and the empty values, CSV has no nulls
+    """
+    value = row.get(name)
+    return None if value is None or value == "" else value
+
+
+def load_fleet(path: str, maps_client: MapsClient) -> tuple[Fleet, JourneyRegistry]:
+    columns = _Columns()
+    for line, row in enumerate(iter_manifest_rows(path), start=1):
+        columns.append(row, line)
+
+    depot_locations = _geocode(list(columns.depots), maps_client)
+    # the generated ids follow the explicit ones
+    skip_truck_ids(max(columns.ids, default=_MISSING_ID))
+
+    trucks: list[Truck] = []
+    registry = JourneyRegistry()
+    for i in range(len(columns)):
+        if (depot_index := columns.depot_indexes[i]) != _MISSING_DEPOT:
+            # the trucks of the depot share the location until they move
+            location = depot_locations[depot_index]
+        else:
+            location = LocationPoint(lat=columns.lats[i], lon=columns.lons[i])
+
+        id_ = columns.ids[i] if columns.ids[i] != _MISSING_ID else get_next_truck_id()
+        if registry.get_truck(id_) is not None:
+            raise FleetManifestError(f"Duplicate truck id {id_} in the fleet manifest")
+
+        # the values are already validated, so the model validation is skipped
+        truck = Truck.model_construct(
+            id=id_,
+            color=get_truck_color(id_),
+            location=location,
+            in_journey=False,
+            max_load_weight=columns.capacities[i],
+        )
+        trucks.append(truck)
+        registry.add_truck(truck)
+
+    return Fleet(trucks=trucks, maps_client=maps_client), registry
+
+
+def _geocode(addresses: list[str], maps_client: MapsClient) -> list[LocationPoint]:
+    if not addresses:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(GEOCODING_WORKERS_NUMBER, len(addresses))
+    ) as executor:
+        return list(executor.map(maps_client.get_location, addresses))
@@ -0,0 +1,181 @@
+import collections
+import math
+import typing
+
+from app.clients.maps import LocationPoint, get_distance_in_meters
+from app.simulation.journey import Journey
+from app.simulation.truck import Truck
+from app.simulation.utils import get_city
+
+# ~5.5 km along the meridian
+GRID_CELL_SIZE_IN_DEGREES = 0.05
+
+METERS_PER_DEGREE_OF_LATITUDE = 111_320
+
+Cell = tuple[int, int]
+
+
+class JourneyRegistry:
+    """
+    Keeps the active journeys and all trucks indexed by id, truck,
+    origin/destination city and the location of the truck. Indexes are
+    updated incrementally when the journeys are added/removed and when
+    the trucks move
+    """
+
+    def __init__(
+        self,
+        trucks: typing.Iterable[Truck] = (),
+        cell_size: float = GRID_CELL_SIZE_IN_DEGREES,
+    ):
+        self.cell_size = cell_size
+        self._journeys: dict[int, Journey] = {}
+        self._journeys_by_truck: dict[int, Journey] = {}
+        self._journeys_by_origin: dict[str, set[int]] = collections.defaultdict(set)
+        self._journeys_by_destination: dict[str, set[int]] = collections.defaultdict(
+            set
+        )
+        self._trucks: dict[int, Truck] = {}
+        self._truck_cells: dict[int, Cell] = {}
+        self._cells: dict[Cell, set[int]] = collections.defaultdict(set)
+
+        for truck in trucks:
+            self.add_truck(truck)
+
+    def __len__(self) -> int:
+        return len(self._journeys)
+
+    def __iter__(self) -> typing.Iterator[Journey]:
+        return iter(list(self._journeys.values()))
+
+    def add_truck(self, truck: Truck) -> None:
+        self._trucks[truck.id] = truck
+        self.update_truck_location(truck)
+
+    def update_truck_location(self, truck: Truck) -> None:
+        cell = self._get_cell(truck.location.lat, truck.location.lon)
+        if (previous_cell := self._truck_cells.get(truck.id)) == cell:
+            return
+
+        if previous_cell is not None:
+            self._cells[previous_cell].discard(truck.id)
+            if not self._cells[previous_cell]:
+                del self._cells[previous_cell]
+
+        self._cells[cell].add(truck.id)
+        self._truck_cells[truck.id] = cell
+
+    def add_journey(self, journey: Journey) -> None:
+        self._journeys[journey.id] = journey
+        self._journeys_by_truck[journey.truck.id] = journey
+        if origin := get_city(journey.route.origin_address):
+            self._journeys_by_origin[origin].add(journey.id)
+        if destination := get_city(journey.route.destination_address):
+            self._journeys_by_destination[destination].add(journey.id)
+
+    def remove_journey(self, journey: Journey) -> None:
+        self._journeys.pop(journey.id, None)
+        if self._journeys_by_truck.get(journey.truck.id) is journey:
+            del self._journeys_by_truck[journey.truck.id]
+        for index, address in [
+            (self._journeys_by_origin, journey.route.origin_address),
+            (self._journeys_by_destination, journey.route.destination_address),
+        ]:
+            if (city := get_city(address)) and city in index:
+                index[city].discard(journey.id)
+                if not index[city]:
+                    del index[city]
+
+    def get_journey(self, journey_id: int) -> Journey | None:
+        return self._journeys.get(journey_id)
+
+    def get_journey_by_truck(self, truck_id: int) -> Journey | None:
+        return self._journeys_by_truck.get(truck_id)
+
+    def find_journeys(
+        self, origin: str | None = None, destination: str | None = None
+    ) -> list[Journey]:
+        """
+        Returns the journeys (sorted by id) from the origin and/or to the
+        destination city, addresses are matched by the city
+        """
+        journey_ids: set[int] | None = None
+        for index, address in [
+            (self._journeys_by_origin, origin),
+            (self._journeys_by_destination, destination),
+        ]:
+            if address is None:
+                continue
+            ids = index.get(get_city(address) or "", set())
+            journey_ids = ids if journey_ids is None else journey_ids & ids
+
+        if journey_ids is None:
+            return list(self._journeys.values())
+
+        return [self._journeys[i] for i in sorted(journey_ids)]
+
+    def get_truck(self, truck_id: int) -> Truck | None:
+        return self._trucks.get(truck_id)
+
+    def get_trucks(self) -> list[Truck]:
+        return list(self._trucks.values())
+
+    def find_trucks_in_bbox(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> list[Truck]:
+        """
+        Returns the trucks (sorted by id) inside the bounding box
+        """
+        min_cell = self._get_cell(min_lat, min_lon)
+        max_cell = self._get_cell(max_lat, max_lon)
+        cells_number = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+
+        truck_ids: typing.Iterable[int]
+        if cells_number > len(self._cells):
+            truck_ids = (
+                truck_id
+                for cell, ids in self._cells.items()
+                if min_cell[0] <= cell[0] <= max_cell[0]
+                and min_cell[1] <= cell[1] <= max_cell[1]
+                for truck_id in ids
+            )
+        else:
+            truck_ids = (
+                truck_id
+                for x in range(min_cell[0], max_cell[0] + 1)
+                for y in range(min_cell[1], max_cell[1] + 1)
+                for truck_id in self._cells.get((x, y), ())
+            )
+
+        trucks = []
+        for truck_id in truck_ids:
+            truck = self._trucks[truck_id]
+            if (
+                min_lat <= truck.location.lat <= max_lat
+                and min_lon <= truck.location.lon <= max_lon
+            ):
+                trucks.append(truck)
+
+        return sorted(trucks, key=lambda tr: tr.id)
+
+    def find_trucks_in_radius(
+        self, location: LocationPoint, radius_in_meters: float
+    ) -> list[Truck]:
+        """
+        Returns the trucks (sorted by id) within the radius from the location
+        """
+        lat_delta = radius_in_meters / METERS_PER_DEGREE_OF_LATITUDE
+        lon_delta = lat_delta / max(math.cos(math.radians(location.lat)), 1e-6)
+        return [
+            truck
+            for truck in self.find_trucks_in_bbox(
+                location.lat - lat_delta,
+                location.lon - lon_delta,
+                location.lat + lat_delta,
+                location.lon + lon_delta,
+            )
+            if get_distance_in_meters(truck.location, location) <= radius_in_meters
+        ]
+
+    def _get_cell(self, lat: float, lon: float) -> Cell:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
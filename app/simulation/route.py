@@ -1,11 +1,27 @@
 from __future__ import annotations
 
+import enum
+
 from pydantic import BaseModel
 
 from app.clients.maps import LocationPoint, MapsClient
 from app.simulation.truck import Truck
 
 
+class StopType(enum.StrEnum):
+    PICKUP = enum.auto()
+    DROPOFF = enum.auto()
+
+
+class RouteStop(BaseModel):
+    type: StopType
+    event_id: int
+    address: str
+    load_weight: int
+    # index of the location point of the route where the stop is reached
+    location_index: int = 0
+
+
 class Route(BaseModel):
     origin_address: str | None = None
     origin_location: LocationPoint | None = None
@@ -13,17 +29,37 @@ class Route(BaseModel):
     destination_location: LocationPoint | None = None
     location_points: list[LocationPoint]
     expected_duration_in_seconds: int
+    stops: list[RouteStop] = []
 
     @staticmethod
-    def combine_routes(r1: Route, r2: Route) -> Route:
+    def combine_routes(*routes: Route) -> Route:
+        """
+        Chains the legs into one route, the stops of the legs are shifted
+        to the location points of the combined route
+        """
+        location_points: list[LocationPoint] = []
+        stops: list[RouteStop] = []
+        for route in routes:
+            stops.extend(
+                stop.model_copy(
+                    update={
+                        "location_index": stop.location_index + len(location_points)
+                    }
+                )
+                for stop in route.stops
+            )
+            location_points.extend(route.location_points)
+
         return Route(
-            origin_address=r1.origin_address,
-            origin_location=r1.origin_location,
-            destination_address=r2.destination_address,
-            destination_location=r2.destination_location,
-            location_points=[*r1.location_points, *r2.location_points],
-            expected_duration_in_seconds=r1.expected_duration_in_seconds
-            + r2.expected_duration_in_seconds,
+            origin_address=routes[0].origin_address,
+            origin_location=routes[0].origin_location,
+            destination_address=routes[-1].destination_address,
+            destination_location=routes[-1].destination_location,
+            location_points=location_points,
+            expected_duration_in_seconds=sum(
+                route.expected_duration_in_seconds for route in routes
+            ),
+            stops=stops,
         )
 
     @classmethod
@@ -42,7 +78,7 @@ class Route(BaseModel):
             origin_location=origin_location,
             destination_location=destination_location,
         )
-        return cls(**route_response.model_dump())
+        return cls(**dict(route_response))
 
     @classmethod
     def from_truck_location_origin_and_destination(
@@ -65,3 +101,43 @@ class Route(BaseModel):
         )
 
         return Route.combine_routes(truck_to_origin_route, origin_to_destination_route)
+
+    @classmethod
+    def from_truck_location_and_stops(
+        cls,
+        maps_client: MapsClient,
+        truck: Truck,
+        stops: list[RouteStop],
+    ) -> Route:
+        """
+        Builds the route from the truck location through the pickups and
+        drop-offs in the given order. Consecutive stops at the same address
+        share the leg, the legs between the addresses are cached by the
+        Maps client, so the corridors driven before are not requested again
+        """
+        legs: list[Route] = []
+        previous_address: str | None = None
+        for stop in stops:
+            if stop.address == previous_address:
+                legs[-1].stops.append(
+                    stop.model_copy(
+                        update={"location_index": len(legs[-1].location_points) - 1}
+                    )
+                )
+                continue
+
+            leg = cls.from_origin_and_destination(
+                maps_client=maps_client,
+                origin_address=previous_address,
+                origin_location=truck.location if previous_address is None else None,
+                destination_address=stop.address,
+            )
+            leg.stops = [
+                stop.model_copy(update={"location_index": len(leg.location_points) - 1})
+            ]
+            legs.append(leg)
+            previous_address = stop.address
+
+        route = cls.combine_routes(*legs)
+        route.origin_address = stops[0].address
+        return route
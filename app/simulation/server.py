@@ -1,40 +1,68 @@
-import asyncio
-
 from app.clients.maps import MapsClient
 from app.clients.pub_sub import PubSubClient
-from app.simulation.event import Event
+from app.clients.sink import ColumnarSink
+from app.config import (
+    BACKLOG_TTL_IN_SECONDS,
+    FLEET_MANIFEST_PATH,
+    GEOFENCES_FILE,
+    JOURNEY_MAX_DELIVERIES,
+    LOCAL_SINK_DIR,
+    TTS_WORKERS_NUMBER,
+)
+from app.simulation.backlog import PendingRequestsBacklog
+from app.simulation.consolidation import ConsolidationPlanner
+from app.simulation.events_queue import EventsQueue
 from app.simulation.fleet import Fleet
+from app.simulation.geofence import GeofenceEngine, load_geofences
+from app.simulation.manifest import load_fleet
+from app.simulation.registry import JourneyRegistry
 from app.simulation.truck import Truck
 from app.simulation.tts import TTS
 
 
-async def serve_tts(events_queue: asyncio.Queue[Event]):
+def create_tts(events_queue: EventsQueue) -> TTS:
     maps_client = MapsClient()
 
     # service file for the service account will be already bind to the Cloud Run instance
-    pub_sub_client = PubSubClient.create(service_file=None)
+    pub_sub_client = PubSubClient.create(
+        service_file=None,
+        sink=ColumnarSink(LOCAL_SINK_DIR) if LOCAL_SINK_DIR else None,
+    )
 
-    trucks = [
-        Truck.create(
-            location=maps_client.get_location("Vilnius, Lithuania"),
-            max_load_weight=5000,
-        ),
-        Truck.create(
-            location=maps_client.get_location("Kaunas, Lithuania"),
-            max_load_weight=10000,
-        ),
-        Truck.create(
-            location=maps_client.get_location("Klaipeda, Lithuania"),
-            max_load_weight=15000,
-        ),
-    ]
+    if FLEET_MANIFEST_PATH:
+        fleet, journeys = load_fleet(FLEET_MANIFEST_PATH, maps_client)
+    else:
+        trucks = [
+            Truck.create(
+                location=maps_client.get_location("Vilnius, Lithuania"),
+                max_load_weight=5000,
+            ),
+            Truck.create(
+                location=maps_client.get_location("Kaunas, Lithuania"),
+                max_load_weight=10000,
+            ),
+            Truck.create(
+                location=maps_client.get_location("Klaipeda, Lithuania"),
+                max_load_weight=15000,
+            ),
+        ]
+        fleet = Fleet(trucks=trucks, maps_client=maps_client)
+        journeys = JourneyRegistry(trucks=trucks)
 
-    fleet = Fleet(trucks=trucks)
-    tts = TTS(
+    return TTS(
         maps_client=maps_client,
         pub_sub_client=pub_sub_client,
         events_queue=events_queue,
         fleet=fleet,
-        journeys=[],
+        journeys=journeys,
+        geofence_engine=GeofenceEngine(load_geofences(GEOFENCES_FILE))
+        if GEOFENCES_FILE
+        else None,
+        workers_number=TTS_WORKERS_NUMBER,
+        backlog=PendingRequestsBacklog(ttl_in_seconds=BACKLOG_TTL_IN_SECONDS),
+        planner=ConsolidationPlanner(max_deliveries=JOURNEY_MAX_DELIVERIES),
     )
-    await tts.run()
+
+
+async def serve_tts(events_queue: EventsQueue):
+    await create_tts(events_queue).run()
@@ -0,0 +1,242 @@
+import asyncio
+import collections
+import logging
+import math
+import time
+import typing
+
+from app.serialization import dumps, encode_string
+from app.simulation.truck import Truck
+from app.simulation.utils import get_timestamp
+
+logger = logging.getLogger(__name__)
+
+GRID_CELL_SIZE_IN_DEGREES = 0.1
+
+TICK_INTERVAL_IN_SECONDS = 0.1
+MIN_FRAME_INTERVAL_IN_SECONDS = 0.5
+KEEPALIVE_INTERVAL_IN_SECONDS = 15
+MAX_SUBSCRIBERS = 1000
+SUBSCRIPTIONS_CHUNK_SIZE = 50
+
+Cell = tuple[int, int]
+
+# truck id, encoded position, lat, lon
+Move = tuple[int, str, float, float]
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+class Viewport(typing.NamedTuple):
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+
+class Subscription:
+    """
+    Position updates of a single client. Pending updates are conflated by the
+    truck, so a slow client gets only the latest position of each truck and
+    its buffer is bounded by the number of trucks in the viewport
+    """
+
+    def __init__(self, viewport: Viewport, min_frame_interval: float):
+        self.viewport = viewport
+        self.min_frame_interval = min_frame_interval
+        # truck id -> encoded position or None when the truck left the viewport
+        self.pending: dict[int, str | None] = {}
+        self.visible: set[int] = set()
+        self.has_pending = asyncio.Event()
+        self.last_frame_time = 0.0
+
+    def update(self, moves: typing.Iterable[Move]) -> None:
+        min_lat, min_lon, max_lat, max_lon = self.viewport
+        pending, visible = self.pending, self.visible
+        is_updated = False
+        for truck_id, position, lat, lon in moves:
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                pending[truck_id] = position
+                visible.add(truck_id)
+            elif truck_id in visible:
+                pending[truck_id] = None
+                visible.discard(truck_id)
+            else:
+                continue
+            is_updated = True
+
+        if is_updated:
+            self.has_pending.set()
+
+    def pop_frame(self) -> str:
+        """
+        Returns the SSE frame with all the pending updates
+        """
+        positions = []
+        removed = []
+        for truck_id, position in self.pending.items():
+            if position is None:
+                removed.append(truck_id)
+            else:
+                positions.append(position)
+        self.pending = {}
+        self.has_pending.clear()
+        self.last_frame_time = time.monotonic()
+
+        return (
+            "event: positions\n"
+            f'data: {{"timestamp":{get_timestamp()},'
+            f'"positions":[{",".join(positions)}],"removed":{dumps(removed)}}}\n\n'
+        )
+
+
+class PositionStreamHub:
+    """
+    Fans out the positions of the moved trucks to the subscribed clients.
+    Moves are collected between the ticks, each position is encoded once per
+    tick and dispatched only to the clients whose viewport covers its grid
+    cell, so the per-move cost in Journey.run is a single dict assignment
+    """
+
+    def __init__(
+        self,
+        cell_size: float = GRID_CELL_SIZE_IN_DEGREES,
+        tick_interval: float = TICK_INTERVAL_IN_SECONDS,
+        max_subscribers: int = MAX_SUBSCRIBERS,
+    ):
+        self.cell_size = cell_size
+        self.tick_interval = tick_interval
+        self.max_subscribers = max_subscribers
+        self._moved_trucks: dict[int, Truck] = {}
+        self._subscriptions: set[Subscription] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def mark_moved(self, truck: Truck) -> None:
+        if self._subscriptions:
+            self._moved_trucks[truck.id] = truck
+
+    def subscribe(
+        self,
+        viewport: Viewport,
+        trucks: typing.Iterable[Truck] = (),
+        min_frame_interval: float = MIN_FRAME_INTERVAL_IN_SECONDS,
+    ) -> Subscription:
+        """
+        Creates the subscription with the given trucks (already filtered by
+        the viewport) as the initial snapshot
+        """
+        if len(self._subscriptions) >= self.max_subscribers:
+            raise TooManySubscribersError(
+                f"Max number of subscribers {self.max_subscribers} is reached"
+            )
+
+        subscription = Subscription(viewport, min_frame_interval)
+        subscription.update(
+            (tr.id, self._encode_position(tr), tr.location.lat, tr.location.lon)
+            for tr in trucks
+        )
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    async def run(self):
+        while True:
+            try:
+                await self.dispatch()
+            except Exception:
+                logger.exception("Failed to dispatch positions")
+            await asyncio.sleep(self.tick_interval)
+
+    async def dispatch(self) -> None:
+        """
+        Dispatches the moves since the previous tick, yields to the event loop
+        after every chunk of subscriptions to keep the loop responsive
+        """
+        if not self._moved_trucks:
+            return
+
+        trucks = list(self._moved_trucks.values())
+        self._moved_trucks.clear()
+
+        moves: dict[int, Move] = {}
+        moves_by_cell: dict[Cell, list[Move]] = collections.defaultdict(list)
+        for truck in trucks:
+            lat, lon = truck.location.lat, truck.location.lon
+            move = (truck.id, self._encode_position(truck), lat, lon)
+            moves[truck.id] = move
+            moves_by_cell[self._get_cell(lat, lon)].append(move)
+
+        for i, subscription in enumerate(list(self._subscriptions), start=1):
+            # visible trucks may have left the viewport to any cell
+            subscription.update(
+                [
+                    moves[truck_id]
+                    for truck_id in subscription.visible
+                    if truck_id in moves
+                ]
+            )
+            for cell in self._get_viewport_cells(subscription.viewport, moves_by_cell):
+                subscription.update(moves_by_cell[cell])
+            if i % SUBSCRIPTIONS_CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+
+    def _get_viewport_cells(
+        self, viewport: Viewport, moves_by_cell: dict[Cell, list[Move]]
+    ) -> list[Cell]:
+        min_cell = self._get_cell(viewport.min_lat, viewport.min_lon)
+        max_cell = self._get_cell(viewport.max_lat, viewport.max_lon)
+        cells_number = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+        if cells_number > len(moves_by_cell):
+            return [
+                cell
+                for cell in moves_by_cell
+                if min_cell[0] <= cell[0] <= max_cell[0]
+                and min_cell[1] <= cell[1] <= max_cell[1]
+            ]
+        return [
+            (x, y)
+            for x in range(min_cell[0], max_cell[0] + 1)
+            for y in range(min_cell[1], max_cell[1] + 1)
+            if (x, y) in moves_by_cell
+        ]
+
+    def _encode_position(self, truck: Truck) -> str:
+        # formatted directly, float repr is the same as in the JSON encoder
+        return (
+            f'{{"id":{truck.id},"lat":{truck.location.lat!r},'
+            f'"lon":{truck.location.lon!r},"color":{encode_string(truck.color)},'
+            f'"in_journey":{"true" if truck.in_journey else "false"}}}'
+        )
+
+    def _get_cell(self, lat: float, lon: float) -> Cell:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+
+async def stream_frames(
+    subscription: Subscription,
+    keepalive_interval: float = KEEPALIVE_INTERVAL_IN_SECONDS,
+) -> typing.AsyncIterator[str]:
+    """
+    Yields the SSE frames of the subscription, not more often than its min
+    frame interval, with the keepalive comments when there are no updates
+    """
+    while True:
+        try:
+            await asyncio.wait_for(
+                subscription.has_pending.wait(), timeout=keepalive_interval
+            )
+        except asyncio.TimeoutError:
+            yield ": keepalive\n\n"
+            continue
+
+        delay = subscription.last_frame_time + subscription.min_frame_interval
+        if (delay := delay - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+        yield subscription.pop_frame()
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import colorsys
 import typing
 
 from pydantic import BaseModel
@@ -15,6 +16,34 @@ COLOR_MAP = [
 
 TRUCK_ID = 0
 
+# hue step between the generated colors, the golden ratio conjugate spreads
+# the hues of the consecutive ids evenly around the color wheel
+COLOR_HUE_STEP = 0.618033988749895
+
+
+def get_truck_color(id_: int) -> str:
+    if 0 <= id_ < len(COLOR_MAP):
+        return COLOR_MAP[id_]
+
+    r, g, b = colorsys.hsv_to_rgb((id_ * COLOR_HUE_STEP) % 1, 0.8, 0.9)
+    return f"#{int(r * 255):02x}{int(g * 255):02x}{int(b * 255):02x}"
+
+
+def get_next_truck_id() -> int:
+    global TRUCK_ID
+    id_ = TRUCK_ID
+    TRUCK_ID += 1
+    return id_
+
+
+def skip_truck_ids(last_id: int) -> None:
+    """
+    Makes the trucks created later get the ids after the last id, which
+    was assigned explicitly
+    """
+    global TRUCK_ID
+    TRUCK_ID = max(TRUCK_ID, last_id + 1)
+
 
 class Truck(BaseModel):
     id: int
@@ -25,12 +54,10 @@ class Truck(BaseModel):
 
     @classmethod
     def create(cls, location: LocationPoint, max_load_weight: int = 1000) -> Truck:
-        global TRUCK_ID
-        id_ = TRUCK_ID
-        TRUCK_ID += 1
+        id_ = get_next_truck_id()
         return cls(
             id=id_,
-            color=COLOR_MAP[id_],
+            color=get_truck_color(id_),
             location=location,
             max_load_weight=max_load_weight,
         )
@@ -1,15 +1,29 @@
 import asyncio
 import logging
+import time
 from typing import Callable
 
-from app.clients.maps import MapsClient
+from app.clients.maps import LocationPoint, MapsClient
 from app.clients.pub_sub import PubSubClient
+from app.diagnostics.tracing import SpanContext, traced, tracer
+from app.simulation.backlog import PendingRequest, PendingRequestsBacklog
+from app.simulation.consolidation import (
+    ConsolidationPlanner,
+    Delivery,
+    get_direct_stops,
+)
+from app.simulation.eta import EtaService
 from app.simulation.event import DeliveryRequestEvent, Event
+from app.simulation.events_queue import EventsQueue
 from app.simulation.fleet import Fleet
-from app.simulation.journey import Journey
+from app.simulation.geofence import GeofenceEngine
+from app.simulation.journey import MOVEMENT_DELAY_IN_SECONDS, Journey
 from app.simulation.log import Log, LogType
-from app.simulation.route import Route
+from app.simulation.registry import JourneyRegistry
+from app.simulation.route import Route, RouteStop
+from app.simulation.streaming import PositionStreamHub
 from app.simulation.truck import Truck
+from app.simulation.utils import get_timestamp
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,49 +34,124 @@ class TTS:
         self,
         maps_client: MapsClient,
         pub_sub_client: PubSubClient,
-        events_queue: asyncio.Queue[Event],
+        events_queue: EventsQueue,
         fleet: Fleet,
-        journeys: list[Journey],
+        journeys: JourneyRegistry,
+        geofence_engine: GeofenceEngine | None = None,
+        position_stream: PositionStreamHub | None = None,
+        workers_number: int = 1,
+        backlog: PendingRequestsBacklog | None = None,
+        planner: ConsolidationPlanner | None = None,
+        eta_service: EtaService | None = None,
     ):
         self.maps_client = maps_client
         self.pub_sub_client = pub_sub_client
         self.events_queue = events_queue
+        self.events_queue.on_shed = self._on_event_shed
         self.fleet = fleet
         self.journeys = journeys
+        self.geofence_engine = geofence_engine
+        self.position_stream = position_stream or PositionStreamHub()
+        self.workers_number = workers_number
+        # requests without a free truck wait here until a truck is released
+        self.backlog = backlog
+        # packs the backlog requests along the way into the dispatched journey
+        self.planner = planner or ConsolidationPlanner()
+        self.eta_service = eta_service or EtaService()
 
         self._journey_finished_queue: asyncio.Queue[Journey] = asyncio.Queue()
+        # trucks freed while the locations of the event are geocoded before
+        # adding it to the backlog, by the event id
+        self._freed_trucks: dict[int, dict[int, Truck]] = {}
 
     async def run(self):
         logger.info("Starting serving TTS")
-        await asyncio.gather(
-            *[
-                self._listen_events_queue(),
-                self._listen_journey_finished_queue(),
-                self._log_tts_state(),
-                self.pub_sub_client.flush_domain_logs(),
-            ]
-        )
+        tasks = [
+            *[self._listen_events_queue() for _ in range(self.workers_number)],
+            self._listen_journey_finished_queue(),
+            self._log_tts_state(),
+            self.pub_sub_client.flush_domain_logs(),
+            self.pub_sub_client.flush_telemetry(),
+            self.position_stream.run(),
+            self.eta_service.run(),
+        ]
+        if self.geofence_engine:
+            tasks.append(self._check_geofences(self.geofence_engine))
+        if self.pub_sub_client.sink:
+            tasks.append(self.pub_sub_client.sink.run())
+        if self.backlog is not None:
+            tasks.append(self._expire_backlog(self.backlog))
+        await asyncio.gather(*tasks)
 
     async def _listen_events_queue(self):
         while True:
             event = await self.events_queue.get()
-            await self.handle_event(event)
+            try:
+                await self.handle_event(event)
+            except Exception:
+                logger.exception(f"Failed to handle event with id {event.id}")
 
     async def _listen_journey_finished_queue(self):
         while True:
             journey = await self._journey_finished_queue.get()
-            journey.truck.in_journey = False
+            self.fleet.finish_journey(journey.truck)
+            self._on_truck_freed(journey.truck)
+            self.pub_sub_client.stop_track(journey.truck.id)
             logger.info(f"Finished {journey.get_info()}")
-            self.journeys.remove(journey)
+            self.journeys.remove_journey(journey)
+            self.eta_service.remove_journey(journey)
             await self.pub_sub_client.add_domain_log(
                 journey.get_journey_finished_domain_log()
             )
+            if self.backlog is not None:
+                self._dispatch_from_backlog(self.backlog, journey.truck)
+
+    def _dispatch_from_backlog(self, backlog: PendingRequestsBacklog, truck: Truck):
+        if not self.fleet.reserve_truck(truck):
+            return
+        if not (event := backlog.pop_for_truck(truck)):
+            self.fleet.release_truck(truck)
+            self._on_truck_freed(truck)
+            return
+
+        logger.info(f"Dispatching backlog event with id {event.id} to truck {truck.id}")
+        asyncio.create_task(self._dispatch_backlog_event(event, truck))
+
+    async def _dispatch_backlog_event(self, event: DeliveryRequestEvent, truck: Truck):
+        try:
+            with tracer.start_span(
+                "tts.dispatch_backlog_event",
+                parent=SpanContext.from_traceparent(event.traceparent),
+                attributes={"event_id": event.id, "truck_id": truck.id},
+            ):
+                await self._dispatch_journey(event, truck)
+        except Exception:
+            logger.exception(f"Failed to dispatch backlog event with id {event.id}")
+
+    async def _expire_backlog(self, backlog: PendingRequestsBacklog):
+        while True:
+            for event in backlog.pop_expired():
+                logger.info(f"Backlog event with id {event.id} expired")
+                await self.pub_sub_client.add_domain_log(
+                    self.fleet.get_truck_not_found_domain_log(event)
+                )
+            await asyncio.sleep(1)
+
+    async def _check_geofences(self, geofence_engine: GeofenceEngine):
+        geofence_engine.initialize(self.journeys.get_trucks())
+        while True:
+            for log in geofence_engine.check():
+                await self.pub_sub_client.add_domain_log(log)
+            await asyncio.sleep(MOVEMENT_DELAY_IN_SECONDS)
 
     async def _log_tts_state(self):
         while True:
             data = {
                 "number_of_journeys": len(self.journeys),
                 "fleet": self.fleet.get_info(),
+                "events_queue": self.events_queue.get_info(),
+                "backlog_size": len(self.backlog) if self.backlog is not None else 0,
+                "eta_summary": self.eta_service.get_summary(),
             }
             logger.info(f"TTS state: {data}")
             await self.pub_sub_client.add_domain_log(
@@ -73,13 +162,51 @@ class TTS:
             )
             await asyncio.sleep(5)
 
+    def _on_event_shed(self, event: Event, reason: str):
+        logger.warning(f"Shed event with id {event.id}, reason: {reason}")
+        self.pub_sub_client.add_domain_log_nowait(
+            Log(
+                type=LogType.DELIVERY_REQUEST_SHED,
+                data={
+                    "event_id": event.id,
+                    "reason": reason,
+                    **event.model_dump(
+                        include={
+                            "priority",
+                            "created_at",
+                            "deadline",
+                            "origin_address",
+                            "destination_address",
+                            "load_weight",
+                        }
+                    ),
+                },
+                timestamp=get_timestamp(),
+                traceparent=event.traceparent,
+            )
+        )
+
     async def handle_event(self, event: Event):
         handlers_map: dict[type[Event], Callable] = {
             DeliveryRequestEvent: self._handle_delivery_request,
         }
 
+        parent = SpanContext.from_traceparent(event.traceparent)
+        tracer.record_span(
+            "tts.events_queue",
+            start_time_ns=event.created_at * 1_000_000,
+            end_time_ns=time.time_ns(),
+            parent=parent,
+            attributes={"event_id": event.id},
+        )
+
         if handler := handlers_map.get(event.__class__, None):
-            await handler(event)
+            with tracer.start_span(
+                "tts.handle_event",
+                parent=parent,
+                attributes={"event_id": event.id, "event_type": type(event).__name__},
+            ):
+                await handler(event)
         else:
             logger.warning("Unknown event", event)
 
@@ -87,14 +214,46 @@ class TTS:
         logger.info(f"Handling delivery request event with id {event.id}")
 
         if not (truck := await self.fleet.select_truck_for_delivery(event)):
-            await self.pub_sub_client.add_domain_log(
-                self.fleet.get_truck_not_found_domain_log(event)
-            )
+            if not await self._add_to_backlog(event):
+                await self.pub_sub_client.add_domain_log(
+                    self.fleet.get_truck_not_found_domain_log(event)
+                )
             return
 
         logger.info(f"Found truck {truck.id} for handling event")
+        await self._dispatch_journey(event, truck)
+
+    async def _add_to_backlog(self, event: DeliveryRequestEvent) -> bool:
+        if self.backlog is None or not self.fleet.can_carry(event):
+            return False
 
-        journey = await self._create_journey(event, truck)
+        freed_trucks = self._freed_trucks[event.id] = {}
+        try:
+            origin_location, destination_location = await self._get_locations(event)
+        finally:
+            del self._freed_trucks[event.id]
+        if not self.backlog.add(event, origin_location, destination_location):
+            return False
+
+        logger.info(f"No free truck, event with id {event.id} added to the backlog")
+        # the trucks freed while the locations were geocoded didn't see the event
+        for truck in freed_trucks.values():
+            self._dispatch_from_backlog(self.backlog, truck)
+        return True
+
+    async def _dispatch_journey(self, event: DeliveryRequestEvent, truck: Truck):
+        """
+        Dispatches the journey with the reserved truck
+        """
+        consolidated: list[PendingRequest] = []
+        try:
+            stops, consolidated = await self._plan_journey(event, truck)
+            journey = await self._create_journey(stops, truck)
+        except Exception:
+            self.fleet.release_truck(truck)
+            self._on_truck_freed(truck)
+            self._return_to_backlog(consolidated)
+            raise
 
         logger.info(f"Created journey {journey.get_info()}")
 
@@ -112,19 +271,108 @@ class TTS:
             route_geography=f"LINESTRING({points})",
         )
 
-    async def _create_journey(self, event: DeliveryRequestEvent, truck: Truck):
-        return Journey.create(
-            truck=truck,
-            route=Route.from_truck_location_origin_and_destination(
-                self.maps_client,
-                truck,
-                event.origin_address,
-                event.destination_address,
-            ),
-            starting_delay=0,
+    @traced("tts.plan_journey")
+    async def _plan_journey(
+        self, event: DeliveryRequestEvent, truck: Truck
+    ) -> tuple[list[RouteStop], list[PendingRequest]]:
+        """
+        Returns the stops of the journey and the backlog requests consolidated
+        into it, which are removed from the backlog
+        """
+        backlog = self.backlog
+        if backlog is None or not len(backlog) or self.planner.max_deliveries < 2:
+            return get_direct_stops(event), []
+
+        origin_location, destination_location = await self._get_locations(event)
+        candidates = backlog.find_candidates(
+            origin_location, truck.max_load_weight, self.planner.candidates_number
+        )
+        if not candidates:
+            return get_direct_stops(event), []
+
+        stops = self.planner.plan(
+            truck.location,
+            truck.max_load_weight,
+            Delivery(event, origin_location, destination_location),
+            [
+                Delivery(c.event, c.origin_location, c.destination_location)
+                for c in candidates
+            ],
+        )
+        # there was no await since the candidates were found, so all of them
+        # are still in the backlog
+        consolidated = [
+            request
+            for event_id in dict.fromkeys(stop.event_id for stop in stops)
+            if event_id != event.id and (request := backlog.remove(event_id))
+        ]
+        if consolidated:
+            logger.info(
+                f"Consolidated backlog events with ids "
+                f"{[r.event.id for r in consolidated]} into the journey "
+                f"of event with id {event.id}"
+            )
+        return stops, consolidated
+
+    @traced("tts.create_journey")
+    async def _create_journey(self, stops: list[RouteStop], truck: Truck):
+        # the Maps API calls are blocking, so they don't stall the other workers
+        route = await asyncio.to_thread(
+            Route.from_truck_location_and_stops, self.maps_client, truck, stops
+        )
+        return Journey.create(truck=truck, route=route, starting_delay=0)
+
+    async def _get_locations(
+        self, event: DeliveryRequestEvent
+    ) -> tuple[LocationPoint, LocationPoint]:
+        origin_location, destination_location = await asyncio.gather(
+            asyncio.to_thread(self.maps_client.get_location, event.origin_address),
+            asyncio.to_thread(self.maps_client.get_location, event.destination_address),
         )
+        return origin_location, destination_location
 
+    def _on_truck_freed(self, truck: Truck):
+        for freed_trucks in self._freed_trucks.values():
+            freed_trucks[truck.id] = truck
+
+    def _return_to_backlog(self, requests: list[PendingRequest]):
+        for request in requests:
+            if self.backlog is None or not self.backlog.add(
+                request.event, request.origin_location, request.destination_location
+            ):
+                self.pub_sub_client.add_domain_log_nowait(
+                    self.fleet.get_truck_not_found_domain_log(request.event)
+                )
+
+    @traced("tts.serve_journey")
     async def _serve_journey(self, journey: Journey):
-        journey.truck.in_journey = True
-        self.journeys.append(journey)
-        asyncio.create_task(journey.run(self._journey_finished_queue))
+        self.fleet.start_journey(journey.truck)
+        self.journeys.add_journey(journey)
+        self.eta_service.add_journey(journey)
+        self.pub_sub_client.start_track(journey.truck.id, journey.route.location_points)
+        asyncio.create_task(
+            journey.run(
+                self._journey_finished_queue,
+                on_move=self._on_truck_moved,
+                on_stop=self._on_journey_stop,
+            )
+        )
+
+    def _on_truck_moved(self, journey: Journey):
+        self.journeys.update_truck_location(journey.truck)
+        if self.geofence_engine:
+            self.geofence_engine.mark_moved(journey.truck)
+        self.position_stream.mark_moved(journey.truck)
+        self.pub_sub_client.add_track_point(
+            journey.truck.id,
+            journey.route_index,
+            journey.truck.location,
+            get_timestamp(),
+        )
+
+    def _on_journey_stop(self, journey: Journey, stop: RouteStop):
+        logger.info(
+            f"Truck {journey.truck.id} {stop.type} event with id {stop.event_id} "
+            f"at {stop.address}"
+        )
+        self.pub_sub_client.add_domain_log_nowait(journey.get_stop_domain_log(stop))
@@ -3,3 +3,12 @@ import datetime
 
 def get_timestamp() -> int:
     return int(datetime.datetime.now().timestamp() * 1000)
+
+
+def get_city(address: str | None) -> str | None:
+    """
+    Returns the normalized city of the address, e.g. "kaunas" for "Kaunas, Lithuania"
+    """
+    if not address:
+        return None
+    return address.split(",")[0].strip().lower() or None
@@ -1,8 +1,25 @@
+import dataclasses
 import typing
 
 from pydantic import BaseModel
 
 
-class Notification(BaseModel):
+class PushMessage(BaseModel):
+    attributes: dict[str, str]
+    data: str
+
+
+class PushRequest(BaseModel):
+    """
+    Body of the Pub/Sub push subscription request
+    https://cloud.google.com/pubsub/docs/push#receive_push
+    """
+
+    message: PushMessage
+
+
+@dataclasses.dataclass(slots=True)
+class Notification:
     event_type: str
     additional_data: dict[str, typing.Any]
+    traceparent: str | None = None
@@ -1,32 +1,157 @@
+from __future__ import annotations
+
 import asyncio
-import json
+import functools
+import hashlib
 import logging
-
-from telebot import TeleBot  # type: ignore[import-untyped]
-from telebot.types import Message  # type: ignore[import-untyped]
-
-from app.config import TELEGRAM_API_TOKEN
+import typing
+
+from app.config import (
+    SUBSCRIPTIONS_DB_FILE,
+    SUBSCRIPTIONS_STORAGE,
+    TELEGRAM_WEBHOOK_SECRET,
+    get_telegram_api_token,
+)
+from app.diagnostics.tracing import SpanContext, tracer
+from app.serialization import dumps
+from app.simulation.log import LogType
 from app.telegram_bot_server.schemas import Notification
+from app.telegram_bot_server.subscriptions import (
+    DatastoreSubscriptionStorage,
+    SqliteSubscriptionStorage,
+    SubscriptionKind,
+    SubscriptionStorage,
+    SubscriptionStore,
+)
 
-bot = TeleBot(TELEGRAM_API_TOKEN)
+if typing.TYPE_CHECKING:
+    from telebot.async_telebot import AsyncTeleBot  # type: ignore[import-untyped]
+    from telebot.types import Message  # type: ignore[import-untyped]
 
-notifications_chat_ids = []
+WEBHOOK_PATH = "/telegram/webhook"
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
 logger = logging.getLogger(__name__)
 
+# the domain logs forwarded to the server by the push subscription filter
+NOTIFIED_LOG_TYPES = (
+    LogType.TRUCK_NOT_FOUND,
+    LogType.GEOFENCE_ENTERED,
+    LogType.GEOFENCE_EXITED,
+    LogType.DELIVERY_REQUEST_SHED,
+)
+
+SUBSCRIBE_USAGE = f"""
+    Usage: /subscribe <kind> [value], kinds: {', '.join(SubscriptionKind)}
+    Events: {', '.join(t.value for t in NOTIFIED_LOG_TYPES)}
+
+    /subscribe all
+    /subscribe event {LogType.TRUCK_NOT_FOUND.value}
+    /subscribe truck 1
+    /subscribe city Vilnius
+    """
 
-@bot.message_handler(commands=["info"])
-def info(message: Message):
-    if message.chat.id not in notifications_chat_ids:
-        notifications_chat_ids.append(message.chat.id)
+
+@functools.cache
+def get_bot() -> AsyncTeleBot:
+    """
+    Creates the bot on the first use, telebot takes a noticeable share of the
+    server cold start and the bot token is required only here
+    """
+    from telebot.async_telebot import AsyncTeleBot
+
+    bot = AsyncTeleBot(get_telegram_api_token())
+    bot.register_message_handler(info, commands=["info"])
+    bot.register_message_handler(subscribe, commands=["subscribe"])
+    bot.register_message_handler(unsubscribe, commands=["unsubscribe"])
+    bot.register_message_handler(subscriptions, commands=["subscriptions"])
+    return bot
+
+
+@functools.cache
+def get_subscription_store() -> SubscriptionStore:
+    storage: SubscriptionStorage
+    if SUBSCRIPTIONS_STORAGE == "datastore":
+        # the service account is bound to the Cloud Run instance
+        storage = DatastoreSubscriptionStorage()
+    else:
+        storage = SqliteSubscriptionStorage(SUBSCRIPTIONS_DB_FILE)
+    return SubscriptionStore(storage)
+
+
+def parse_subscription(text: str) -> tuple[SubscriptionKind, str] | None:
+    """
+    Parses the arguments of the /subscribe and /unsubscribe commands
+    """
+    args = text.split(maxsplit=2)[1:]
+    if not args or args[0].lower() not in list(SubscriptionKind):
+        return None
+
+    kind = SubscriptionKind(args[0].lower())
+    value = args[1] if len(args) > 1 else ""
+    if kind == SubscriptionKind.ALL:
+        return kind, ""
+    if not value:
+        return None
+    # the other events never reach the server, so nothing would be notified
+    if kind == SubscriptionKind.EVENT and value.lower() not in NOTIFIED_LOG_TYPES:
+        return None
+    if kind == SubscriptionKind.TRUCK and not value.isdigit():
+        return None
+    return kind, value
+
+
+def format_subscriptions(chat_id: int) -> str:
+    subscriptions = get_subscription_store().get_subscriptions(chat_id)
+    if not subscriptions:
+        return "No subscriptions"
+    return "\n".join(f"{kind} {value}".strip() for kind, value in subscriptions)
+
+
+async def info(message: Message):
+    store = get_subscription_store()
+    if not store.get_subscriptions(message.chat.id):
+        await store.subscribe(message.chat.id, SubscriptionKind.ALL)
     data = f"""
     Bot sends important notification about Truck Tracking system
-    
-    Subscribed chat ids: {', '.join([str(i) for i in notifications_chat_ids])}
-    
-    Querying an info automatically subscribes you to the notifications
+
+    Your subscriptions:
+{format_subscriptions(message.chat.id)}
+
+    Querying an info automatically subscribes you to all notifications, when
+    you have no subscriptions. Use /subscribe, /unsubscribe and /subscriptions
+    to choose the notifications
+    """
+    await get_bot().send_message(message.chat.id, data)
+
+
+async def subscribe(message: Message):
+    if not (subscription := parse_subscription(message.text)):
+        await get_bot().send_message(message.chat.id, SUBSCRIBE_USAGE)
+        return
+
+    await get_subscription_store().subscribe(message.chat.id, *subscription)
+    await get_bot().send_message(message.chat.id, format_subscriptions(message.chat.id))
+
+
+async def unsubscribe(message: Message):
     """
-    bot.send_message(message.chat.id, data)
+    Removes the subscription or all subscriptions without the arguments
+    """
+    store = get_subscription_store()
+    if len(message.text.split()) == 1:
+        await store.unsubscribe(message.chat.id)
+    elif subscription := parse_subscription(message.text):
+        await store.unsubscribe(message.chat.id, *subscription)
+    else:
+        await get_bot().send_message(message.chat.id, SUBSCRIBE_USAGE)
+        return
+
+    await get_bot().send_message(message.chat.id, format_subscriptions(message.chat.id))
+
+
+async def subscriptions(message: Message):
+    await get_bot().send_message(message.chat.id, format_subscriptions(message.chat.id))
 
 
 def get_message(notification: Notification) -> str:
@@ -35,25 +160,96 @@ def get_message(notification: Notification) -> str:
 
 Event: {notification.event_type}
 
-Additional info: {json.dumps(notification.additional_data)}
+Additional info: {dumps(notification.additional_data)}
     """
 
 
-async def send_telegram_messages(queue: asyncio.Queue[Notification]):
-    while True:
-        notification = await queue.get()
-        logger.info(
-            f"Got new notification, will send for chat ids {notifications_chat_ids}"
+class NotificationNotSentError(Exception):
+    pass
+
+
+def is_retryable(error: BaseException) -> bool:
+    from telebot.asyncio_helper import (  # type: ignore[import-untyped]
+        ApiTelegramException,
+    )
+
+    # e.g. the chat has blocked the bot, the retries would fail the same way
+    if isinstance(error, ApiTelegramException):
+        return error.error_code == 429 or error.error_code >= 500
+    return True
+
+
+async def send_telegram_messages(notification: Notification):
+    """
+    Sends the notification to the subscribed chats. Raises
+    NotificationNotSentError when a message has failed with a transient error,
+    the notification is sent again to all its chats then
+    """
+    chat_ids = list(get_subscription_store().find_chat_ids(notification))
+    logger.info(f"Got new notification, will send for chat ids {chat_ids}")
+    with tracer.start_span(
+        "telegram_bot.send_messages",
+        parent=SpanContext.from_traceparent(notification.traceparent),
+        attributes={"chats_number": len(chat_ids)},
+    ):
+        text = get_message(notification)
+        results = await asyncio.gather(
+            *[get_bot().send_message(chat_id, text) for chat_id in chat_ids],
+            return_exceptions=True,
+        )
+
+    failed_chats_number = 0
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Failed to send notification to {chat_id}: {result}")
+            failed_chats_number += is_retryable(result)
+    if failed_chats_number:
+        raise NotificationNotSentError(
+            f"Failed to send notification to {failed_chats_number} chats"
         )
-        for chat_id in notifications_chat_ids:
-            bot.send_message(chat_id, get_message(notification))
 
 
-# start in separate thread
-def serve_telegram_bot():
+def get_webhook_secret() -> str:
+    """
+    Returns the secret token of the webhook requests, by default it is derived
+    from the bot token, so it is the same for all instances of the server
+    """
+    if TELEGRAM_WEBHOOK_SECRET:
+        return TELEGRAM_WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{get_telegram_api_token()}".encode()).hexdigest()
+
+
+async def set_telegram_webhook(base_url: str):
+    url = f"{base_url.rstrip('/')}{WEBHOOK_PATH}"
+    logger.info(f"Setting Telegram webhook to {url}")
+    await get_bot().set_webhook(url=url, secret_token=get_webhook_secret())
+
+
+async def process_telegram_update(data: dict[str, typing.Any]):
+    from telebot.types import Update
+
+    await get_bot().process_new_updates([Update.de_json(data)])
+
+
+async def serve_telegram_bot():
+    """
+    Long-polls the Telegram on the event loop, used when the webhook URL is
+    not configured, e.g. in the local runs
+    """
     logger.info("Starting polling for Telegram messages...")
-    bot.polling()
+    await get_bot().delete_webhook()
+    await get_bot().infinity_polling()
+
+
+async def close_telegram_bot():
+    await get_bot().close_session()
+    await get_subscription_store().close()
+
+
+async def main():
+    await get_subscription_store().load()
+    await serve_telegram_bot()
 
 
 if __name__ == "__main__":
-    serve_telegram_bot()
+    asyncio.run(main())
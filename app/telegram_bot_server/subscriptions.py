@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import collections
+import enum
+import sqlite3
+import typing
+
+from app.simulation.utils import get_city
+from app.telegram_bot_server.schemas import Notification
+
+if typing.TYPE_CHECKING:
+    from gcloud.aio.datastore import Datastore, Key
+
+
+class SubscriptionKind(enum.StrEnum):
+    ALL = enum.auto()
+    EVENT = enum.auto()
+    TRUCK = enum.auto()
+    CITY = enum.auto()
+
+
+# value is an empty string for the ALL subscriptions
+Subscription = tuple[SubscriptionKind, str]
+
+
+SUBSCRIPTION_ENTITY_KIND = "Subscription"
+
+
+class SubscriptionStorage(typing.Protocol):
+    async def load(self) -> list[tuple[int, Subscription]]:
+        ...
+
+    async def add(self, chat_id: int, subscription: Subscription) -> None:
+        ...
+
+    async def remove(self, chat_id: int, subscriptions: list[Subscription]) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class SqliteSubscriptionStorage:
+    """
+    Subscriptions in the SQLite file on the local disk, used in the local runs
+    """
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            "chat_id INTEGER NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (chat_id, kind, value))"
+        )
+        self._connection.commit()
+
+    async def load(self) -> list[tuple[int, Subscription]]:
+        return [
+            (chat_id, (SubscriptionKind(kind), value))
+            for chat_id, kind, value in self._connection.execute(
+                "SELECT chat_id, kind, value FROM subscriptions"
+            )
+        ]
+
+    async def add(self, chat_id: int, subscription: Subscription) -> None:
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?)",
+                (chat_id, *subscription),
+            )
+
+    async def remove(self, chat_id: int, subscriptions: list[Subscription]) -> None:
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM subscriptions WHERE chat_id = ? AND kind = ? AND value = ?",
+                [(chat_id, *s) for s in subscriptions],
+            )
+
+    async def close(self) -> None:
+        self._connection.close()
+
+
+class DatastoreSubscriptionStorage:
+    """
+    Subscriptions as the entities of Firestore in Datastore mode, one entity
+    per subscription keyed by the chat id, the kind and the value, so the
+    writes of the concurrent instances never conflict. The project is the one
+    of the service account, when it's not given
+    """
+
+    def __init__(self, project: str | None = None, service_file: str | None = None):
+        self.project = project
+        self.service_file = service_file
+        # created on the first use, gcloud.aio takes a large share of the
+        # server cold start
+        self._datastore: Datastore | None = None
+
+    @property
+    def datastore(self) -> Datastore:
+        if self._datastore is None:
+            from gcloud.aio.datastore import Datastore
+
+            self._datastore = Datastore(
+                project=self.project, service_file=self.service_file
+            )
+        return self._datastore
+
+    async def load(self) -> list[tuple[int, Subscription]]:
+        from gcloud.aio.datastore import MoreResultsType, Query
+
+        subscriptions: list[tuple[int, Subscription]] = []
+        cursor = ""
+        while True:
+            batch = await self.datastore.runQuery(
+                Query(kind=SUBSCRIPTION_ENTITY_KIND, start_cursor=cursor)
+            )
+            for result in batch.entity_results:
+                properties = result.entity.properties
+                subscriptions.append(
+                    (
+                        int(properties["chat_id"]),
+                        (SubscriptionKind(properties["kind"]), properties["value"]),
+                    )
+                )
+            if batch.more_results != MoreResultsType.NOT_FINISHED:
+                return subscriptions
+            cursor = batch.end_cursor
+
+    async def add(self, chat_id: int, subscription: Subscription) -> None:
+        from gcloud.aio.datastore import Mode, Operation
+
+        kind, value = subscription
+        mutation = self.datastore.make_mutation(
+            Operation.UPSERT,
+            await self._get_key(chat_id, subscription),
+            properties={"chat_id": chat_id, "kind": kind.value, "value": value},
+        )
+        await self.datastore.commit([mutation], mode=Mode.NON_TRANSACTIONAL)
+
+    async def remove(self, chat_id: int, subscriptions: list[Subscription]) -> None:
+        from gcloud.aio.datastore import Mode, Operation
+
+        if not subscriptions:
+            return
+        mutations = [
+            self.datastore.make_mutation(
+                Operation.DELETE, await self._get_key(chat_id, subscription)
+            )
+            for subscription in subscriptions
+        ]
+        await self.datastore.commit(mutations, mode=Mode.NON_TRANSACTIONAL)
+
+    async def close(self) -> None:
+        if self._datastore is not None:
+            await self._datastore.close()
+
+    async def _get_key(self, chat_id: int, subscription: Subscription) -> Key:
+        from gcloud.aio.datastore import Key, PathElement
+
+        kind, value = subscription
+        return Key(
+            await self.datastore.project(),
+            [PathElement(SUBSCRIPTION_ENTITY_KIND, name=f"{chat_id}:{kind}:{value}")],
+        )
+
+
+class SubscriptionStore:
+    """
+    Chat subscriptions persisted in the storage and kept in memory as the
+    inverted index from the subscription to the chat ids. A chat gets the
+    notification when any of its subscriptions matches it
+    """
+
+    def __init__(self, storage: SubscriptionStorage):
+        self.storage = storage
+        self._chat_ids: dict[Subscription, set[int]] = collections.defaultdict(set)
+        self._subscriptions: dict[int, set[Subscription]] = collections.defaultdict(set)
+
+    async def load(self) -> None:
+        for chat_id, subscription in await self.storage.load():
+            self._add(chat_id, subscription)
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    async def subscribe(
+        self, chat_id: int, kind: SubscriptionKind, value: str = ""
+    ) -> bool:
+        """
+        Returns False if the chat is already subscribed
+        """
+        subscription = (kind, self.normalize(kind, value))
+        if subscription in self._subscriptions.get(chat_id, ()):
+            return False
+
+        await self.storage.add(chat_id, subscription)
+        self._add(chat_id, subscription)
+        return True
+
+    async def unsubscribe(
+        self, chat_id: int, kind: SubscriptionKind | None = None, value: str = ""
+    ) -> int:
+        """
+        Removes the subscription or all subscriptions of the chat when the kind
+        is not specified, returns the number of removed subscriptions
+        """
+        if kind is None:
+            subscriptions = list(self._subscriptions.get(chat_id, ()))
+        else:
+            subscription = (kind, self.normalize(kind, value))
+            subscriptions = (
+                [subscription]
+                if subscription in self._subscriptions.get(chat_id, ())
+                else []
+            )
+
+        await self.storage.remove(chat_id, subscriptions)
+        for subscription in subscriptions:
+            self._remove(chat_id, subscription)
+        return len(subscriptions)
+
+    def get_subscriptions(self, chat_id: int) -> list[Subscription]:
+        return sorted(self._subscriptions.get(chat_id, ()))
+
+    def find_chat_ids(self, notification: Notification) -> set[int]:
+        """
+        Returns the chats subscribed to the notification, looking up only the
+        subscriptions that can match it
+        """
+        data = notification.additional_data
+        keys: list[Subscription] = [
+            (SubscriptionKind.ALL, ""),
+            (SubscriptionKind.EVENT, notification.event_type),
+        ]
+        if (truck_id := data.get("truck_id")) is not None:
+            keys.append((SubscriptionKind.TRUCK, str(truck_id)))
+        for field in ["origin_address", "destination_address"]:
+            if city := get_city(data.get(field)):
+                keys.append((SubscriptionKind.CITY, city))
+
+        chat_ids: set[int] = set()
+        for key in keys:
+            if ids := self._chat_ids.get(key):
+                chat_ids |= ids
+        return chat_ids
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+    @staticmethod
+    def normalize(kind: SubscriptionKind, value: str) -> str:
+        if kind == SubscriptionKind.ALL:
+            return ""
+        if kind == SubscriptionKind.CITY:
+            return get_city(value) or ""
+        return value.strip().lower()
+
+    def _add(self, chat_id: int, subscription: Subscription) -> None:
+        self._chat_ids[subscription].add(chat_id)
+        self._subscriptions[chat_id].add(subscription)
+
+    def _remove(self, chat_id: int, subscription: Subscription) -> None:
+        self._chat_ids[subscription].discard(chat_id)
+        if not self._chat_ids[subscription]:
+            del self._chat_ids[subscription]
+        self._subscriptions[chat_id].discard(subscription)
+        if not self._subscriptions[chat_id]:
+            del self._subscriptions[chat_id]
@@ -24,6 +24,13 @@ variable "maps_api_token" {}
 
 variable "telegram_api_token" {}
 
+# public URL of the notifications server, Telegram pushes the bot updates
+# to its webhook, when empty the server falls back to polling
+variable "notifications_server_url" {
+  type    = string
+  default = ""
+}
+
 provider "google" {
   credentials = file("../var/${var.sa_account_file}")
   project     = var.project
@@ -146,6 +153,11 @@ resource "google_pubsub_topic" "journeys_topic" {
 }
 
 
+resource "google_pubsub_topic" "iot_events_compact_topic" {
+  name = "iot-events-compact"
+}
+
+
 # Pub/Sub subscriptions
 
 resource "google_pubsub_subscription" "domain_logs_subscription" {
@@ -178,6 +190,23 @@ resource "google_pubsub_subscription" "iot_events_subscription" {
   timeouts {}
 }
 
+# the batches of the compact telemetry are stored as they are, with the
+# truck_id and encoding attributes, and decoded by decode_track_batch
+resource "google_pubsub_subscription" "iot_events_compact_subscription" {
+  name       = "iot-events-compact-big-query-sync"
+  topic      = "projects/${var.project}/topics/${google_pubsub_topic.iot_events_compact_topic.name}"
+  depends_on = [google_pubsub_topic.iot_events_compact_topic, google_bigquery_table.iot_events_compact_table]
+
+  bigquery_config {
+    drop_unknown_fields = false
+    table               = "${var.project}.iot_events_data.iot-events-compact"
+    use_topic_schema    = false
+    write_metadata      = true
+  }
+
+  timeouts {}
+}
+
 resource "google_pubsub_subscription" "journeys_subscription" {
   name       = "journeys-big-query-sync"
   topic      = "projects/${var.project}/topics/${google_pubsub_topic.journeys_topic.name}"
@@ -198,9 +227,17 @@ resource "google_pubsub_subscription" "domain_logs_notifications_subscription" {
   topic      = "projects/${var.project}/topics/domain-logs"
   depends_on = [google_pubsub_topic.domain_logs_topic, google_cloud_run_v2_service.notifications_server_cloud_run]
 
-  ack_deadline_seconds = 10
+  # the messages are sent to Telegram before the push is acked
+  ack_deadline_seconds = 60
+
+  retry_policy {
+    minimum_backoff = "10s"
+    maximum_backoff = "600s"
+  }
+
+  # the forwarded types are the NOTIFIED_LOG_TYPES of the notifications server
 
-  filter = "attributes.type = \"truck_not_found\""
+  filter = "attributes.type = \"truck_not_found\" OR attributes.type = \"geofence_entered\" OR attributes.type = \"geofence_exited\" OR attributes.type = \"delivery_request_shed\""
 
   push_config {
     push_endpoint = "${google_cloud_run_v2_service.notifications_server_cloud_run.uri}/notifications"
@@ -345,6 +382,46 @@ resource "google_bigquery_table" "iot_events_table" {
   table_id = "iot-events"
 }
 
+resource "google_bigquery_table" "iot_events_compact_table" {
+  depends_on               = [google_bigquery_dataset.iot_events_data_dataset]
+  dataset_id               = google_bigquery_dataset.iot_events_data_dataset.dataset_id
+  deletion_protection      = false
+  labels                   = {}
+  project                  = var.project
+  require_partition_filter = false
+  # the columns of the messages written by the subscription with the metadata
+  schema = jsonencode(
+    [
+      {
+        mode = "NULLABLE"
+        name = "subscription_name"
+        type = "STRING"
+      },
+      {
+        mode = "NULLABLE"
+        name = "message_id"
+        type = "STRING"
+      },
+      {
+        mode = "NULLABLE"
+        name = "publish_time"
+        type = "TIMESTAMP"
+      },
+      {
+        mode = "NULLABLE"
+        name = "data"
+        type = "BYTES"
+      },
+      {
+        mode = "NULLABLE"
+        name = "attributes"
+        type = "JSON"
+      },
+    ]
+  )
+  table_id = "iot-events-compact"
+}
+
 resource "google_bigquery_table" "domain_logs_with_json_data_view" {
   depends_on               = [google_bigquery_table.domain_logs_table]
   dataset_id               = google_bigquery_dataset.iot_events_data_dataset.dataset_id
@@ -533,8 +610,8 @@ resource "google_bigquery_table" "tts_state_domain_logs_view" {
       },
       {
         mode = "NULLABLE"
-        name = "trucks"
-        type = "JSON"
+        name = "reserved_trucks"
+        type = "INTEGER"
       },
       {
         mode = "NULLABLE"
@@ -552,7 +629,7 @@ resource "google_bigquery_table" "tts_state_domain_logs_view" {
               INT64(data_json.number_of_journeys) as number_of_journeys,
               INT64(data_json.fleet.busy_trucks) as busy_trucks,
               INT64(data_json.fleet.free_trucks) as free_trucks,
-              data_json.fleet.trucks,
+              INT64(data_json.fleet.reserved_trucks) as reserved_trucks,
               timestamp_datetime
             FROM `${var.project}.iot_events_data.domain-logs-with-json-data`
             WHERE type = 'tts_state' AND timestamp_datetime > DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 60 MINUTE)
@@ -616,7 +693,7 @@ resource "google_bigquery_table" "truck_not_found_domain_logs_view" {
 }
 
 resource "google_bigquery_table" "latest_trucks_data_view" {
-  depends_on               = [google_bigquery_table.tts_state_domain_logs_view]
+  depends_on               = [google_bigquery_table.domain_logs_table]
   dataset_id               = google_bigquery_dataset.iot_events_data_dataset.dataset_id
   deletion_protection      = false
   project                  = var.project
@@ -643,19 +720,25 @@ resource "google_bigquery_table" "latest_trucks_data_view" {
   table_id = "latest-trucks-data"
 
   view {
+    # the TTS state has only the aggregates of the fleet, so the state of
+    # the truck is taken from its latest journey: busy at the start of the
+    # route since the dispatch, free at the finish location
     query          = <<-EOT
             SELECT
-             INT64(trucks_data.id) as id,
-             BOOL(trucks_data.in_journey) as in_journey,
-             ST_GEOGPOINT(FLOAT64(trucks_data.location.lon), FLOAT64(trucks_data.location.lat)) as location
+             INT64(data_json.truck_id) as id,
+             type = 'journey_dispatched' as in_journey,
+             IF(
+               type = 'journey_dispatched',
+               ST_GEOGPOINT(FLOAT64(data_json.route_lines[0].lon), FLOAT64(data_json.route_lines[0].lat)),
+               ST_GEOGPOINT(FLOAT64(data_json.truck_location.lon), FLOAT64(data_json.truck_location.lat))
+             ) as location
              FROM
               (
-                SELECT trucks
-                FROM `${var.project}.iot_events_data.tts-state-domain-logs`
-                ORDER BY timestamp_datetime desc
-                LIMIT 1
-                ) as domain_logs,
-              UNNEST(JSON_EXTRACT_ARRAY(trucks, '$')) AS trucks_data
+                SELECT type, SAFE.PARSE_JSON(data) AS data_json, timestamp
+                FROM `${var.project}.iot_events_data.domain-logs`
+                ) as domain_logs
+             WHERE type IN ('journey_dispatched', 'journey_finished')
+             QUALIFY ROW_NUMBER() OVER (PARTITION BY INT64(data_json.truck_id) ORDER BY timestamp DESC) = 1
         EOT
     use_legacy_sql = false
   }
@@ -865,6 +948,21 @@ resource "google_cloud_run_service_iam_policy" "tts_server_noauth" {
   policy_data = data.google_iam_policy.no_auth.policy_data
 }
 
+# the subscriptions of the notifications server outlive its instances, the
+# concurrent revisions write them as separate entities
+resource "google_firestore_database" "datastore_database" {
+  project     = var.project
+  name        = "(default)"
+  location_id = var.region
+  type        = "DATASTORE_MODE"
+}
+
+resource "google_project_iam_member" "datastore_user" {
+  project = var.project
+  role    = "roles/datastore.user"
+  member  = "serviceAccount:${google_service_account.service_account.email}"
+}
+
 resource "google_cloud_run_v2_service" "notifications_server_cloud_run" {
   name     = "notifications-server"
   location = var.location
@@ -874,7 +972,9 @@ resource "google_cloud_run_v2_service" "notifications_server_cloud_run" {
     service_account = google_service_account.service_account.email
     scaling {
       max_instance_count = 1
-      min_instance_count = 1
+      # the webhook and the push subscription start the instance on demand,
+      # while polling the bot updates the instance must be always running
+      min_instance_count = var.notifications_server_url != "" ? 0 : 1
     }
 
     containers {
@@ -900,6 +1000,14 @@ resource "google_cloud_run_v2_service" "notifications_server_cloud_run" {
           }
         }
       }
+      env {
+        name  = "TELEGRAM_WEBHOOK_URL"
+        value = var.notifications_server_url
+      }
+      env {
+        name  = "SUBSCRIPTIONS_STORAGE"
+        value = "datastore"
+      }
     }
   }
 
@@ -908,6 +1016,8 @@ resource "google_cloud_run_v2_service" "notifications_server_cloud_run" {
     percent = 100
   }
   depends_on = [
+    google_firestore_database.datastore_database,
+    google_project_iam_member.datastore_user,
     google_secret_manager_secret_version.maps_api_token_secret_version_data,
     google_secret_manager_secret_version.telegram_api_token_secret_version_data,
   ]